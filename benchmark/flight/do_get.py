@@ -0,0 +1,52 @@
+# microbenchmark for the bookkeeping part of FlightServer.do_get, i.e. figuring out which cached objects to return.
+# we fill the cache directly instead of going through do_put so we can get to 1M objects in reasonable time, 
+# and call do_get in process so we don't measure gRPC.
+# usage: python do_get.py [num_objects ...]
+
+import sys
+import time
+import pickle
+import pyarrow
+import pyarrow.flight
+import polars
+from pyquokka.flight import FlightServer
+
+SOURCE_ACTORS = 2
+SOURCE_CHANNELS = 16
+TARGET_CHANNELS = 8
+TRIALS = 1000
+
+def fill(server, num_objects):
+    batch = pyarrow.RecordBatch.from_pydict({"a": [1, 2, 3]})
+    per_stream = num_objects // (SOURCE_ACTORS * SOURCE_CHANNELS * TARGET_CHANNELS)
+    for source_actor_id in range(SOURCE_ACTORS):
+        for source_channel_id in range(SOURCE_CHANNELS):
+            for target_channel_id in range(TARGET_CHANNELS):
+                for seq in range(per_stream):
+                    name = (source_actor_id, source_channel_id, seq, 100, 0, target_channel_id)
+                    server.flights[name] = ([batch], "polars")
+                    server.flight_keys.add(name)
+    return per_stream
+
+def bench(num_objects):
+    server = FlightServer("localhost", location = "grpc+tcp://localhost:0")
+    per_stream = fill(server, num_objects)
+
+    # consumers are somewhere in the middle of their streams
+    input_reqs = polars.from_dict({"source_actor_id": [a for a in range(SOURCE_ACTORS) for c in range(SOURCE_CHANNELS)],
+        "source_channel_id": [c for a in range(SOURCE_ACTORS) for c in range(SOURCE_CHANNELS)],
+        "min_seq": [per_stream // 2] * (SOURCE_ACTORS * SOURCE_CHANNELS)})
+
+    tickets = [pyarrow.flight.Ticket(pickle.dumps(("cache", 100, k % TARGET_CHANNELS, input_reqs, False))) for k in range(TRIALS)]
+    start = time.time()
+    for ticket in tickets:
+        server.do_get(None, ticket)
+    elapsed = time.time() - start
+
+    server.shutdown()
+    print(len(server.flight_keys), "cached objects:", round(elapsed / TRIALS * 1e6, 1), "us per do_get")
+
+if __name__ == '__main__':
+    sizes = [int(i) for i in sys.argv[1:]] if len(sys.argv) > 1 else [10000, 100000, 1000000]
+    for size in sizes:
+        bench(size)
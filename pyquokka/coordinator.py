@@ -117,6 +117,8 @@ class Coordinator:
             except ray.exceptions.RayActorError:
                 print("detected failure")
                 self.r.set("recovery-lock", 1)
+                # the TaskManagers are mostly listening for this instead of checking the lock
+                self.r.publish("quokka-recovery", b"")
 
                 start = time.time()
                 while True:
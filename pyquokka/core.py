@@ -1,6 +1,7 @@
 import ray
 import pyarrow
 import pyarrow.flight
+import pyarrow.ipc
 import pickle
 import redis
 from pyquokka.hbq import * 
@@ -10,6 +11,11 @@ import polars
 import time
 import boto3
 import types
+import concurrent.futures
+from collections import deque
+from functools import partial
+import os
+import uuid
 
 CHECKPOINT_INTERVAL = None
 MAX_SEQ = 1000000000
@@ -18,6 +24,25 @@ PROFILE = False
 FT = False
 MEM_LIMIT = 0.25
 MAX_BATCHES = 5
+# how many pushes a TaskManager can have in flight on its background sender before the main loop waits
+PUSH_QUEUE_DEPTH = 2
+# bytes of pushed batches the Flight server keeps in memory before spilling to disk. None means never spill.
+CACHE_MEM_BYTES = None
+# bytes the Flight server holds for one consumer channel, and in total. None for the global quota means keep MEM_LIMIT of system memory free.
+CONSUMER_QUOTA_BYTES = None
+GLOBAL_QUOTA_BYTES = None
+# pushes to the Flight server on the same machine are written here as Arrow IPC files and only the file names are sent. None to always use do_put.
+SHM_DIR = "/dev/shm/quokka/" if os.path.isdir("/dev/shm") else None
+# with shuffle_compression set to "adaptive", every this many pushes on an edge go out uncompressed to measure the link and pick the codec again
+COMPRESSION_PROBE_INTERVAL = 50
+# idle TaskManagers block on Redis pub/sub for at most this many seconds before looking around anyway, in case they missed a message
+EVENT_WAIT_TIMEOUT = 0.5
+# TaskManagers are told about recovery over pub/sub, this is how often they also check the recovery lock themselves
+RECOVERY_CHECK_INTERVAL = 1
+# how often a source that waits for the runtime filter of a join checks if all the channels of the join have published it
+RUNTIME_FILTER_CHECK_INTERVAL = 1
+# which channel with queued input an ExecTaskManager runs first: "most_bytes" for the biggest backlog, "oldest" for the input that has waited longest
+TASK_SELECTION = "most_bytes"
 
 def print_if_debug(*x):
     if DEBUG:
@@ -32,6 +57,44 @@ def record_batches_to_polars(batches):
     aligned_batches = [pyarrow.record_batch([pyarrow.concat_arrays([arr]) for arr in batch], schema=batch.schema) for batch in batches]
     return polars.from_arrow(pyarrow.Table.from_batches(aligned_batches))
 
+def ipc_size(batches, codec):
+    # bytes the batches take as an Arrow IPC stream compressed with codec (None, "lz4" or "zstd")
+    sink = pyarrow.BufferOutputStream()
+    writer = pyarrow.ipc.new_stream(sink, batches[0].schema, options = pyarrow.ipc.IpcWriteOptions(compression = codec))
+    for batch in batches:
+        writer.write_batch(batch)
+    writer.close()
+    return sink.getvalue().size
+
+def read_flight_chunks(reader):
+
+    # read a do_get stream from the local Flight server into a list of names and a list of lists of batches, one per name.
+    # objects that were pushed through shared memory come as a handle, we map those ourselves.
+
+    chunks_list = []
+    names = []
+    while True:
+        try:
+            chunk, metadata = reader.read_chunk()
+            name, format = pickle.loads(metadata)
+            if type(format) == tuple:
+                _, filename, format = format
+                shm_reader = pyarrow.ipc.open_file(pyarrow.memory_map(filename, 'r'))
+                chunks = [shm_reader.get_batch(i) for i in range(shm_reader.num_record_batches)]
+            else:
+                chunks = [chunk]
+            assert format == "polars"
+            if len(names) == 0 or name != names[-1]:
+                chunks_list.append(chunks)
+                names.append(name)
+            else:
+                chunks_list[-1].extend(chunks)
+                print("creating multi-chunk")
+
+        except StopIteration:
+            break
+    return names, chunks_list
+
 class ConnectionError(Exception):
     pass
 
@@ -54,11 +117,15 @@ class TaskManager:
 
         self.node_id = node_id
         self.mappings = {}
+        # actor_id -> list of source actor ids. a source is only read once the ones before it are drained.
+        self.orderings = {}
         self.function_objects = {}
 
         # key is source_actor_id, value is another dict of target_actor_id: fn
         self.partition_fns = {}
         self.target_count = {}
+        # key is source_actor_id, value is another dict of target_actor_id: number of target channels
+        self.target_channels = {}
 
         self.blocking_nodes = {}
 
@@ -69,6 +136,31 @@ class TaskManager:
         self.clear_flights(self.flight_client)
         self.set_flight_configs(self.flight_client)
         self.flight_clients = {i: pyarrow.flight.connect("grpc://" + str(i) + ":5005") for i in worker_ips}
+        # the client in flight_clients for the Flight server on this machine, pushes to it can go through shared memory
+        self.local_flight_client = self.flight_clients.get(ray.util.get_node_ip_address())
+
+        # credit based flow control: bytes each target channel's Flight server said it would still take from us.
+        # key is (target_actor_id, target_channel_id). Refilled from the do_put response, we only ask with check_puttable when we run out.
+        self.credits = {}
+
+        # IPC compression for do_put, set per query by set_configs: None, "lz4", "zstd" or "adaptive".
+        # edge_compression is (source_actor_id, target_actor_id) -> {"codec", "pushes", "ratio"}, the codec the edge uses right now,
+        # how many pushes it has done and the compressed / uncompressed size last measured for that codec.
+        # compression_stats is (source_actor_id, target_actor_id) -> [bytes before compression, bytes after that were measured, bytes after that were estimated].
+        # uncompressed pushes and probes are measured, the other compressed pushes are only estimated from the last measured ratio, since Flight compresses them.
+        self.compression = None
+        self.edge_compression = {}
+        self.compression_stats = {}
+
+        # (source_actor_id, target_actor_id) -> [RuntimeFilter or None, last time we looked for it] for the edges into joins whose
+        # build side publishes a runtime filter. Once all its channels have, the merged filter drops rows in the partition function.
+        self.runtime_filters = {}
+
+        # pushes are done by a background sender so the main loop can read or compute the next batch in the meantime.
+        # one thread so pushes go out in order. pending_pushes is a queue of (future, commit function),
+        # the commits are only run, in order, once the push is acknowledged.
+        self.sender = concurrent.futures.ThreadPoolExecutor(max_workers = 1)
+        self.pending_pushes = deque()
 
         #  Bytedance can write this.
         self.HBQ = HBQ(hbq_path)
@@ -92,6 +184,32 @@ class TaskManager:
         self.DST = DoneSeqTable()
         self.CLT = ChannelLocationTable()
         self.FOT = FunctionObjectTable()
+        self.RFT = RuntimeFilterTable()
+        self.EDT = EarlyDoneTable()
+
+        # nobody else touches our NTT outside of recovery, so we keep our own copy of the task list. task_commit updates it right away,
+        # even though the transaction might only run once the push is acknowledged. None means read it from Redis again.
+        self.tasks = None
+
+        # instead of polling Redis we listen on pub/sub. The coordinator announces recovery on quokka-recovery,
+        # finished channels are announced on quokka-done, and every output commit of an actor is announced on quokka-output-<actor_id>.
+        # done_seqs is our copy of the DST, which is only read in full when we might have missed announcements.
+        self.events = self.r.pubsub(ignore_subscribe_messages = True)
+        self.events.subscribe("quokka-recovery", "quokka-done", "quokka-cancel")
+        self.recovery_requested = False
+        self.last_recovery_check = 0
+        self.done_seqs = {}
+        self.dst_stale = True
+        self.dst_changed = False
+        # set when something other than new input could have made a task runnable, e.g. a channel it reads from finished
+        self.check_all = True
+
+        # early termination. early_done is our copy of the EDT, the exec channels that don't need the rest of their input, announced on quokka-cancel.
+        # cancelled are the actors nobody needs the outputs of anymore because of that, see update_cancelled.
+        self.early_done = set()
+        self.cancelled = set()
+        self.cancel_stale = True
+        self.cancel_changed = False
 
         # populate this dictionary from the initial assignment 
             
@@ -117,14 +235,65 @@ class TaskManager:
 
     def update_dst(self):
         # you only ever need the actor, channel pairs that have been registered in self.actor_flight_clients
+        # done_seqs is kept up to date from the quokka-done announcements, the whole table is only read when it's stale.
         
-        keys = self.DST.keys(self.r)
-        seqs = [int(i) for i in self.DST.mget(self.r, keys)]
-        actor_ids = [pickle.loads(k)[0] for k in keys]
-        channel_ids = [pickle.loads(k)[1] for k in keys]
+        if self.dst_stale:
+            keys = self.DST.keys(self.r)
+            seqs = [int(i) for i in self.DST.mget(self.r, keys)]
+            self.done_seqs = {pickle.loads(k) : seq for k, seq in zip(keys, seqs)}
+            self.dst_stale = False
+            self.dst_changed = True
+
+        if self.dst_changed and len(self.done_seqs) > 0:
+            self.dst = polars.from_dict({"source_actor_id": [k[0] for k in self.done_seqs], "source_channel_id": [k[1] for k in self.done_seqs], 
+                "done_seq": list(self.done_seqs.values())})
+        self.dst_changed = False
+    
+    def set_done(self, actor_id, channel_id, seq):
+        self.DST.set(self.r, pickle.dumps((actor_id, channel_id)), seq)
+        self.r.publish("quokka-done", pickle.dumps((actor_id, channel_id, seq)))
+    
+    def handle_event(self, message):
+        if message["channel"] == b"quokka-recovery":
+            self.recovery_requested = True
+        elif message["channel"] == b"quokka-done":
+            actor_id, channel_id, seq = pickle.loads(message["data"])
+            self.done_seqs[actor_id, channel_id] = seq
+            self.dst_changed = True
+            self.check_all = True
+        elif message["channel"] == b"quokka-cancel":
+            self.early_done.add(pickle.loads(message["data"]))
+            self.cancel_changed = True
+        # output announcements don't carry anything, they are only there to wake us up
+
+    def poll_events(self):
+        message = self.events.get_message()
+        while message is not None:
+            self.handle_event(message)
+            message = self.events.get_message()
+    
+    def wait_for_events(self):
+
+        # nothing we have can make progress right now, block until something happens that might change that.
+        # if nothing at all happens for a while we assume we missed something and read the DST again.
 
-        if len(seqs) > 0:
-            self.dst = polars.from_dict({"source_actor_id": actor_ids, "source_channel_id": channel_ids, "done_seq": seqs})
+        message = self.events.get_message(timeout = EVENT_WAIT_TIMEOUT)
+        if message is None:
+            self.dst_stale = True
+            self.cancel_stale = True
+            self.check_all = True
+        else:
+            self.handle_event(message)
+            self.poll_events()
+    
+    def refresh_tasks(self):
+        self.tasks = self.NTT.lrange(self.r, str(self.node_id), 0, -1)
+        self.check_all = True
+    
+    def get_tasks(self):
+        if self.tasks is None:
+            self.refresh_tasks()
+        return self.tasks
 
     
     def register_partition_function(self, source_actor_id, target_actor_id, number_target_channels, partition_function):
@@ -142,19 +311,122 @@ class TaskManager:
         else:
             self.target_count[source_actor_id] += number_target_channels
         
+        if source_actor_id not in self.target_channels:
+            self.target_channels[source_actor_id] = {target_actor_id: number_target_channels}
+        else:
+            self.target_channels[source_actor_id][target_actor_id] = number_target_channels
+        
+        return True
+    
+    def register_runtime_filter(self, source_actor_id, target_actor_id):
+        self.runtime_filters[source_actor_id, target_actor_id] = [None, 0]
         return True
+
+    def get_runtime_filter(self, source_actor_id, target_actor_id):
+        edge = (source_actor_id, target_actor_id)
+        if edge not in self.runtime_filters:
+            return None
+        runtime_filter, last_check = self.runtime_filters[edge]
+        if runtime_filter is None and time.time() - last_check > RUNTIME_FILTER_CHECK_INTERVAL:
+            self.runtime_filters[edge][1] = time.time()
+            channels = list(self.actor_flight_clients[target_actor_id].keys())
+            published = self.RFT.mget(self.r, [pickle.dumps((target_actor_id, channel)) for channel in channels])
+            if all(i is not None for i in published):
+                runtime_filter = pickle.loads(published[0])
+                for i in published[1:]:
+                    runtime_filter.merge(pickle.loads(i))
+                self.runtime_filters[edge][0] = runtime_filter.finalize()
+        return runtime_filter
+
+    def get_runtime_filter_stats(self):
+        # (source_actor_id, target_actor_id) -> rows dropped by the runtime filter on this machine
+        return {edge: self.runtime_filters[edge][0].pruned for edge in self.runtime_filters if self.runtime_filters[edge][0] is not None}
+
+    def set_configs(self, configs):
+        self.compression = configs.get("shuffle_compression", None)
+        self.edge_compression = {}
+        self.compression_stats = {}
+        return True
+    
+    def get_compression_stats(self):
+        return self.compression_stats
     
+    def choose_compression(self, source_actor_id, target_actor_id):
+
+        # returns the codec to push this edge's batches with, and if this push is a probe. 
+        # a probe measures the compression ratio, for "adaptive" it's also sent uncompressed to measure the link.
+
+        edge = (source_actor_id, target_actor_id)
+        if edge not in self.edge_compression:
+            self.edge_compression[edge] = {"codec": None if self.compression == "adaptive" else self.compression, "pushes": 0, "ratio": 1.0}
+        state = self.edge_compression[edge]
+        probe = self.compression is not None and state["pushes"] % COMPRESSION_PROBE_INTERVAL == 0
+        state["pushes"] += 1
+
+        if self.compression == "adaptive" and probe:
+            return None, True
+        return state["codec"], probe
+
+    def update_compression(self, source_actor_id, target_actor_id, batches, codec, probe, seconds):
+
+        # account the bytes of a finished push, and on probes measure the ratio and for "adaptive" pick the edge's codec:
+        # the one with the smallest compression time + compressed bytes / link throughput. The receiver's decompression is cheap and ignored.
+
+        edge = (source_actor_id, target_actor_id)
+        state = self.edge_compression[edge]
+        raw = sum(batch.nbytes for batch in batches)
+
+        # what went over the wire, if we know it
+        sent = raw if codec is None else None
+
+        if probe:
+            uncompressed = ipc_size(batches, None)
+            if self.compression == "adaptive":
+                throughput = uncompressed / max(seconds, 1e-6)
+                best_codec, best_time, best_ratio = None, uncompressed / throughput, 1.0
+                for candidate in ["lz4", "zstd"]:
+                    start = time.time()
+                    compressed = ipc_size(batches, candidate)
+                    estimate = time.time() - start + compressed / throughput
+                    if estimate < best_time:
+                        best_codec, best_time, best_ratio = candidate, estimate, compressed / uncompressed
+                state["codec"] = best_codec
+                state["ratio"] = best_ratio
+                print_if_profile("edge", edge, "link throughput", throughput, "picked", best_codec, "ratio", best_ratio)
+            else:
+                sent = ipc_size(batches, codec)
+                state["ratio"] = sent / uncompressed
+
+        if edge not in self.compression_stats:
+            self.compression_stats[edge] = [0, 0, 0]
+        self.compression_stats[edge][0] += raw
+        if sent is not None:
+            self.compression_stats[edge][1] += sent
+        else:
+            self.compression_stats[edge][2] += int(raw * state["ratio"])
+
     def register_mapping(self, actor_id, mapping):
         self.mappings[actor_id] = mapping
         return True
+
+    def register_ordering(self, actor_id, ordering):
+        self.orderings[actor_id] = ordering
+        return True
     
     def register_blocking(self, actor_id, transform_fn, dataset_object):
         self.blocking_nodes[actor_id] = (transform_fn, dataset_object)
         return True
     
     def check_in_recovery(self):
+        self.poll_events()
+        if not self.recovery_requested and time.time() - self.last_recovery_check < RECOVERY_CHECK_INTERVAL:
+            return
+        self.recovery_requested = False
+        self.last_recovery_check = time.time()
         if self.r.get("recovery-lock") == b'1':
             print("Recovery request detected, I am going to wait ", self.node_id)
+            # the coordinator plans recovery from what is committed, so forget about anything that's not.
+            self.abandon_pushes()
             self.r.sadd("waiting-workers",  self.node_id)
             while True:
                 time.sleep(0.01)
@@ -172,6 +444,11 @@ class TaskManager:
                             self.actor_flight_clients[actor][channel] = self.flight_clients[ip]
                         else:
                             self.actor_flight_clients[actor] = {channel : self.flight_clients[ip]}
+                    # channels might have moved, credits from the old servers are meaningless
+                    self.credits = {}
+                    # the coordinator rewrote the task lists and maybe the DST
+                    self.tasks = None
+                    self.dst_stale = True
                     break
             print("exitted recovery loop", self.node_id)
     
@@ -185,7 +462,8 @@ class TaskManager:
             raise Exception
     
     def set_flight_configs(self, client):
-        message = pyarrow.py_buffer(pickle.dumps({"mem_limit" : MEM_LIMIT, "max_batches" : MAX_BATCHES}))
+        message = pyarrow.py_buffer(pickle.dumps({"mem_limit" : MEM_LIMIT, "max_batches" : MAX_BATCHES, "cache_mem_bytes": CACHE_MEM_BYTES,
+            "consumer_quota_bytes": CONSUMER_QUOTA_BYTES, "global_quota_bytes": GLOBAL_QUOTA_BYTES}))
         action = pyarrow.flight.Action("set_configs", message)
         result = next(client.do_action(action))
         if result.body.to_pybytes().decode("utf-8") != "True":
@@ -207,6 +485,9 @@ class TaskManager:
 
             if target_mask is not None and target_actor_id not in target_mask:
                 continue
+            
+            if target_actor_id in self.cancelled:
+                continue
 
             partition_fn = partition_fns[target_actor_id]
             # this will be a dict of channel -> Polars DataFrame
@@ -216,7 +497,7 @@ class TaskManager:
             else:
 
                 start_part = time.time()
-                outputs = partition_fn(output, source_channel_id)
+                outputs = partition_fn(output, source_channel_id, self.get_runtime_filter(source_actor_id, target_actor_id))
                 print_if_profile("partitioner time", time.time() - start_part)
                 start_spill = time.time()
                 if FT:
@@ -228,12 +509,16 @@ class TaskManager:
             fake_row = outputs[list(outputs.keys())[0]][:0]
             expected_schema = outputs[list(outputs.keys())[0]].to_arrow().schema
 
-            for target_channel_id in self.actor_flight_clients[target_actor_id]:
+            # all the target channels that live on the same Flight server get pushed over one do_put stream
+            streams = {}
 
-                start = time.time()
+            for target_channel_id in self.actor_flight_clients[target_actor_id]:
 
                 if target_mask is not None and target_channel_id not in target_mask[target_actor_id]:
                     continue
+                
+                if (target_actor_id, target_channel_id) in self.early_done:
+                    continue
 
                 if target_channel_id in outputs and len(outputs[target_channel_id]) > 0:
                     data = outputs[target_channel_id]
@@ -249,42 +534,204 @@ class TaskManager:
                     # print(name, batches, fake_row.to_pandas())
 
                 assert len(batches) == 1, batches
-                # spin here until you can finally push it. If you die while spinning, well yourself will be recovered.
-                # this is fine since you don't have the recovery lock.
                 client = self.actor_flight_clients[target_actor_id][target_channel_id]
+                if client in streams:
+                    streams[client].append((target_channel_id, name, batches[0]))
+                else:
+                    streams[client] = [(target_channel_id, name, batches[0])]
+
+            codec, probe = self.choose_compression(source_actor_id, target_actor_id)
+            put_options = pyarrow.flight.FlightCallOptions(write_options = pyarrow.ipc.IpcWriteOptions(compression = codec))
+            # the batches that went over do_put and how long that took, for the compression stats
+            put_batches = []
+            put_time = 0
+
+            for client in streams:
+
+                start = time.time()
 
-                print_if_debug("pushing", source_actor_id, source_channel_id, seq, target_actor_id, target_channel_id, len(batches[0]))
+                print_if_debug("pushing", source_actor_id, source_channel_id, seq, target_actor_id, [k[0] for k in streams[client]])
 
                 try:
-                    if not self.check_puttable(client):
-                        return False
-                    upload_descriptor = pyarrow.flight.FlightDescriptor.for_command(pickle.dumps((True, name, my_format)))
-                    batch = batches[0]
-                    writer, _ = client.do_put(upload_descriptor, batch.schema)
-                    # print("Attempting to write ", batch.nbytes, "bytes")
-                    if batch.nbytes >= 2e9:
-                        for k in range(0, len(batch), len(batch)//10):
-                            writer.write_batch(batch[k : k + len(batch) // 10])
-                    else:
-                        writer.write_batch(batch)
-                    writer.close()
+                    # spin here until you can finally push it. If you die while spinning, well yourself will be recovered.
+                    # this is fine since you don't have the recovery lock.
+                    for target_channel_id, name, batch in streams[client]:
+                        if self.credits.get((target_actor_id, target_channel_id), 0) <= 0:
+                            if not self.check_puttable(client, target_actor_id, target_channel_id):
+                                return False
+                        # spend them as we go, the server's reply to the put sets them to what it really has left
+                        self.credits[(target_actor_id, target_channel_id)] -= batch.nbytes
+
+                    # if the server is on this machine try to hand the objects over through shared memory first
+                    shm_pushed = SHM_DIR is not None and client is self.local_flight_client and self.push_shm(client, streams[client], my_format)
+                    if not shm_pushed:
+                        put_start = time.time()
+                        upload_descriptor = pyarrow.flight.FlightDescriptor.for_command(pickle.dumps((True, None, my_format)))
+                        writer, metadata_reader = client.do_put(upload_descriptor, streams[client][0][2].schema, options = put_options)
+                        for target_channel_id, name, batch in streams[client]:
+                            metadata = pyarrow.py_buffer(pickle.dumps(name))
+                            # print("Attempting to write ", batch.nbytes, "bytes")
+                            if batch.nbytes >= 2e9:
+                                for k in range(0, len(batch), len(batch)//10):
+                                    writer.write_with_metadata(batch[k : k + len(batch) // 10], metadata)
+                            else:
+                                writer.write_with_metadata(batch, metadata)
+                        writer.done_writing()
+                        # the server replies with how many more bytes it will take for each of these target channels
+                        self.credits.update(pickle.loads(metadata_reader.read().to_pybytes()))
+                        writer.close()
+                        put_batches.extend([k[2] for k in streams[client]])
+                        put_time += time.time() - put_start
 
                 except pyarrow._flight.FlightUnavailableError:
                     # failed to push to cache, probably because downstream node failed. update actor_flight_clients
                     print("downstream unavailable")
                     return False
                 
-                print_if_debug("finished pushing", source_actor_id, source_channel_id, seq, target_actor_id, target_channel_id, len(batches[0]))
+                print_if_debug("finished pushing", source_actor_id, source_channel_id, seq, target_actor_id, [k[0] for k in streams[client]])
 
-                print_if_profile("pushing to one channel time", time.time() - start)
+                print_if_profile("pushing to one server time", time.time() - start)
+            
+            if len(put_batches) > 0:
+                self.update_compression(source_actor_id, target_actor_id, put_batches, codec, probe, put_time)
 
         print_if_profile("push time", time.time() - start_push)
         return True
+    
+    def push_shm(self, client, objects, my_format):
+
+        # the Flight server is on this machine, so write the (target_channel_id, name, batch) objects to shared memory and only send the file names.
+        # returns False if that didn't work out, e.g. /dev/shm is full, and the caller should push with do_put instead.
+        # the file names are unique, so a push of the same name during recovery can't clobber a file the server is about to delete.
+
+        handles = []
+        try:
+            os.makedirs(SHM_DIR, exist_ok = True)
+            for target_channel_id, name, batch in objects:
+                filename = SHM_DIR + "-".join(str(i) for i in name) + "-" + uuid.uuid4().hex + ".arrow"
+                handles.append((name, filename, batch.nbytes))
+                writer = pyarrow.ipc.new_file(filename, batch.schema)
+                writer.write_batch(batch)
+                writer.close()
+        except OSError:
+            print_if_debug("shared memory push failed, falling back to do_put")
+            for name, filename, nbytes in handles:
+                if os.path.exists(filename):
+                    os.remove(filename)
+            return False
+
+        action = pyarrow.flight.Action("put_shm", pyarrow.py_buffer(pickle.dumps((my_format, handles))))
+        result = next(client.do_action(action))
+        self.credits.update(pickle.loads(result.body.to_pybytes()))
+        return True
         
     
+    def submit_push(self, push_fn, commit_fn):
+
+        # push_fn runs on the sender thread and returns if the push succeeded. push_fn can be None if there is nothing to push.
+        # commit_fn runs on the main thread in drain_pushes after the push succeeded.
+
+        if push_fn is None:
+            future = concurrent.futures.Future()
+            future.set_result(True)
+        else:
+            future = self.sender.submit(push_fn)
+        self.pending_pushes.append((future, commit_fn))
+    
+    def drain_pushes(self, max_pending = 0):
+
+        # commit finished pushes in order, waiting until at most max_pending are left. 
+        # returns False if a push failed, in which case everything after it is thrown away uncommitted, like a synchronous push failure.
+
+        while len(self.pending_pushes) > 0:
+            future, commit_fn = self.pending_pushes[0]
+            if len(self.pending_pushes) <= max_pending and not future.done():
+                break
+            if not future.result():
+                print("push failed!")
+                self.abandon_pushes()
+                return False
+            self.pending_pushes.popleft()
+            commit_fn()
+        return True
+    
+    def abandon_pushes(self):
+        for future, commit_fn in self.pending_pushes:
+            future.result()
+        self.pending_pushes.clear()
+        # our task list ran ahead of the NTT with tasks that are now never going to be committed
+        self.tasks = None
+
     def execute(self):
         raise NotImplementedError
 
+    def update_cancelled(self):
+
+        # an actor is cancelled once every channel of every actor it pushes to finished early or is cancelled itself, i.e. nobody needs its outputs anymore.
+        # this goes all the way upstream from the channels in the EDT, e.g. a limit that has its rows cancels the scan feeding it. 
+        # returns True if anything changed since the last time.
+
+        if self.cancel_stale:
+            early_done = set(self.EDT.to_dict(self.r).keys())
+            if early_done != self.early_done:
+                self.early_done = early_done
+                self.cancel_changed = True
+            self.cancel_stale = False
+        
+        if not self.cancel_changed:
+            return False
+        self.cancel_changed = False
+
+        cancelled = set(self.cancelled)
+        changed = True
+        while changed:
+            changed = False
+            for source_actor_id, targets in self.target_channels.items():
+                if source_actor_id in cancelled:
+                    continue
+                if all(target_actor_id in cancelled or all((target_actor_id, channel_id) in self.early_done for channel_id in range(num_channels)) 
+                        for target_actor_id, num_channels in targets.items()):
+                    cancelled.add(source_actor_id)
+                    changed = True
+        
+        self.cancelled = cancelled
+        return True
+
+    def drop_cancelled_tasks(self):
+
+        # drop our tasks for cancelled actors as if they finished. An exec channel is done at the last output it committed, so whoever still 
+        # reads from it stops waiting. Input channels already have their done seq from the start. 
+        # Then have the local Flight server throw away everything queued for cancelled consumers.
+
+        if not self.drain_pushes(0):
+            # recovery is going to happen, try again after
+            self.cancel_changed = True
+            return
+
+        transaction = self.r.pipeline()
+        finished = []
+        for task in self.get_tasks():
+            task_type, tup = pickle.loads(task)
+            actor_id, channel_id = tup[0], tup[1]
+            if actor_id not in self.cancelled:
+                continue
+            print_if_debug("cancelling", task_type, actor_id, channel_id)
+            self.NTT.lrem(transaction, str(self.node_id), 1, task)
+            if task_type == "exec" or task_type == "exectape":
+                finished.append((actor_id, channel_id, tup[3] - 1))
+            if (actor_id, channel_id) in self.function_objects:
+                del self.function_objects[actor_id, channel_id]
+        transaction.execute()
+        
+        for actor_id, channel_id, seq in finished:
+            self.set_done(actor_id, channel_id, seq)
+        self.tasks = None
+
+        message = pyarrow.py_buffer(pickle.dumps((self.cancelled, self.early_done)))
+        action = pyarrow.flight.Action("cancel", message)
+        result = next(self.flight_client.do_action(action))
+        assert result.body.to_pybytes().decode("utf-8") == "True"
+
     #The task node periodically will run a garbage collection process for its local cache as well as its HBQ. 
     # this can be run every X iterations in the main loop
     def garbage_collect(self):
@@ -318,6 +765,15 @@ class TaskManager:
             # most likely it got done from all its input sources
             self.NTT.lrem(transaction, str(self.node_id), 1, candidate_task.reduce())
         
+        # same thing on our copy of the task list
+        if self.tasks is not None:
+            if candidate_task.reduce() in self.tasks:
+                self.tasks.remove(candidate_task.reduce())
+                if next_task is not None:
+                    self.tasks.append(next_task.reduce())
+            else:
+                self.tasks = None
+        
 
 @ray.remote
 class ExecTaskManager(TaskManager):
@@ -334,13 +790,18 @@ class ExecTaskManager(TaskManager):
             bucket.objects.all().delete()
 
         self.tape_input_reqs = {}
+
+        # see pick_task
+        self.task_channels = {}
+        self.checked = set()
     
-    def check_puttable(self, client):
-        buf = pyarrow.allocate_buffer(0)
+    def check_puttable(self, client, target_actor_id, target_channel_id):
+        buf = pyarrow.py_buffer(pickle.dumps((target_actor_id, target_channel_id)))
         action = pyarrow.flight.Action("check_puttable", buf)
         result = next(client.do_action(action))
-        #print(result.body.to_pybytes().decode("utf-8"))
-        if result.body.to_pybytes().decode("utf-8") != "True":
+        # the server tells us how many bytes it will still take for this target channel
+        self.credits[(target_actor_id, target_channel_id)] = int(result.body.to_pybytes().decode("utf-8"))
+        if self.credits[(target_actor_id, target_channel_id)] <= 0:
             print("BACKPRESSURING!")
             return False
         else:
@@ -356,8 +817,9 @@ class ExecTaskManager(TaskManager):
             # this probably doesn't have to be done transactionally, but why not.
 
             self.LT.set(transaction, name_prefix, lineage)
-        else:
-            pass
+        
+        # wake up the consumers, they might have been waiting on this
+        transaction.publish("quokka-output-" + str(actor_id), b"")
     
     def state_commit(self, transaction, actor_id, channel_id, state_seq, lineage):
 
@@ -368,6 +830,16 @@ class ExecTaskManager(TaskManager):
         else:
             pass
 
+    def push_output(self, actor_id, channel_id, out_seq, data):
+        if actor_id not in self.blocking_nodes:
+            return self.push(actor_id, channel_id, out_seq, data)
+        else:
+            transform_fn, dataset = self.blocking_nodes[actor_id]
+            if transform_fn is not None:
+                data = transform_fn(data)
+            ray.get(dataset.added_object.remote(channel_id, [ray.put(data.to_arrow(), _owner = dataset)]))
+            return True
+
     def process_output(self, actor_id, channel_id, output, transaction, state_seq, out_seq):
         if output is not None:
             assert type(output) == polars.internals.DataFrame or type(output) == types.GeneratorType
@@ -375,48 +847,59 @@ class ExecTaskManager(TaskManager):
                 output = [output]
             
             for data in output:
-                if actor_id not in self.blocking_nodes:
-                    pushed = self.push(actor_id, channel_id, out_seq, data)
-                    if not pushed:
-                        # you failed to push downstream, most likely due to node failure. wait a bit for coordinator recovery and continue, most like will be choked on barrier.
-                        time.sleep(0.2)
-                        return -1
-                else:
-                    transform_fn, dataset = self.blocking_nodes[actor_id]
-                    if transform_fn is not None:
-                        data = transform_fn(data)
-                    ray.get(dataset.added_object.remote(channel_id, [ray.put(data.to_arrow(), _owner = dataset)]))
+                pushed = self.push_output(actor_id, channel_id, out_seq, data)
+                if not pushed:
+                    # you failed to push downstream, most likely due to node failure. wait a bit for coordinator recovery and continue, most like will be choked on barrier.
+                    time.sleep(0.2)
+                    return -1
                 self.output_commit(transaction, actor_id, channel_id, out_seq, state_seq)
 
                 out_seq += 1
         return out_seq
+    
+    def prepare_output(self, actor_id, channel_id, output, transaction, state_seq, out_seq):
+
+        # like process_output, but hands back the push for the sender thread instead of doing it. returns (push function or None, out_seq)
+        
+        if output is None:
+            return None, out_seq
+        elif type(output) == polars.internals.DataFrame:
+            self.output_commit(transaction, actor_id, channel_id, out_seq, state_seq)
+            return partial(self.push_output, actor_id, channel_id, out_seq, output), out_seq + 1
+        else:
+            # a generator could still be reading executor state that the next task will change, so it has to be pushed out here.
+            if not self.drain_pushes(0):
+                time.sleep(0.2)
+                return None, -1
+            return None, self.process_output(actor_id, channel_id, output, transaction, state_seq, out_seq)
 
     def execute(self):
 
         pyarrow.set_cpu_count(8)
-        count = -1
-        self.index = 0
+        # tasks that had input queued but still got nothing from do_get, e.g. because it's not committed upstream yet. cleared when anything makes progress.
+        self.tried = set()
         while True:
 
             self.check_in_recovery()
 
-            count += 1
-            length = self.NTT.llen(self.r, str(self.node_id))
-            if length == 0:
+            if self.update_cancelled():
+                self.drop_cancelled_tasks()
+
+            if not self.drain_pushes(PUSH_QUEUE_DEPTH - 1):
+                # downstream failure detected, wait for coordinator recovery.
+                time.sleep(0.2)
+                continue
+
+            candidate_task = self.pick_task(self.get_tasks())
+            if candidate_task is None:
+                # none of our tasks can go. get our outputs committed and wait for something to happen.
+                if not self.drain_pushes(0):
+                    time.sleep(0.2)
+                    continue
+                self.wait_for_events()
+                self.tried.clear()
                 continue
 
-            candidate_tasks = self.NTT.lrange(self.r, str(self.node_id), 0, -1)
-            # exec_tape_task = False
-            # for candidate_task in candidate_tasks:
-            #     task_type, tup = pickle.loads(candidate_task)
-            #     # prioritize recovery tasks
-            #     if task_type == "exectape":
-            #         exec_tape_task = True
-            #         break
-            # if not exec_tape_task:
-            if count > length - 1:
-                count = count % length
-            candidate_task = candidate_tasks[count]
             task_type, tup = pickle.loads(candidate_task)
         
             if task_type == "input" or task_type == "inputtape" or task_type == "replay":
@@ -455,7 +938,17 @@ class ExecTaskManager(TaskManager):
                 input_names = []
                 if len(input_requirements) > 0:
 
-                    request = ("cache", actor_id, channel_id, input_requirements, False)
+                    # gate the sources that come after one still being drained. they stay in input_requirements for the next task.
+                    request_requirements = input_requirements
+                    if actor_id in self.orderings:
+                        remaining_source_actor_ids = set(input_requirements["source_actor_id"].unique().to_list())
+                        ordering = self.orderings[actor_id]
+                        for i in range(len(ordering)):
+                            if ordering[i] in remaining_source_actor_ids:
+                                request_requirements = input_requirements.filter(~polars.col("source_actor_id").is_in(ordering[i + 1:]))
+                                break
+
+                    request = ("cache", actor_id, channel_id, request_requirements, False)
 
                     # if we can bake logic inside the the flight server we probably should, because that will be baked into C++ at some point.
 
@@ -463,22 +956,7 @@ class ExecTaskManager(TaskManager):
 
                     # we are going to assume the Flight server gives us results sorted by source_actor_id
                     
-                    chunks_list = []
-                    names = []
-                    while True:
-                        try:
-                            chunk, metadata = reader.read_chunk()
-                            name, format = pickle.loads(metadata)
-                            assert format == "polars"
-                            if len(names) == 0 or name != names[-1]:
-                                chunks_list.append([chunk])
-                                names.append(name)
-                            else:
-                                chunks_list[-1].append(chunk)
-                                print("creating multi-chunk")
-
-                        except StopIteration:
-                            break
+                    names, chunks_list = read_flight_chunks(reader)
 
                     batches = []
                     source_actor_ids = set()
@@ -507,7 +985,7 @@ class ExecTaskManager(TaskManager):
                         batches.append(chunks)
                     
                     if len(batches) == 0:
-                        self.index += 1
+                        self.tried.add(candidate_task.reduce())
                         continue
 
                     assert len(source_actor_ids) == 1
@@ -527,6 +1005,11 @@ class ExecTaskManager(TaskManager):
                         remaining_sources = set([self.mappings[actor_id][source_actor_id] for source_actor_id in remaining_source_actor_ids])
                         self.function_objects[actor_id, channel_id].update_sources(remaining_sources)
 
+                    if hasattr(self.function_objects[actor_id, channel_id], 'runtime_filter'):
+                        runtime_filter = self.function_objects[actor_id, channel_id].runtime_filter()
+                        if runtime_filter is not None:
+                            self.RFT.set(self.r, pickle.dumps((actor_id, channel_id)), pickle.dumps(runtime_filter))
+
                     print_if_profile("execute time", time.time() - start)
 
                     source_channel_ids = [i for i in source_channel_seqs]
@@ -542,21 +1025,28 @@ class ExecTaskManager(TaskManager):
                     print_if_debug(new_input_reqs)
                     new_input_reqs = new_input_reqs.drop("progress")
 
-                    out_seq = self.process_output(actor_id, channel_id, output, transaction, state_seq, out_seq)
+                    push_fn, out_seq = self.prepare_output(actor_id, channel_id, output, transaction, state_seq, out_seq)
                     if out_seq == -1:
                         continue
+
+                    if getattr(self.function_objects[actor_id, channel_id], 'done_early', False):
+                        # the executor doesn't need the rest of its input. The next task has nothing left to read so it calls done,
+                        # and everyone learns from the EDT that nothing more has to be sent here.
+                        new_input_reqs = new_input_reqs.head(0)
+                        self.EDT.set(transaction, pickle.dumps((actor_id, channel_id)), state_seq)
+                        transaction.publish("quokka-cancel", pickle.dumps((actor_id, channel_id)))
+                        self.check_all = True
                         
                     next_task = ExecutorTask(actor_id, channel_id, state_seq + 1, out_seq, new_input_reqs)
+                    last_output_seq = None
 
                 else:
                     output = self.function_objects[actor_id, channel_id].done(channel_id)
 
-                    out_seq = self.process_output(actor_id, channel_id, output, transaction, state_seq, out_seq)
+                    push_fn, out_seq = self.prepare_output(actor_id, channel_id, output, transaction, state_seq, out_seq)
                     if out_seq == -1:
                         continue
                     last_output_seq = out_seq - 1
-                    # print("DONE", actor_id, channel_id)
-                    self.DST.set(self.r, pickle.dumps((actor_id, channel_id)), last_output_seq)
                             
                     next_task = None
 
@@ -574,16 +1064,25 @@ class ExecTaskManager(TaskManager):
                 lineage = pickle.dumps((source_actor_id, source_channel_seqs))
                 self.state_commit(transaction, actor_id, channel_id, state_seq, lineage)
                 self.task_commit(transaction, candidate_task, next_task)
-                
-                executed = transaction.execute()
-                #if not all(executed):
-                #    raise Exception(executed)
-                
-                if len(input_names) > 0:
-                    message = pyarrow.py_buffer(pickle.dumps(input_names))
-                    action = pyarrow.flight.Action("cache_garbage_collect", message)
-                    result = next(self.flight_client.do_action(action))
-                    assert result.body.to_pybytes().decode("utf-8") == "True"
+
+                def commit(actor_id, channel_id, transaction, last_output_seq, input_names):
+                    if last_output_seq is not None:
+                        # print("DONE", actor_id, channel_id)
+                        self.set_done(actor_id, channel_id, last_output_seq)
+
+                    executed = transaction.execute()
+                    #if not all(executed):
+                    #    raise Exception(executed)
+                    
+                    if len(input_names) > 0:
+                        message = pyarrow.py_buffer(pickle.dumps(input_names))
+                        action = pyarrow.flight.Action("cache_garbage_collect", message)
+                        result = next(self.flight_client.do_action(action))
+                        assert result.body.to_pybytes().decode("utf-8") == "True"
+
+                # the output goes out on the sender thread while we work on the next task, the transaction is only executed once it's acknowledged.
+                self.submit_push(push_fn, partial(commit, actor_id, channel_id, transaction, last_output_seq, input_names))
+                self.tried.clear()
             
             elif task_type == "exectape":
                 candidate_task = TapedExecutorTask.from_tuple(tup)
@@ -611,29 +1110,14 @@ class ExecTaskManager(TaskManager):
                 request = ("cache", actor_id, channel_id, input_requirements, True)
                 reader = self.flight_client.do_get(pyarrow.flight.Ticket(pickle.dumps(request)))
 
-                chunks_list = []
-                names = []
-                while True:
-                    try:
-                        chunk, metadata = reader.read_chunk()
-                        name, format = pickle.loads(metadata)
-                        assert format == "polars"
-                        if len(names) == 0 or name != names[-1]:
-                            chunks_list.append([chunk])
-                            names.append(name)
-                        else:
-                            chunks_list[-1].append(chunk)
-                            print("creating multi-chunk")
-
-                    except StopIteration:
-                        break
+                names, chunks_list = read_flight_chunks(reader)
 
                 # we are going to assume the Flight server gives us results sorted by source_actor_id
                 batches = chunks_list
                 input_names = names
 
                 if len(batches) == 0:
-                    self.index += 1
+                    self.tried.add(candidate_task.reduce())
                     continue
 
                 source_actor_id, source_channel_seqs = pickle.loads(input_requirements)
@@ -680,6 +1164,49 @@ class ExecTaskManager(TaskManager):
                 action = pyarrow.flight.Action("cache_garbage_collect", message)
                 result = next(self.flight_client.do_action(action))
                 assert result.body.to_pybytes().decode("utf-8") == "True"
+                self.tried.clear()
+    
+    def pick_task(self, candidate_tasks):
+
+        # ask the local Flight server which of our channels have input queued and run the best of those, per TASK_SELECTION.
+        # channels without queued input can only have something to do if a channel they read from finished or during recovery, 
+        # so we only go through those, once each, when check_all says so. returns None if there is nothing worth running.
+
+        if len(candidate_tasks) == 0:
+            return None
+
+        # remember which channel each task is for, so we don't unpickle every task on every pick
+        self.task_channels = {task: self.task_channels[task] if task in self.task_channels else tuple(pickle.loads(task)[1][:2]) for task in candidate_tasks}
+
+        result = next(self.flight_client.do_action(pyarrow.flight.Action("get_ready_channels", pyarrow.py_buffer(b''))))
+        ready = pickle.loads(result.body.to_pybytes())
+
+        ready_tasks = [task for task in candidate_tasks if self.task_channels[task] in ready and task not in self.tried]
+        if len(ready_tasks) > 0:
+            if TASK_SELECTION == "oldest":
+                return min(ready_tasks, key = lambda task: ready[self.task_channels[task]][1])
+            else:
+                return max(ready_tasks, key = lambda task: ready[self.task_channels[task]][0])
+        
+        if self.check_all:
+            unchecked = [task for task in candidate_tasks if self.task_channels[task] not in ready and task not in self.checked]
+            if len(unchecked) > 0:
+                self.checked.add(unchecked[0])
+                return unchecked[0]
+            self.check_all = False
+            self.checked.clear()
+
+        return None
+
+    def refresh_tasks(self):
+        super().refresh_tasks()
+        # listen for outputs of everything our tasks read from
+        sources = set()
+        for task in self.tasks:
+            task_type, tup = pickle.loads(task)
+            sources.update(self.mappings[tup[0]].keys())
+        if len(sources) > 0:
+            self.events.subscribe(*["quokka-output-" + str(source_actor_id) for source_actor_id in sources])
 
 
 @ray.remote
@@ -691,14 +1218,14 @@ class IOTaskManager(TaskManager):
 
     # while the exectaskmanager should error out and proceed with the next task 
     # if check puttable is not true to relieve pressure on itself, inputs should just be held up.
-    def check_puttable(self, client):
+    def check_puttable(self, client, target_actor_id, target_channel_id):
         delayed = False
         while True:
-            buf = pyarrow.allocate_buffer(0)
+            buf = pyarrow.py_buffer(pickle.dumps((target_actor_id, target_channel_id)))
             action = pyarrow.flight.Action("check_puttable", buf)
             result = next(client.do_action(action))
-            #print(result.body.to_pybytes().decode("utf-8"))
-            if result.body.to_pybytes().decode("utf-8") != "True":
+            self.credits[(target_actor_id, target_channel_id)] = int(result.body.to_pybytes().decode("utf-8"))
+            if self.credits[(target_actor_id, target_channel_id)] <= 0:
                 print("BACKPRESSURING!")
                 # be nice
                 if not delayed:
@@ -722,6 +1249,9 @@ class IOTaskManager(TaskManager):
             if lineage is not None:
                 self.LT.set(transaction, name_prefix, lineage)
             self.GIT.sadd(transaction, pickle.dumps((actor_id, channel_id)), out_seq)
+        
+        # wake up the consumers, they might have been waiting on this
+        transaction.publish("quokka-output-" + str(actor_id), b"")
 
     def execute(self):
         """
@@ -732,17 +1262,27 @@ class IOTaskManager(TaskManager):
         pyarrow.set_cpu_count(8)
         count = -1
         while True:
-            time.sleep(self.delay)
-            if self.delay - 0.1 > 0.1:
-                self.delay -= 0.1
+            # no sleep here, an idle loop blocks in wait_for_events and backpressure sleeps in check_puttable
             self.check_in_recovery()
 
             count += 1
-            length = self.NTT.llen(self.r, str(self.node_id))
-            if length == 0:
+
+            if self.update_cancelled():
+                self.drop_cancelled_tasks()
+
+            if not self.drain_pushes(PUSH_QUEUE_DEPTH - 1):
+                # downstream failure detected, will start recovery soon, DO NOT COMMIT!
+                # sleep for 0.2 seconds, since recovery happens every 0.1 seconds
+                time.sleep(0.2)
+                continue
+
+            candidate_tasks = self.get_tasks()
+            if len(candidate_tasks) == 0:
+                # nothing left to read, unless recovery gives us something
+                if self.drain_pushes(0):
+                    self.wait_for_events()
                 continue 
 
-            candidate_tasks = self.NTT.lrange(self.r, str(self.node_id), 0, -1)
             candidate_task = random.sample(candidate_tasks,1 )[0]
             task_type, tup = pickle.loads(candidate_task)
 
@@ -756,16 +1296,18 @@ class IOTaskManager(TaskManager):
                     self.function_objects[actor_id, channel_id] = ray.cloudpickle.loads(self.FOT.get(self.r, actor_id))
 
                 functionObject = self.function_objects[actor_id, channel_id]
+
+                # a reader that only feeds a join can skip what the join's runtime filter rules out, e.g. Parquet row groups
+                if hasattr(functionObject, 'set_runtime_filter') and len(self.partition_fns[actor_id]) == 1:
+                    runtime_filter = self.get_runtime_filter(actor_id, list(self.partition_fns[actor_id].keys())[0])
+                    if runtime_filter is not None:
+                        functionObject.set_runtime_filter(runtime_filter)
                 
                 start = time.time()
 
                 next_task, output, seq, lineage = candidate_task.execute(functionObject)
 
                 print_if_profile("read time", time.time() - start)
-
-                if next_task is None:
-                    # print("DONE", actor_id, channel_id)
-                    self.DST.set(self.r, pickle.dumps((actor_id, channel_id)), seq)
             
             elif task_type == "inputtape":
                 candidate_task = TapedInputTask.from_tuple(tup)
@@ -789,22 +1331,25 @@ class IOTaskManager(TaskManager):
             else:
                 raise Exception("unsupported task type", task_type)       
 
-            pushed = self.push(actor_id, channel_id, seq, output)
+            transaction = self.r.pipeline()
+            self.output_commit(transaction, actor_id, channel_id, seq, lineage)
+            self.task_commit(transaction, candidate_task, next_task)
 
-            if pushed:
-                transaction = self.r.pipeline()
-                self.output_commit(transaction, actor_id, channel_id, seq, lineage)
-                self.task_commit(transaction, candidate_task, next_task)
+            def commit(actor_id, channel_id, seq, transaction, done):
+                if done:
+                    # print("DONE", actor_id, channel_id)
+                    self.set_done(actor_id, channel_id, seq)
                 if not all(transaction.execute()):
                    print("COMMITING TRANSACTION FAILED")
                    # raise Exception
-            
-            # downstream failure detected, will start recovery soon, DO NOT COMMIT!
-            else:
-                print("push failed!")
-                # sleep for 0.2 seconds, since recovery happens every 0.1 seconds
-                time.sleep(0.2)
-                continue
+
+            # the push happens on the sender thread while we go read the next batch. We only commit once it's acknowledged.
+            self.submit_push(partial(self.push, actor_id, channel_id, seq, output), 
+                partial(commit, actor_id, channel_id, seq, transaction, task_type == "input" and next_task is None))
+
+            # a task went through, so back off less the next time we are backpressured
+            if self.delay - 0.1 > 0.1:
+                self.delay -= 0.1
 
 @ray.remote
 class ReplayTaskManager(TaskManager):
@@ -843,11 +1388,13 @@ class ReplayTaskManager(TaskManager):
             self.check_in_recovery()
 
             count += 1
-            length = self.NTT.llen(self.r, str(self.node_id))
-            if length == 0:
+            candidate_tasks = self.get_tasks()
+            if len(candidate_tasks) == 0:
+                # replay tasks only come from recovery
+                self.wait_for_events()
                 continue 
 
-            candidate_task = self.NTT.lindex(self.r, str(self.node_id), 0)
+            candidate_task = candidate_tasks[0]
             task_type, tup = pickle.loads(candidate_task)
             assert task_type == "replay"
             
@@ -857,7 +1404,11 @@ class ReplayTaskManager(TaskManager):
             
             replayed = self.replay(candidate_task.actor_id, candidate_task.channel_id, candidate_task.replay_specification)
             if replayed:
-                self.NTT.lrem(self.r, str(self.node_id), 1, candidate_task.reduce())
+                transaction = self.r.pipeline()
+                self.task_commit(transaction, candidate_task, None)
+                # the consumers might be waiting on the replayed outputs
+                transaction.publish("quokka-output-" + str(candidate_task.actor_id), b"")
+                transaction.execute()
             else:
                 print("replay failed!")
                 time.sleep(0.2)
\ No newline at end of file
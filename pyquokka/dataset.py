@@ -45,6 +45,11 @@ class InputEC2ParquetDataset:
         self.s3 = None
         self.iterator = None
         self.count = 0
+        # set by the runtime if we only feed a join whose build side is done, see RuntimeFilter
+        self.runtime_filter = None
+
+    def set_runtime_filter(self, runtime_filter):
+        self.runtime_filter = runtime_filter
 
     def get_own_state(self, num_channels):
         self.num_channels = num_channels
@@ -77,6 +82,14 @@ class InputEC2ParquetDataset:
         def download(file):
             with warnings.catch_warnings():
                 warnings.simplefilter("ignore")
+                if self.runtime_filter is not None and self.filters is None:
+                    # only read the row groups whose key range overlaps the join's build side
+                    parquet_file = pq.ParquetFile(self.s3.open_input_file(self.bucket + "/" + file))
+                    row_groups = self.runtime_filter.row_groups(parquet_file.metadata)
+                    if len(row_groups) == 0:
+                        table = parquet_file.schema_arrow.empty_table()
+                        return polars.from_arrow(table.select(self.columns) if self.columns is not None else table)
+                    return polars.from_arrow(parquet_file.read_row_groups(row_groups, columns=self.columns, use_threads= False))
                 return polars.from_arrow(pq.read_table(self.bucket + "/" +file, columns=self.columns, filters=self.filters, use_threads= False, use_legacy_dataset = True, filesystem = self.s3))
 
         assert self.num_channels is not None
@@ -156,7 +169,8 @@ class InputSortedEC2ParquetDataset:
         channel_bounds = {}
         for channel in range(num_channels):
             channel_infos[channel] = fragments[channel * fragments_per_channel : channel * fragments_per_channel + fragments_per_channel]
-            channel_bounds[channel] = (channel_infos[channel][0][1], channel_infos[channel][-1][-1])
+            # with fewer files than channels the last channels get nothing, and have no bounds
+            channel_bounds[channel] = (channel_infos[channel][0][1], channel_infos[channel][-1][-1]) if len(channel_infos[channel]) > 0 else None
 
         self.bounds = channel_infos
         return channel_bounds
@@ -253,6 +267,8 @@ class InputEC2CoPartitionedSortedParquetDataset:
 
             # find which channel you belong. This is inclusive interval intersection.
             for channel in channel_bounds:
+                if channel_bounds[channel] is None:
+                    continue
                 if overlap([min_timestamp, max_timestamp], channel_bounds[channel]) >= 0:
                     channel_infos[channel].append((fragment.path, min_timestamp, max_timestamp))
             
@@ -7,6 +7,17 @@ from pyquokka.quokka_runtime import *
 from pyquokka.utils import EC2Cluster, LocalCluster
 from functools import partial
 import pyarrow as pa
+import pyarrow.parquet as pq
+import numpy as np
+import os
+from pyquokka.sketches import KLLSketch, HyperLogLog, hash_keys
+
+# groupbys estimated to make fewer groups than this are aggregated on a single channel, otherwise they are hash partitioned on the group keys.
+PARALLEL_AGG_MIN_GROUPS = 100000
+# the splitters of a sort are picked from a sample of this many rows of the sort keys per channel
+SORT_SAMPLE_ROWS_PER_CHANNEL = 10000
+# taken from the first this many rows every channel reads, the rest of the input isn't read for the sample
+SORT_SAMPLE_READ_ROWS_PER_CHANNEL = 1000000
 
 
 class DataStream:
@@ -611,7 +622,7 @@ class DataStream:
             ordering=None
         )
     
-    def distinct(self, key: str):
+    def distinct(self, keys, exact = False):
 
         """
         Return a new DataStream with specified columns and unique rows. This is like `SELECT DISTINCT(KEYS) FROM ...` in SQL.
@@ -622,8 +633,13 @@ class DataStream:
         This could be accomplished by using `groupby().agg()` but using `distinct` is generally faster because it is nonblocking, 
         compared to a groupby. Quokka really likes nonblocking operations because it can then pipeline it with other operators.
 
+        The keys seen so far are kept as 128 bit fingerprints, or as themselves for a single integer column, so memory doesn't grow 
+        with how wide the keys are. When they outgrow memory, part of them are spilled to local disk, and the new rows with those keys
+        come out at the end.
+
         Args:
-            keys (list): a list of columns to select distinct on.
+            keys (str or list): a column or a list of columns to select distinct on.
+            exact (bool): also keep the keys themselves and check them, instead of trusting fingerprints. Defaults to False.
 
         Return:
             A transformed DataStream whose columns are in keys and whose rows are unique.
@@ -640,26 +656,197 @@ class DataStream:
             ~~~
         """
 
-        assert type(key) == str
-        assert key in self.schema
+        if type(keys) == str:
+            keys = [keys]
+        for key in keys:
+            assert key in self.schema, "distinct key not found in DataStream"
 
-        select_stream = self.select([key])
+        select_stream = self.select(keys)
 
         return self.quokka_context.new_stream(
             sources={0: select_stream},
-            partitioners={0: HashPartitioner(key)},
+            partitioners={0: HashPartitioner(keys)},
             node=StatefulNode(
-                schema=[key],
+                schema=keys,
                 # this is a stateful node, but predicates and projections can be pushed down.
-                schema_mapping={col: (0, col) for col in [key]},
-                required_columns={0: set([key])},
-                operator=DistinctExecutor([key])
+                schema_mapping={col: (0, col) for col in keys},
+                required_columns={0: set(keys)},
+                operator=DistinctExecutor(keys, exact = exact)
             ),
-            schema=[key],
+            schema=keys,
             ordering=None
         )
 
-    def join(self, right, on=None, left_on=None, right_on=None, suffix="_2", how="inner"):
+    def sort(self, keys):
+
+        """
+        Sort the DataStream on a column or a list of columns, in ascending order. Null keys come first.
+
+        If the DataStream reads straight from a file source, with only filters, projections and maps in between, calling sort() right away
+        runs a quick job that samples the sort keys to pick splitters, so every exec channel gets a range of keys of about the same size.
+        It only reads the first rows of every input channel, so the ranges are about even if those look like the rest. Then every row goes 
+        to the channel of its range, and each channel does an external sort of its range on local disk. Channel i only has keys that are 
+        no bigger than the keys of channel i + 1, so the channels are globally ordered. 
+        
+        Anything else, e.g. the result of a join, would have to be computed once for the sample and again for the sort, so it's sorted on 
+        a single channel instead. If that's too slow, write it out and sort what you read back. Either way this is a blocking operation for 
+        each channel.
+
+        Args:
+            keys (str or list): the column or columns to sort on. Lists are sorted lexicographically.
+
+        Return:
+            A sorted DataStream with the same schema.
+
+        Examples:
+            ~~~python
+            >>> lineitem = qc.read_parquet("s3://tpc-h-parquet/lineitem/*")
+
+            # every exec channel writes out Parquets of a contiguous range of l_orderkey, in order
+            >>> lineitem.sort(["l_orderkey", "l_linenumber"]).write_parquet("s3://my-bucket/lineitem-sorted/")
+            ~~~
+        """
+
+        if type(keys) == str:
+            keys = [keys]
+        for key in keys:
+            assert key in self.schema, "sort key not found in DataStream"
+
+        sort_node = StatefulNode(
+            schema=self.schema,
+            # filters and projections commute with sorting
+            schema_mapping={col: (0, col) for col in self.schema},
+            required_columns={0: set(keys)},
+            operator=SuperFastSortExecutor(keys, file_prefix = "sort")
+        )
+
+        if self._scan_source() is None:
+            # sampling would run everything upstream twice
+            sort_node.set_placement_strategy(SingleChannelStrategy())
+            return self.quokka_context.new_stream(
+                sources={0: self},
+                partitioners={0: BroadcastPartitioner()},
+                node=sort_node,
+                schema=self.schema,
+                ordering=None
+            )
+
+        # one channel per machine per exec_per_node, the default placement of the sort node
+        num_channels = self.quokka_context.cluster.num_node * self.quokka_context.exec_per_node
+        # every channel samples the keys of the first rows it reads and cancels its input after that, one channel samples those samples
+        sample = self.select(keys)._two_stage(SampleExecutor(SORT_SAMPLE_ROWS_PER_CHANNEL, SORT_SAMPLE_READ_ROWS_PER_CHANNEL), 
+            SampleExecutor(SORT_SAMPLE_ROWS_PER_CHANNEL * num_channels), keys).collect()
+        if sample is None or len(sample) == 0:
+            splitters = polars.DataFrame({key: [] for key in keys})
+        else:
+            sample = sample.select(keys).sort(keys)
+            splitters = polars.concat([sample[len(sample) * i // num_channels : len(sample) * i // num_channels + 1] for i in range(1, num_channels)]) \
+                if num_channels > 1 else sample[:0]
+
+        return self.quokka_context.new_stream(
+            sources={0: self},
+            partitioners={0: SplitterPartitioner(keys, splitters)},
+            node=sort_node,
+            schema=self.schema,
+            ordering=None
+        )
+
+    def _two_stage(self, first, second, required_columns):
+
+        '''
+        Runs first on every channel, next to where the data already is, and second on one channel over what they all emit.
+        Nothing can be pushed past either, since which rows come out depends on all of them.
+        '''
+
+        per_channel = self.quokka_context.new_stream(
+            sources={0: self},
+            partitioners={0: PassThroughPartitioner()},
+            node=StatefulNode(
+                schema=self.schema,
+                schema_mapping={col: (-1, col) for col in self.schema},
+                required_columns={0: set(required_columns)},
+                operator=first
+            ),
+            schema=self.schema,
+            ordering=None
+        )
+
+        gather_node = StatefulNode(
+            schema=self.schema,
+            schema_mapping={col: (-1, col) for col in self.schema},
+            required_columns={0: set(required_columns)},
+            operator=second
+        )
+        gather_node.set_placement_strategy(SingleChannelStrategy())
+        return self.quokka_context.new_stream(
+            sources={0: per_channel},
+            partitioners={0: BroadcastPartitioner()},
+            node=gather_node,
+            schema=self.schema,
+            ordering=None
+        )
+
+    def top_k(self, keys, k):
+
+        """
+        The k first rows of the DataStream in the order of keys, like `ORDER BY keys LIMIT k` in SQL. Every channel keeps only its own
+        top k rows, and only those are sent to one channel to pick the final k.
+
+        Args:
+            keys (str or list): a column, or a list of columns or (column, "asc" or "desc") tuples. Bare columns are sorted ascending like in
+                ORDER BY, so `top_k("revenue", 100)` gives the 100 rows with the smallest revenue and `top_k([("revenue", "desc")], 100)` the biggest.
+            k (int): how many rows to keep.
+
+        Return:
+            A DataStream with at most k rows, sorted on keys.
+
+        Examples:
+            ~~~python
+            >>> orders = qc.read_parquet("s3://tpc-h-parquet/orders/*")
+
+            # top 100 customers by revenue
+            >>> revenue = orders.groupby("o_custkey").agg({"o_totalprice":"sum"})
+            >>> top = revenue.top_k([("o_totalprice_sum", "desc")], 100)
+
+            # the 10 oldest orders, oldest first
+            >>> oldest = orders.top_k("o_orderdate", 10)
+            ~~~
+        """
+
+        if type(keys) == str:
+            keys = [keys]
+        orderby = [(key, "asc") if type(key) == str else key for key in keys]
+        for key, dir in orderby:
+            assert key in self.schema, "top_k key not found in DataStream"
+            assert dir in {"asc", "desc"}, "sort direction must be asc or desc"
+        assert type(k) == int and k > 0
+
+        return self._two_stage(TopKExecutor(orderby, k), TopKExecutor(orderby, k), self.schema)
+
+    def limit(self, n):
+
+        """
+        Any n rows of the DataStream, like `LIMIT n` in SQL. Every channel passes on its first n rows as soon as they come and drops 
+        the rest, and one channel keeps the first n of those. As soon as that channel has its n rows everything upstream of the limit
+        is cancelled, so a limit on a huge input returns once enough rows came in instead of after reading all of it.
+
+        Args:
+            n (int): how many rows to keep.
+
+        Return:
+            A DataStream with at most n rows.
+
+        Examples:
+            ~~~python
+            >>> lineitem = qc.read_parquet("s3://tpc-h-parquet/lineitem/*")
+            >>> lineitem.limit(10).collect()
+            ~~~
+        """
+
+        assert type(n) == int and n > 0
+        return self._two_stage(LimitExecutor(n), LimitExecutor(n), self.schema)
+
+    def join(self, right, on=None, left_on=None, right_on=None, suffix="_2", how="inner", build_first=False):
 
         """
         Join a DataStream with another DataStream or a **small** Polars DataFrame (<10MB). If you have a Polars DataFrame bigger
@@ -668,7 +855,10 @@ class DataStream:
 
         A streaming two-sided distributed join will be executed for two DataStream joins and a streaming broadcast join
         will be executed for DataStream joined with Polars DataFrame. Joins are obviously very important, and we are constantly improving
-        how we do joins. Eventually we will support out of core joins, when @savebuffer merges his PR into Arrow 10.0.
+        how we do joins. A two-sided join that runs out of memory spills to local disk. If both DataStreams come from Parquets read with `sorted_by` 
+        set to their join columns, the right one is read on the same key ranges as this one and a streaming sort-merge join is executed instead, 
+        which only keeps the rows at the front of the merge. If one side of a two DataStream join is estimated to be small
+        after its filters (see the "broadcast_join_bytes" config), the optimizer sends it to every channel and reads it first instead of shuffling both sides.
 
         Args:
             right (DataStream or Polars DataFrame): the DataStream or Polars DataFrame to join to.
@@ -678,6 +868,9 @@ class DataStream:
             right_on (str): the name of the join column in `right`.
             suffix (str): if `right` has columns with the same names as columns in this DataStream, their names will be appended with the suffix in the result.
             how (str): supports "inner", "left", "semi" or "anti"
+            build_first (bool): only for a DataStream `right`. Read all of `right` before any of this DataStream, so this side never has to be
+                kept around, and left and anti joins emit as they go instead of at the end. Don't use it if both sides read from the same source,
+                since that source can't make progress on `right` while this side's batches back up.
 
         Return:
             A new DataStream that's the joined result of this DataStream and "right". By default, columns from both side will be retained, 
@@ -745,9 +938,34 @@ class DataStream:
         if how == "semi" or how == "anti":
             right = right.select([right_on])
 
-        if issubclass(type(right), DataStream):
+        left_sorted_source = self._sorted_source(left_on)
+        right_sorted_source = right._sorted_source(right_on) if issubclass(type(right), DataStream) else None
+        channels_match = self.quokka_context.io_per_node % self.quokka_context.exec_per_node == 0
 
-            operator = JoinExecutor(on, left_on, right_on, suffix=suffix, how=how) if how != "anti" else AntiJoinExecutor(on , left_on, right_on, suffix = suffix)
+        if left_sorted_source is not None and right_sorted_source is not None and channels_match and not build_first and \
+            right_sorted_source.copartition in {None, (left_sorted_source.bucket, left_sorted_source.prefix, left_on)} and \
+            left_sorted_source.placement_strategy is None and right_sorted_source.placement_strategy is None:
+
+            # channel i of the right reader covers the same keys as channel i of the left reader, and the join has one channel per
+            # reader channel, so every join channel gets both its sides in order from one channel each
+            right_sorted_source.copartition = (left_sorted_source.bucket, left_sorted_source.prefix, left_on)
+            join_node = StatefulNode(
+                    schema=new_schema,
+                    schema_mapping=schema_mapping,
+                    required_columns={0: {left_on}, 1: {right_on}},
+                    operator= SortMergeJoinExecutor(on, left_on, right_on, suffix=suffix, how=how, right_schema=right.schema))
+            join_node.set_placement_strategy(CustomChannelsStrategy(self.quokka_context.io_per_node // self.quokka_context.exec_per_node))
+
+            return self.quokka_context.new_stream(
+                sources={0: self, 1: right},
+                partitioners={0: PassThroughPartitioner(), 1: PassThroughPartitioner()},
+                node=join_node,
+                schema=new_schema,
+                ordering=None)
+
+        elif issubclass(type(right), DataStream):
+
+            operator = JoinExecutor(on, left_on, right_on, suffix=suffix, how=how, build_first=build_first) if how != "anti" else AntiJoinExecutor(on , left_on, right_on, suffix = suffix, build_first=build_first)
 
             return self.quokka_context.new_stream(
                 sources={0: self, 1: right},
@@ -759,7 +977,7 @@ class DataStream:
                     required_columns={0: {left_on}, 1: {right_on}},
                     operator= operator),
                 schema=new_schema,
-                ordering=None)
+                ordering=[1, 0] if build_first else None)
 
         elif type(right) == polars.internals.DataFrame:
             
@@ -781,8 +999,8 @@ class DataStream:
         """
         Group a DataStream on a list of columns, optionally specifying an ordering requirement.
 
-        This returns a GroupedDataStream object, which currently only expose the `aggregate` method. This is similar to Pandas `df.groupby().agg()` syntax.
-        Eventually the GroupedDataStream object will also support different kinds of window functions. 
+        This returns a GroupedDataStream object, which exposes the `aggregate` method, similar to Pandas `df.groupby().agg()` syntax, 
+        and the `window` method for window functions over the groups.
 
         Args:
             groupby (list or str): a column or a list of columns to group on.
@@ -819,6 +1037,75 @@ class DataStream:
 
         return GroupedDataStream(self, groupby=groupby, orderby=orderby)
 
+    def _scan_source(self):
+
+        '''
+        The source node this DataStream reads straight from, with only filters, projections and maps in between, otherwise None.
+        '''
+
+        node = self.quokka_context.nodes[self.source_node_id]
+        while type(node) in {FilterNode, ProjectionNode, MapNode} and len(node.parents) == 1:
+            node = self.quokka_context.nodes[node.parents[0]]
+        if issubclass(type(node), SourceNode):
+            return node
+        return None
+
+    def _sorted_source(self, key):
+
+        '''
+        The sorted Parquet source this DataStream reads straight from, if it is sorted on key, otherwise None.
+        Filters, projections and maps keep the order of the rows.
+        '''
+
+        node = self.quokka_context.nodes[self.source_node_id]
+        while type(node) in {FilterNode, ProjectionNode, MapNode} and len(node.parents) == 1:
+            node = self.quokka_context.nodes[node.parents[0]]
+        if type(node) == InputS3SortedParquetNode and node.sorted_by == key:
+            return node
+        return None
+
+    def _estimate_groups(self, groupby: list):
+
+        '''
+        Rough upper bound on the number of groups a groupby on these keys makes, or None if we have no idea.
+        We only know something if the keys come straight from a local Parquet source. Then the row count bounds it,
+        and so do the min/max statistics of integer keys.
+        '''
+
+        node = self.quokka_context.nodes[self.source_node_id]
+        while type(node) in {FilterNode, ProjectionNode, MapNode} and len(node.parents) == 1:
+            node = self.quokka_context.nodes[node.parents[0]]
+        if type(node) != InputDiskParquetNode or not all(key in node.schema for key in groupby):
+            return None
+
+        if os.path.isdir(node.filepath):
+            files = [node.filepath + i for i in os.listdir(node.filepath) if i.endswith(".parquet")]
+        else:
+            files = [node.filepath]
+
+        num_rows = 0
+        ranges = {key: (None, None) for key in groupby}
+        for file in files:
+            metadata = pq.ParquetFile(file).metadata
+            num_rows += metadata.num_rows
+            names = [metadata.schema.column(i).name for i in range(metadata.num_columns)]
+            for row_group in range(metadata.num_row_groups):
+                for key in list(ranges.keys()):
+                    stats = metadata.row_group(row_group).column(names.index(key)).statistics
+                    if stats is None or not stats.has_min_max or type(stats.min) != int:
+                        # no bound from this key
+                        del ranges[key]
+                        continue
+                    low, high = ranges[key]
+                    ranges[key] = (stats.min if low is None else min(low, stats.min), stats.max if high is None else max(high, stats.max))
+
+        if len(ranges) < len(groupby):
+            return num_rows
+        groups = 1
+        for low, high in ranges.values():
+            groups *= high - low + 1
+        return min(num_rows, groups)
+
     def _grouped_aggregate(self, groupby: list, aggregations: dict, orderby=None):
         '''
         This is an internal method. Regular people are expected to use .groupby().agg() instead of this.
@@ -831,13 +1118,17 @@ class DataStream:
         for key in aggregations:
             assert (key == "*" and (aggregations[key] == ['count'] or aggregations[key] == 'count')) or (
                 key in self.schema and key not in groupby)
-            if type(aggregations[key]) == str:
+            if type(aggregations[key]) == str or type(aggregations[key]) == tuple:
                 aggregations[key] = [aggregations[key]]
             for i in range(len(aggregations[key])):
                 if aggregations[key][i] == "avg":
                     aggregations[key][i] = "mean"
+                if type(aggregations[key][i]) == tuple:
+                    assert aggregations[key][i][0] == "approx_quantile" and len(aggregations[key][i]) == 2 and 0 <= aggregations[key][i][1] <= 1, \
+                        "the only aggregation with an argument is (\"approx_quantile\", q) with q between 0 and 1"
+                elif key != "*":
                     assert aggregations[key][i] in {
-                        "max", "min", "mean", "sum"}, "only support max, min, mean and sum for now"
+                        "max", "min", "mean", "sum", "count_distinct", "approx_count_distinct"}, "only support max, min, mean, sum, count_distinct, approx_count_distinct and approx_quantile for now"
         for key in groupby:
             assert key in self.schema
 
@@ -872,6 +1163,10 @@ class DataStream:
         '''
 
         pyarrow_agg_list = [(count_col, "sum")]
+        # pyarrow names its output columns col_agg, which is not always the name we want
+        pyarrow_rename_dict = {}
+        # (column, "hll" or "kll", output column) for the aggregations that ship a sketch per group instead
+        sketch_list = []
         agg_executor_dict = {}
         # key is column name, value is Boolean to indicate if you should keep around the sum column.
         mean_cols = {}
@@ -890,6 +1185,29 @@ class DataStream:
                         agg_executor_dict[new_col] = "sum"
                         mean_cols[key] = False
 
+                elif agg_spec == "approx_count_distinct":
+                    new_col = key + "_approx_count_distinct"
+                    assert new_col not in new_schema, "duplicate column names detected, most likely caused by a groupby column with suffix _max etc."
+                    new_schema.append(new_col)
+                    sketch_list.append((key, "hll", new_col))
+                    agg_executor_dict[new_col] = agg_spec
+
+                elif type(agg_spec) == tuple:
+                    new_col = key + "_approx_quantile_" + str(agg_spec[1])
+                    assert new_col not in new_schema, "duplicate column names detected, most likely caused by a groupby column with suffix _max etc."
+                    new_schema.append(new_col)
+                    sketch_list.append((key, "kll", new_col))
+                    agg_executor_dict[new_col] = ("quantile", agg_spec[1])
+
+                elif agg_spec == "count_distinct":
+                    # each batch ships the distinct values of each group, AggExecutor counts them across batches.
+                    new_col = key + "_count_distinct"
+                    assert new_col not in new_schema, "duplicate column names detected, most likely caused by a groupby column with suffix _max etc."
+                    new_schema.append(new_col)
+                    pyarrow_agg_list.append((key, "distinct"))
+                    pyarrow_rename_dict[key + "_distinct"] = new_col
+                    agg_executor_dict[new_col] = agg_spec
+
                 else:
                     new_col = key + "_" + agg_spec
                     assert new_col not in new_schema, "duplicate column names detected, most likely caused by a groupby column with suffix _max etc."
@@ -900,38 +1218,88 @@ class DataStream:
         # now insert the transform node.
         # this function needs to be fast since it's executed at every batch in the actual runtime.
 
-        def f(keys, agg_list, batch):
+        def f(keys, agg_list, rename_dict, sketch_list, batch):
             enhanced_batch = batch.with_column(
                 polars.lit(1).cast(polars.Int64).alias(count_col))
-            return polars.from_arrow(enhanced_batch.to_arrow().group_by(keys).aggregate(agg_list))
+            result = polars.from_arrow(enhanced_batch.to_arrow().group_by(keys).aggregate(agg_list)).rename(rename_dict)
+            # the sketch of each group in this batch, see sketches.py
+            for col, kind, new_col in sketch_list:
+                values = enhanced_batch.select(keys + [col]).filter(polars.col(col).is_not_null())
+                if kind == "hll":
+                    codes = HyperLogLog.codes(hash_keys(values, [col], 37, 41, 43, 47))
+                    # only the biggest code of each register matters
+                    sketches = values.select(keys).with_columns([polars.Series("__register__", codes >> np.uint32(6)), polars.Series("__code__", codes)]) \
+                        .groupby(keys + ["__register__"]).agg(polars.col("__code__").max()).groupby(keys).agg(polars.col("__code__").list().alias(new_col))
+                else:
+                    grouped = values.groupby(keys).agg(polars.col(col).list())
+                    sketches = grouped.select(keys).with_column(polars.Series(new_col, [KLLSketch().update(group).to_list() for group in grouped[col].to_list()], 
+                        dtype = polars.List(polars.Float64)))
+                result = result.join(sketches, on = keys, how = "left")
+            return result
 
         if len(groupby) > 0:
-            map_func = partial(f, groupby, pyarrow_agg_list)
+            map_func = partial(f, groupby, pyarrow_agg_list, pyarrow_rename_dict, sketch_list)
         else:
-            map_func = partial(f, [count_col], pyarrow_agg_list)
+            map_func = partial(f, [count_col], pyarrow_agg_list, pyarrow_rename_dict, sketch_list)
 
         transformed_stream = self.transform(map_func,
                                             new_schema=new_schema,
                                             # it shouldn't matter too much for the required columns, since no predicates or projections will ever be pushed through this map node.
                                             # even if this map node gets fused with prior map nodes, no predicates should ever be pushed through those map nodes either.
                                             required_columns=set(required_columns))
+        # a groupby with few groups is cheap to finish on one channel. Otherwise every exec channel aggregates the groups that hash to it,
+        # and only the final ordering, if there is one, is done on one channel. If we have no estimate we assume it's big.
+        estimated_groups = self._estimate_groups(groupby) if len(groupby) > 0 else 1
+        parallel = estimated_groups is None or estimated_groups >= PARALLEL_AGG_MIN_GROUPS
+
         agg_node = StatefulNode(
             schema=new_schema,
             schema_mapping={col: (-1, col) for col in new_schema},
             required_columns={0: set(new_schema)},
             operator=AggExecutor(groupby if len(groupby) > 0 else [
-                                 count_col], orderby, agg_executor_dict, mean_cols, emit_count)
+                                 count_col], None if parallel else orderby, agg_executor_dict, mean_cols, emit_count)
         )
-        agg_node.set_placement_strategy(SingleChannelStrategy())
+
+        if not parallel:
+            agg_node.set_placement_strategy(SingleChannelStrategy())
+            aggregated_stream = self.quokka_context.new_stream(
+                sources={0: transformed_stream},
+                partitioners={0: BroadcastPartitioner()},
+                node=agg_node,
+                schema=new_schema,
+                ordering=None
+            )
+            return aggregated_stream
+
         aggregated_stream = self.quokka_context.new_stream(
             sources={0: transformed_stream},
-            partitioners={0: BroadcastPartitioner()},
+            partitioners={0: HashPartitioner(groupby)},
             node=agg_node,
             schema=new_schema,
             ordering=None
         )
 
-        return aggregated_stream
+        if orderby is None:
+            return aggregated_stream
+        
+        # the columns AggExecutor actually emits
+        dropped = set([key + "_sum" for key in mean_cols if not mean_cols[key]] + ([] if emit_count else [count_col + "_sum"]))
+        output_schema = [col for col in new_schema if col not in dropped] + [key + "_mean" for key in mean_cols]
+
+        gather_node = StatefulNode(
+            schema=output_schema,
+            schema_mapping={col: (0, col) for col in output_schema},
+            required_columns={0: set(output_schema)},
+            operator=SortedGatherExecutor(orderby)
+        )
+        gather_node.set_placement_strategy(SingleChannelStrategy())
+        return self.quokka_context.new_stream(
+            sources={0: aggregated_stream},
+            partitioners={0: BroadcastPartitioner()},
+            node=gather_node,
+            schema=output_schema,
+            ordering=None
+        )
 
     def agg(self, aggregations):
 
@@ -946,8 +1314,11 @@ class DataStream:
 
         Args:
             aggregations (dict): similar to a dictionary argument to Pandas `df.agg()`. The key is the column name, where the value
-                is a str that is "min", "max", "mean", "sum", "avg" or a list of such strings. If you desire to have the count column
-                in your result, add a key "*" with value "count". Look at the examples.
+                is a str that is "min", "max", "mean", "sum", "avg", "count_distinct", "approx_count_distinct", a tuple ("approx_quantile", q), 
+                or a list of such. If you desire to have the count column in your result, add a key "*" with value "count". Look at the examples.
+                "approx_count_distinct" is a HyperLogLog estimate, within about 2%, and ("approx_quantile", q) a KLL sketch estimate of the q-th
+                quantile. Unlike "count_distinct", they only ship a small sketch per group out of every batch. Their columns are named like 
+                l_orderkey_approx_count_distinct and l_quantity_approx_quantile_0.5.
 
         Return:
             A DataStream object that holds the aggregation result. It will only emit one batch, which is the result when it's done. 
@@ -1104,8 +1475,11 @@ class GroupedDataStream:
 
         Args:
             aggregations (dict): similar to a dictionary argument to Pandas `df.agg()`. The key is the column name, where the value
-                is a str that is "min", "max", "mean", "sum", "avg" or a list of such strings. If you desire to have the count column
-                in your result, add a key "*" with value "count". Look at the examples.
+                is a str that is "min", "max", "mean", "sum", "avg", "count_distinct", "approx_count_distinct", a tuple ("approx_quantile", q), 
+                or a list of such. If you desire to have the count column in your result, add a key "*" with value "count". Look at the examples.
+                "approx_count_distinct" is a HyperLogLog estimate, within about 2%, and ("approx_quantile", q) a KLL sketch estimate of the q-th
+                quantile. Unlike "count_distinct", they only ship a small sketch per group out of every batch. Their columns are named like 
+                l_orderkey_approx_count_distinct and l_quantity_approx_quantile_0.5.
 
         Return:
             A DataStream object that holds the aggregation result. It will only emit one batch, which is the result when it's done. 
@@ -1123,6 +1497,9 @@ class GroupedDataStream:
             # I want the sum and average of the l_quantity column and the l_extendedprice colum, the sum of the disc_price column, the minimum of the l_discount
             # column, and oh give me the total row count as well, of each unique combination of l_returnflag and l_linestatus
             >>> f = d.groupby(["l_returnflag", "l_linestatus"]).agg({"l_quantity":["sum","avg"], "l_extendedprice":["sum","avg"], "disc_price":"sum", "l_discount":"min","*":"count"})
+
+            # about how many distinct orders and the approximate median quantity, per ship date
+            >>> f = d.groupby("l_shipdate").agg({"l_orderkey":"approx_count_distinct", "l_quantity":("approx_quantile", 0.5)})
             ~~~
         """
 
@@ -1133,3 +1510,76 @@ class GroupedDataStream:
         Alias for agg.
         """
         return self.agg(aggregations)
+
+    def window(self, windows: dict, orderby: str):
+
+        """
+        Window functions over the groups of this GroupedDataStream, like `f() OVER (PARTITION BY groupby ORDER BY orderby)` in SQL. Every row
+        is kept, with one new column per window function.
+
+        The rows are hash partitioned on the group keys, and every exec channel external sorts its rows on orderby on local disk. Then it goes
+        through them in order a batch at a time, carrying over a little state for each group from one batch to the next.
+
+        Memory is O(rows), not O(groups): the rows themselves wait on disk, but the sort keeps the orderby value and a 4 byte run number of
+        every row of the channel in memory. On top of that the carried state is O(groups). This is a blocking operation for each channel: 
+        any row still to come could sort first, so nothing comes out until all of its input is in. The rows don't come out in any particular order.
+
+        Args:
+            windows (dict): the key is the name of the new column, the value is "row_number", "rank", ("lag", column, n), ("lead", column, n) 
+                or ("cumsum", column). n is optional and defaults to 1. "rank" gives ties the same rank and skips ranks after them, like SQL RANK.
+                ("lag", column, n) is column n rows before in the group, ("lead", column, n) n rows after, null if there is no such row. 
+                ("cumsum", column) is the running sum of column up to and including this row, nulls count as 0.
+            orderby (str): the column to order each group by, ascending. Null values come first.
+
+        Return:
+            A DataStream with the columns of this one and the new columns.
+        
+        Examples:
+            ~~~python
+            >>> lineitem = qc.read_csv("lineitem.csv")
+
+            # number the lines of every order by ship date, with the running total quantity and the previous line's ship date
+            >>> d = lineitem.groupby("l_orderkey").window({"line_no": "row_number", "total_quantity": ("cumsum", "l_quantity"), 
+                    "previous_shipdate": ("lag", "l_shipdate")}, orderby = "l_shipdate")
+            ~~~
+        """
+
+        source = self.source_data_stream
+        assert type(orderby) == str and orderby in source.schema, "must order by a column of the DataStream"
+
+        specs = []
+        for name, spec in windows.items():
+            assert name not in source.schema, "window column " + name + " is already in the DataStream"
+            if type(spec) == str:
+                spec = (spec,)
+            assert type(spec) == tuple and len(spec) > 0
+            function = spec[0]
+            if function == "row_number" or function == "rank":
+                assert len(spec) == 1
+                specs.append((name, function, None, 0))
+            elif function == "lag" or function == "lead":
+                assert (len(spec) == 2 or len(spec) == 3) and spec[1] in source.schema
+                n = spec[2] if len(spec) == 3 else 1
+                assert type(n) == int and n > 0
+                specs.append((name, function, spec[1], n))
+            elif function == "cumsum":
+                assert len(spec) == 2 and spec[1] in source.schema
+                specs.append((name, function, spec[1], 0))
+            else:
+                raise Exception("window function not supported", function)
+
+        new_schema = source.schema + list(windows.keys())
+
+        return source.quokka_context.new_stream(
+            sources={0: source},
+            partitioners={0: HashPartitioner(self.groupby)},
+            node=StatefulNode(
+                schema=new_schema,
+                # a filter on the group keys drops whole groups, so it can go before the window functions. Nothing else can.
+                schema_mapping={col: (0, col) if col in self.groupby else (-1, col) for col in new_schema},
+                required_columns={0: set(source.schema)},
+                operator=WindowExecutor(self.groupby, orderby, specs)
+            ),
+            schema=new_schema,
+            ordering=None
+        )
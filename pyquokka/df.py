@@ -6,6 +6,13 @@ import pyquokka.sql_utils as sql_utils
 from pyquokka.datastream import * 
 import os
 
+# guessed fraction of rows that pass a predicate of each kind, when estimating how big a table is after its filters
+EQUALITY_SELECTIVITY = 0.1
+RANGE_SELECTIVITY = 0.33
+OTHER_SELECTIVITY = 0.5
+# Parquet files on S3 are only sized by their object sizes, and are about this much bigger in memory
+PARQUET_EXPANSION = 3
+
 class QuokkaContext:
     def __init__(self, cluster = None, io_per_node = 2, exec_per_node = 1) -> None:
         self.latest_node_id = 0
@@ -13,6 +20,35 @@ class QuokkaContext:
         self.cluster = LocalCluster() if cluster is None else cluster
         self.io_per_node = io_per_node
         self.exec_per_node = exec_per_node
+        self.exec_config = {"shuffle_compression": None, "broadcast_join_bytes": 100 * 1048576}
+
+    def set_config(self, key, value):
+
+        """
+        Set an execution setting for the queries run from this context.
+
+        Args:
+            key (str): the setting. One of:
+                "shuffle_compression", which compresses the batches pushed between machines. It can be None (off, the default), 
+                "lz4", "zstd" or "adaptive". "adaptive" picks for every edge in the plan whether and how to compress from the 
+                measured compression ratio and link throughput.
+                "broadcast_join_bytes": a join of two DataStreams is run as a broadcast join if one side is estimated to be smaller
+                than this many bytes after its filters, 100MB by default. The estimate comes from Parquet metadata or CSV file sizes.
+                Set it to 0 to always shuffle both sides.
+            value: the new value.
+
+        Examples:
+            ~~~python
+            >>> qc.set_config("shuffle_compression", "adaptive")
+            ~~~
+        """
+
+        assert key in self.exec_config, "unrecognized config " + str(key)
+        if key == "shuffle_compression":
+            assert value in {None, "lz4", "zstd", "adaptive"}, "shuffle_compression must be None, lz4, zstd or adaptive"
+        if key == "broadcast_join_bytes":
+            assert type(value) == int and value >= 0, "broadcast_join_bytes must be a non-negative int"
+        self.exec_config[key] = value
 
     def read_files(self, table_location: str):
 
@@ -208,7 +244,7 @@ class QuokkaContext:
     After it has done these things, if the dataset is not materialized, we will instantiate a logical plan node and return a DataStream
     '''
 
-    def read_parquet(self, table_location: str, schema = None):
+    def read_parquet(self, table_location: str, schema = None, sorted_by = None):
 
         """
         Read Parquet. It can be a single Parquet or a list of Parquets. It can be Parquet(s) on disk
@@ -218,6 +254,9 @@ class QuokkaContext:
         Args:
             table_location (str): where the Parquet(s) are. This mostly mimics Spark behavior. Look at the examples.
             schema (list): list of column names. This is optional. If you do supply it, please make sure it's correct!
+            sorted_by (str): only for Parquets on S3 with a prefix. Says that every file is sorted on this column, and no two files overlap on it,
+                which is checked against the Parquet statistics. Every channel then reads its files in order, and joins of two such DataStreams
+                on their sort columns are sort-merge joins that keep very little state.
 
         Return:
             A new DataStream if the Parquet file is larger than 10MB, otherwise a Polars DataFrame. 
@@ -235,9 +274,14 @@ class QuokkaContext:
 
             # read Parquets from S3 bucket with prefix
             >>> lineitem = qc.read_parquet("s3://tpc-h-parquet/lineitem/*")
+
+            # read Parquets clustered on l_orderkey from S3 bucket with prefix
+            >>> lineitem = qc.read_parquet("s3://tpc-h-parquet/lineitem/*", sorted_by = "l_orderkey")
             ~~~
         """
 
+        assert sorted_by is None or (table_location[:5] == "s3://" and table_location[-1] == "*"), "sorted_by only works for Parquets on S3 with a prefix"
+
         if table_location[:5] == "s3://":
 
             if type(self.cluster) == LocalCluster:
@@ -266,7 +310,11 @@ class QuokkaContext:
                     except:
                         raise Exception("schema discovery failed for Parquet dataset at location ", table_location)
                 
-                self.nodes[self.latest_node_id] = InputS3ParquetNode(bucket, prefix, None, schema)
+                if sorted_by is not None:
+                    assert sorted_by in schema, "sorted_by column not found in the Parquet dataset"
+                    self.nodes[self.latest_node_id] = InputS3SortedParquetNode(bucket, prefix, schema, sorted_by)
+                else:
+                    self.nodes[self.latest_node_id] = InputS3ParquetNode(bucket, prefix, None, schema)
             else:
                 if schema is None:
                     try:
@@ -353,11 +401,14 @@ class QuokkaContext:
         Partitioner classes in target_info.py
     node: A Node object, the logical plan node you plan to add here that processes the input DataStreams. 
     schema: a list of column names. This might be changed to a dictionary with type information in the future. 
-    ordering: currently this is not supported. If ordering is specified, then the Quokka runtime will ensure that one input stream
-        is entirely drained by this node before the other input stream starts to be processed. This can be used to implement build-probe join, e.g.
-        implementing this is a priority.
+    ordering: a list of the keys in sources. If ordering is specified, then the Quokka runtime will ensure that each input stream
+        is entirely drained by this node before the next one in the list starts to be processed, e.g. [1, 0] for a build-probe join that builds on 1. 
+        Streams not in the list are read whenever.
     '''
     def new_stream(self, sources: dict, partitioners: dict, node: Node, schema: list, ordering=None):
+        if ordering is not None:
+            assert all(key in sources for key in ordering)
+            node.ordering = ordering
         self.nodes[self.latest_node_id] = node
         for source in sources:
             source_datastream = sources[source]
@@ -382,6 +433,7 @@ class QuokkaContext:
         self.__push_filter__(node_id)
         self.__early_projection__(node_id)
         self.__fold_map__(node_id)
+        self.__broadcast_joins__(node_id)
         
         assert len(self.execution_nodes[node_id].parents) == 1
         parent_idx = list(self.execution_nodes[node_id].parents)[0]
@@ -399,7 +451,7 @@ class QuokkaContext:
     def lower(self, end_node_id, collect = True):
 
         start = time.time()
-        task_graph = TaskGraph(self.cluster, self.io_per_node, self.exec_per_node)
+        task_graph = TaskGraph(self.cluster, self.io_per_node, self.exec_per_node, self.exec_config)
         # print("setup time ", time.time() - start)
         node = self.execution_nodes[end_node_id]
         nodes = deque([node])
@@ -526,7 +578,7 @@ class QuokkaContext:
 
             if issubclass(type(node), SourceNode):
                 # push down predicates to the Parquet Nodes!, for the CSV nodes give up
-                if type(node) == InputDiskParquetNode or type(node) == InputS3ParquetNode:
+                if type(node) == InputDiskParquetNode or type(node) == InputS3ParquetNode or type(node) == InputS3SortedParquetNode:
                     filters, remaining_predicate = sql_utils.parquet_condition_decomp(predicate)
                     if len(filters) > 0:
                         node.predicate = filters
@@ -605,7 +657,7 @@ class QuokkaContext:
 
         if issubclass(type(node), SourceNode):
             # push down predicates to the Parquet Nodes! It benefits CSV nodes too because believe it or not polars.from_arrow could be slow
-            if type(node) == InputDiskParquetNode or type(node) == InputS3ParquetNode or type(node) == InputDiskCSVNode or type(node) == InputS3CSVNode:
+            if type(node) == InputDiskParquetNode or type(node) == InputS3ParquetNode or type(node) == InputS3SortedParquetNode or type(node) == InputDiskCSVNode or type(node) == InputS3CSVNode:
                 projection = set()
                 predicate_required_columns = set()
                 for target_id in targets:
@@ -719,6 +771,146 @@ class QuokkaContext:
                         parent.targets[node_id].projection = pushed_projections[parent_id]
                     self.__early_projection__(parent_id)
 
+    def __estimate_bytes__(self, node_id, target_id):
+
+        '''
+        Rough size in bytes of what node_id sends to target_id after filters and projections, or None if we have no idea.
+        We only know something about sources: Parquet metadata, CSV file sizes, and a guess at the selectivity of each filter.
+        '''
+
+        node = self.execution_nodes[node_id]
+        target_info = node.targets[target_id]
+
+        def selectivity(condition):
+            if type(condition) == sqlglot.exp.Or:
+                return min(1, sum(selectivity(i) for i in condition.flatten()))
+            if type(condition) in {sqlglot.exp.EQ, sqlglot.exp.Like, sqlglot.exp.Is}:
+                return EQUALITY_SELECTIVITY
+            if type(condition) == sqlglot.exp.In:
+                return min(1, EQUALITY_SELECTIVITY * len(condition.args["expressions"]))
+            if type(condition) in {sqlglot.exp.GT, sqlglot.exp.GTE, sqlglot.exp.LT, sqlglot.exp.LTE, sqlglot.exp.Between}:
+                return RANGE_SELECTIVITY
+            return OTHER_SELECTIVITY
+
+        fraction = 1
+        if target_info.predicate != sqlglot.exp.TRUE:
+            predicate = target_info.predicate
+            for conjunct in (predicate.flatten() if isinstance(predicate, sqlglot.exp.And) else [predicate]):
+                fraction *= selectivity(conjunct)
+
+        if type(node) == InputDiskParquetNode or type(node) == InputS3ParquetNode or type(node) == InputS3SortedParquetNode:
+            # the filters pushed into the reader, in the format of pyarrow.parquet.read_table
+            for column, op, value in (node.predicate if node.predicate is not None else []):
+                if op == "==":
+                    fraction *= EQUALITY_SELECTIVITY
+                elif op == "in":
+                    fraction *= min(1, EQUALITY_SELECTIVITY * len(value))
+                elif op == "!=":
+                    fraction *= 1 - EQUALITY_SELECTIVITY
+                else:
+                    fraction *= RANGE_SELECTIVITY
+
+        columns = target_info.projection if target_info.projection is not None else node.projection
+
+        if type(node) == InputDiskParquetNode:
+            if os.path.isdir(node.filepath):
+                files = [node.filepath + i for i in os.listdir(node.filepath) if i.endswith(".parquet")]
+            else:
+                files = [node.filepath]
+            size = 0
+            for file in files:
+                metadata = pq.ParquetFile(file).metadata
+                for row_group in range(metadata.num_row_groups):
+                    for column in range(metadata.num_columns):
+                        chunk = metadata.row_group(row_group).column(column)
+                        if columns is None or chunk.path_in_schema in columns:
+                            size += chunk.total_uncompressed_size
+            return int(size * fraction)
+
+        elif type(node) in {InputDiskCSVNode, InputS3CSVNode, InputS3ParquetNode, InputS3SortedParquetNode}:
+            if type(node) == InputDiskCSVNode:
+                if os.path.isdir(node.filename):
+                    size = sum(os.path.getsize(node.filename + i) for i in os.listdir(node.filename))
+                else:
+                    size = os.path.getsize(node.filename)
+            else:
+                s3 = boto3.client('s3')
+                if node.key is not None:
+                    size = s3.head_object(Bucket = node.bucket, Key = node.key)['ContentLength']
+                else:
+                    size = 0
+                    z = s3.list_objects_v2(Bucket = node.bucket, Prefix = node.prefix)
+                    while True:
+                        size += sum(i['Size'] for i in z.get('Contents', []))
+                        if 'NextContinuationToken' not in z:
+                            break
+                        z = s3.list_objects_v2(Bucket = node.bucket, Prefix = node.prefix, ContinuationToken = z['NextContinuationToken'])
+                if type(node) == InputS3ParquetNode or type(node) == InputS3SortedParquetNode:
+                    size *= PARQUET_EXPANSION
+            # assume all columns are about as wide
+            if columns is not None:
+                size = size * len(columns) / len(node.schema)
+            return int(size * fraction)
+
+        return None
+
+    def __broadcast_joins__(self, node_id):
+
+        '''
+        Turn joins of two DataStreams where one side is estimated to be small into broadcast joins. The small side is sent whole to every
+        channel of the join and read first, and the big side stays on the channels that produced it, so it's never shuffled.
+        Only the right side can be the small one, except for inner joins.
+        '''
+
+        node = self.execution_nodes[node_id]
+        for parent_idx in node.parents:
+            self.__broadcast_joins__(node.parents[parent_idx])
+
+        if type(node) != StatefulNode or type(node.operator) not in {JoinExecutor, AntiJoinExecutor} or len(node.parents) != 2 or node.ordering is not None:
+            return
+
+        def ancestors(node_id):
+            result = {node_id}
+            for parent_idx in self.execution_nodes[node_id].parents:
+                result |= ancestors(self.execution_nodes[node_id].parents[parent_idx])
+            return result
+
+        def channels(node):
+            # channels per machine, the big side can only pass through if the two sides have channel counts that divide
+            if node.placement_strategy is None:
+                channels_per_node = 1
+            elif type(node.placement_strategy) == CustomChannelsStrategy:
+                channels_per_node = node.placement_strategy.channels_per_node
+            else:
+                return None
+            return channels_per_node * (self.io_per_node if issubclass(type(node), SourceNode) else self.exec_per_node)
+        
+        # reading the small side first would deadlock if both sides come from the same place
+        if len(ancestors(node.parents[0]) & ancestors(node.parents[1])) > 0:
+            return
+        
+        how = node.operator.how if type(node.operator) == JoinExecutor else "anti"
+        estimates = {i: self.__estimate_bytes__(node.parents[i], node_id) for i in node.parents}
+        candidates = [1, 0] if how == "inner" else [1]
+        candidates = [i for i in candidates if estimates[i] is not None and estimates[i] <= self.exec_config["broadcast_join_bytes"]]
+        if len(candidates) == 0:
+            return
+        small_stream = min(candidates, key = lambda i: estimates[i])
+        big_stream = 1 - small_stream
+
+        big_channels = channels(self.execution_nodes[node.parents[big_stream]])
+        join_channels = channels(node)
+        if big_channels is None or join_channels is None or max(big_channels, join_channels) % min(big_channels, join_channels) != 0:
+            return
+
+        print_if_debug("broadcasting side", small_stream, "of join", node_id, "estimated bytes", estimates)
+        operator = node.operator
+        keys = {0: operator.left_on, 1: operator.right_on}
+        node.operator = BroadcastJoinExecutor(None, small_on = keys[small_stream], big_on = keys[big_stream], suffix = operator.suffix, how = how, small_stream = small_stream)
+        node.ordering = [small_stream, big_stream]
+        self.execution_nodes[node.parents[small_stream]].targets[node_id].partitioner = BroadcastPartitioner()
+        self.execution_nodes[node.parents[big_stream]].targets[node_id].partitioner = PassThroughPartitioner()
+
     def __fold_map__(self, node_id):
 
         node = self.execution_nodes[node_id]
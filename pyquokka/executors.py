@@ -19,6 +19,8 @@ import pyarrow.parquet as pq
 import ray
 import pickle
 import concurrent.futures
+import uuid
+from pyquokka.sketches import KLLSketch, HyperLogLog, RuntimeFilter, hash_keys, take_rows
 
 class Executor:
     def __init__(self) -> None:
@@ -185,22 +187,35 @@ class OutputExecutor(Executor):
 class BroadcastJoinExecutor(Executor):
     # batch func here expects a list of dfs. This is a quark of the fact that join results could be a list of dfs.
     # batch func must return a list of dfs too
-    def __init__(self, small_table, on = None, small_on = None, big_on = None, suffix = "_small", how = "inner"):
+    # small_table None means the small table is streamed in as small_stream, broadcast to every channel, and the runtime drains it before
+    # it gives us anything from the big stream (ordering [small_stream, 1 - small_stream]). Then every big batch sees the whole small table.
+    def __init__(self, small_table, on = None, small_on = None, big_on = None, suffix = "_small", how = "inner", small_stream = 1):
 
         self.suffix = suffix
 
-        assert how in {"inner", "left", "semi"}
         self.how = how
-        self.batch_how = how if how != "left" else "inner"
-
-        if type(small_table) == pd.core.frame.DataFrame:
-            self.state = polars.from_pandas(small_table)
-        elif type(small_table) == polars.internals.DataFrame:
-            self.state = small_table
+        self.streamed = small_table is None
+        self.small_stream = small_stream
+
+        if self.streamed:
+            # the small table is complete before any big batch comes, so every join type can be answered batch by batch
+            assert how in {"inner", "left", "semi", "anti"}
+            # a small left side only works for inner joins, which don't care which side is which
+            assert small_stream == 1 or how == "inner"
+            self.batch_how = how
+            self.state = None
+            self.small_batches = []
         else:
-            raise Exception("small table data type not accepted")
+            assert how in {"inner", "left", "semi"}
+            self.batch_how = how if how != "left" else "inner"
+            if type(small_table) == pd.core.frame.DataFrame:
+                self.state = polars.from_pandas(small_table)
+            elif type(small_table) == polars.internals.DataFrame:
+                self.state = small_table
+            else:
+                raise Exception("small table data type not accepted")
         
-        if how == "left" or how == "anti":
+        if not self.streamed and (how == "left" or how == "anti"):
             self.left_null = None
             self.first_row_right = small_table[0]
 
@@ -213,7 +228,13 @@ class BroadcastJoinExecutor(Executor):
             self.small_on = small_on
             self.big_on = big_on
         
-        assert self.small_on in self.state.columns
+        if not self.streamed:
+            assert self.small_on in self.state.columns
+
+        # like JoinExecutor, the big side's sources can drop rows that can't match once the small table is complete
+        self.runtime_filter_streams = [1 - small_stream] if self.streamed and how in {"inner", "semi"} else []
+        self.build_done = False
+        self.filter_published = False
     
     def checkpoint(self, conn, actor_id, channel_id, seq):
         pass
@@ -221,6 +242,12 @@ class BroadcastJoinExecutor(Executor):
     def restore(self, conn, actor_id, channel_id, seq):
         pass
 
+    def small_table(self):
+        if self.state is None:
+            self.state = polars.concat(self.small_batches) if len(self.small_batches) > 0 else None
+            self.small_batches = []
+        return self.state
+
     # the execute function signature does not change. stream_id will be a [0 - (length of InputStreams list - 1)] integer
     def execute(self,batches, stream_id, executor_id):
         # state compaction
@@ -229,6 +256,23 @@ class BroadcastJoinExecutor(Executor):
             return
         batch = polars.concat(batches)
 
+        if self.streamed:
+            if stream_id == self.small_stream:
+                assert self.state is None, "the small side of a broadcast join must be read before the big side"
+                self.small_batches.append(batch)
+                return
+            small_table = self.small_table()
+            if small_table is None:
+                assert self.how != "left", "empty RHS"
+                result = batch if self.how == "anti" else None
+            elif self.small_stream == 1:
+                result = batch.join(small_table, left_on = self.big_on, right_on = self.small_on, how = self.batch_how, suffix = self.suffix)
+            else:
+                result = small_table.join(batch, left_on = self.small_on, right_on = self.big_on, how = self.batch_how, suffix = self.suffix)
+            if result is not None and len(result) > 0:
+                return result
+            return
+
         if self.how != "anti":
             try:
                 result = batch.join(self.state, left_on = self.big_on, right_on = self.small_on, how = self.batch_how, suffix = self.suffix)
@@ -248,24 +292,239 @@ class BroadcastJoinExecutor(Executor):
         if self.how != "anti" and result is not None and len(result) > 0:
             return result
     
+    def runtime_filter(self):
+        if len(self.runtime_filter_streams) == 0 or not self.build_done or self.filter_published:
+            return None
+        self.filter_published = True
+        big_keys = [self.big_on] if type(self.big_on) == str else self.big_on
+        small_keys = [self.small_on] if type(self.small_on) == str else self.small_on
+        runtime_filter = RuntimeFilter(big_keys)
+        small_table = self.small_table()
+        if small_table is not None:
+            runtime_filter.add(small_table, small_keys)
+        return runtime_filter
+
+    def update_sources(self, remaining_sources):
+        if self.streamed and self.small_stream not in remaining_sources:
+            self.build_done = True
+    
     def done(self,executor_id):
         #print(len(self.state0),len(self.state1))
         #print("done join ", executor_id)
         
-        if (self.how == "left" or self.how == "anti") and self.left_null is not None and len(self.left_null) > 0:
+        if not self.streamed and (self.how == "left" or self.how == "anti") and self.left_null is not None and len(self.left_null) > 0:
             if self.how == "left":
                 return self.left_null.join(self.first_row_right, left_on= self.left_on, right_on= self.right_on, how = "left", suffix = self.suffix)
             if self.how == "anti":
                 return self.left_null
 
 
+class HashIndex:
+    '''
+    Index of an append-only table from key hash to row ids. Batches are appended to self.table as chunks, and their (hash, row id) pairs
+    are kept as sorted runs. A new run is merged into the one before it once it's as big, like an LSM tree, so there are O(log n) runs.
+    Inserting costs O(log n) amortized per row and probing is a binary search in each run, instead of building a hash table over the 
+    whole table for every batch.
+    '''
+    def __init__(self, keys) -> None:
+        self.keys = keys
+        self.table = None
+        self.runs = []
+        # of the table and the runs, counted as batches come in so we don't have to go over the table's chunks every time
+        self.bytes = 0
+
+    def __len__(self):
+        return 0 if self.table is None else len(self.table)
+
+    def nbytes(self):
+        # the runs are 16 bytes a row
+        return self.bytes
+
+    def insert(self, batch):
+        if len(batch) == 0:
+            return
+        start = len(self)
+        hashes = hash_keys(batch, self.keys)
+        order = np.argsort(hashes, kind = "stable")
+        self.runs.append((hashes[order], order.astype(np.int64) + start))
+        if self.table is None:
+            # not the caller's frame, or vstacking onto it would change theirs
+            self.table = batch.clone()
+        else:
+            self.table.vstack(batch, in_place = True)
+        self.bytes += batch.estimated_size() + 16 * len(batch)
+
+        merged = False
+        while len(self.runs) > 1 and len(self.runs[-1][0]) >= len(self.runs[-2][0]):
+            new_hashes, new_rows = self.runs.pop()
+            old_hashes, old_rows = self.runs.pop()
+            hashes = np.concatenate([old_hashes, new_hashes])
+            order = np.argsort(hashes, kind = "stable")
+            self.runs.append((hashes[order], np.concatenate([old_rows, new_rows])[order]))
+            merged = True
+
+        if merged:
+            # only the last two runs ever merge, so the rows of a run are contiguous in the table. Rechunking the rows of the merged run
+            # keeps the table at one chunk per run for the same cost as the merge
+            run_start = len(self.table) - len(self.runs[-1][0])
+            run_rows = self.table[run_start:].rechunk()
+            self.table = self.table[:run_start]
+            self.table.vstack(run_rows, in_place = True)
+
+    def probe(self, batch, keys):
+        '''
+        Returns two arrays, the rows in batch and the rows in self.table of every pair whose keys match.
+        '''
+        probe_rows = [np.empty(0, dtype = np.int64)]
+        table_rows = [np.empty(0, dtype = np.int64)]
+        if len(self) == 0:
+            return probe_rows[0], table_rows[0]
+
+        hashes = hash_keys(batch, keys)
+        for run_hashes, run_rows in self.runs:
+            first = np.searchsorted(run_hashes, hashes, side = "left")
+            counts = np.searchsorted(run_hashes, hashes, side = "right") - first
+            total = counts.sum()
+            if total == 0:
+                continue
+            # position i of the matches belongs to probe row p, and is match number i - (matches before p) in the run from first[p]
+            offsets = np.repeat(first - (np.cumsum(counts) - counts), counts)
+            probe_rows.append(np.repeat(np.arange(len(hashes), dtype = np.int64), counts))
+            table_rows.append(run_rows[np.arange(total, dtype = np.int64) + offsets])
+
+        probe_rows = np.concatenate(probe_rows)
+        table_rows = np.concatenate(table_rows)
+        # hashes can collide, and null keys never match
+        mask = np.ones(len(probe_rows), dtype = bool)
+        for probe_key, table_key in zip(keys, self.keys):
+            mask &= (batch[probe_key].take(probe_rows) == self.table[table_key].take(table_rows)).fill_null(False).to_numpy()
+        return probe_rows[mask], table_rows[mask]
+
+class KeySet:
+    '''
+    Set of distinct key rows with insert-and-test in O(batch log n). Like HashIndex, it keeps sorted runs of key fingerprints that are merged
+    like an LSM tree, but it doesn't have to keep the rows. A fingerprint is a pair of 64 bit numbers. A single integer key is its own 
+    fingerprint, so that's exact. Other keys get two hashes with different seeds, and two rows are taken to be the same if both match, which
+    for 128 bits is safe up to way more rows than we will ever see. With exact, the key rows are kept too, and matches are checked against them.
+    Null is a key like any other.
+    '''
+    def __init__(self, keys, exact = False) -> None:
+        self.keys = keys
+        self.exact = exact
+        self.integer = None
+        # only for exact, the key rows. the runs point into it
+        self.table = None
+        # (high, low, rows) sorted on high. rows is None unless exact
+        self.runs = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def nbytes(self):
+        return (24 if self.exact else 16) * self.size + (0 if self.table is None else self.table.estimated_size())
+
+    def fingerprints(self, frame):
+        if self.integer is None:
+            dtype = str(frame[self.keys[0]].dtype).lower()
+            self.integer = len(self.keys) == 1 and "int" in dtype and dtype != "uint64"
+        if self.integer:
+            column = frame[self.keys[0]].cast(polars.Int64)
+            return column.fill_null(0).to_numpy().view(np.uint64), column.is_null().to_numpy().astype(np.uint64)
+        return hash_keys(frame, self.keys), hash_keys(frame, self.keys, 19, 23, 29, 31)
+
+    @staticmethod
+    def partitions(high, num_partitions, level = 0):
+        # multiplicative hashing, so the partitions don't line up with how the rows were partitioned to get here.
+        # every level mixes differently, so a partition that is split again doesn't all land in one partition
+        high = high ^ np.uint64((0x632BE59BD9B4E019 * level) & 0xFFFFFFFFFFFFFFFF)
+        high = high * np.uint64(0x9E3779B97F4A7C15)
+        high = (high ^ (high >> np.uint64(29))) * np.uint64(0xBF58476D1CE4E5B9)
+        return ((high >> np.uint64(40)) % np.uint64(num_partitions)).astype(np.int64)
+
+    def lookup(self, frame, high, low):
+        found = np.zeros(len(high), dtype = bool)
+        for run_high, run_low, run_rows in self.runs:
+            first = np.searchsorted(run_high, high, side = "left")
+            counts = np.searchsorted(run_high, high, side = "right") - first
+            # more than one candidate only happens when the high halves collide
+            for j in range(counts.max() if len(counts) > 0 else 0):
+                candidates = np.flatnonzero((counts > j) & ~found)
+                positions = first[candidates] + j
+                same = run_low[positions] == low[candidates]
+                if self.exact:
+                    for key in self.keys:
+                        mine = self.table[key].take(run_rows[positions])
+                        theirs = frame[key].take(candidates)
+                        same &= ((mine == theirs).fill_null(False) | (mine.is_null() & theirs.is_null())).to_numpy()
+                found[candidates[same]] = True
+        return found
+
+    def insert(self, frame, high, low):
+        if len(high) == 0:
+            return
+        order = np.argsort(high, kind = "stable")
+        rows = None
+        if self.exact:
+            rows = order.astype(np.int64) + (0 if self.table is None else len(self.table))
+            self.table = frame.select(self.keys) if self.table is None else self.table.vstack(frame.select(self.keys))
+        self.runs.append((high[order], low[order], rows))
+        self.size += len(high)
+        while len(self.runs) > 1 and len(self.runs[-1][0]) >= len(self.runs[-2][0]):
+            new_high, new_low, new_rows = self.runs.pop()
+            old_high, old_low, old_rows = self.runs.pop()
+            high = np.concatenate([old_high, new_high])
+            order = np.argsort(high, kind = "stable")
+            self.runs.append((high[order], np.concatenate([old_low, new_low])[order], 
+                np.concatenate([old_rows, new_rows])[order] if self.exact else None))
+
+    def add(self, frame):
+        '''
+        Inserts the rows of frame whose keys are new, and returns them.
+        '''
+        frame = frame.unique(subset = self.keys)
+        if len(frame) == 0:
+            return frame
+        high, low = self.fingerprints(frame)
+        new = np.flatnonzero(~self.lookup(frame, high, low))
+        frame = take_rows(frame, new)
+        self.insert(frame, high[new], low[new])
+        return frame
+
+    def entries(self):
+        if len(self.runs) == 0:
+            return np.empty(0, dtype = np.uint64), np.empty(0, dtype = np.uint64), None
+        return np.concatenate([run[0] for run in self.runs]), np.concatenate([run[1] for run in self.runs]), \
+            np.concatenate([run[2] for run in self.runs]) if self.exact else None
+
+    def remove_partitions(self, partitions, num_partitions, level = 0):
+        '''
+        Takes out the fingerprints, and the rows if exact, of these partitions and returns them as a DataFrame that load() takes.
+        '''
+        high, low, rows = self.entries()
+        removed = np.isin(KeySet.partitions(high, num_partitions, level), np.array(partitions, dtype = np.int64))
+        result = polars.DataFrame([polars.Series("__high__", high[removed]), polars.Series("__low__", low[removed])])
+        if self.exact:
+            result = take_rows(self.table, rows[removed]).hstack(result)
+            table = take_rows(self.table, rows[~removed])
+        self.runs = []
+        self.size = 0
+        self.table = None
+        self.insert(table if self.exact else None, high[~removed], low[~removed])
+        return result
+
+    def load(self, frame):
+        self.insert(frame.select(self.keys) if self.exact else None, frame["__high__"].to_numpy(), frame["__low__"].to_numpy())
+
 class JoinExecutor(Executor):
     # batch func here expects a list of dfs. This is a quark of the fact that join results could be a list of dfs.
     # batch func must return a list of dfs too
-    def __init__(self, on = None, left_on = None, right_on = None, suffix="_right", how = "inner"):
+    # each side keeps a HashIndex of its rows. A batch probes the index of the other side, then gets inserted into its own.
+    # past spill_bytes of state this becomes a hybrid grace hash join: the biggest of spill_partitions hash partitions go to /data/,
+    # rows of those partitions that come later go straight to disk, and done() joins the partitions on disk one at a time.
+    # build_first says the runtime drains stream 1 before it gives us anything from stream 0, so stream 0 is never stored.
+    def __init__(self, on = None, left_on = None, right_on = None, suffix="_right", how = "inner", spill_bytes = 4 * 1024 ** 3, spill_partitions = 16, file_prefix = "join", build_first = False):
 
-        self.state0 = None
-        self.state1 = None
         self.suffix = suffix
 
         if on is not None:
@@ -276,22 +535,42 @@ class JoinExecutor(Executor):
             assert left_on is not None and right_on is not None
             self.left_on = left_on
             self.right_on = right_on
+        self.left_keys = [self.left_on] if type(self.left_on) == str else self.left_on
+        self.right_keys = [self.right_on] if type(self.right_on) == str else self.right_on
+
+        self.index0 = HashIndex(self.left_keys)
+        self.index1 = HashIndex(self.right_keys)
         
         assert how in {"inner", "left",  "semi"}
         self.how = how
-        if how == "inner":
-            self.batch_how = "inner"
-        elif how == "semi":
-            self.batch_how = "semi"
-        elif how == "left":
-            self.batch_how = "inner"
+        self.build_first = build_first
         
         if how == "left" or how =="semi":
-            self.left_null = None
+            # for left, if each row in index0 has matched anything yet. for semi, index0 only has the rows that didn't match when they came,
+            # and this says if they have been emitted since.
+            self.matched0 = np.empty(0, dtype = bool)
             self.first_row_right = None # this is a hack to produce the left join NULLs at the end.
-            self.left_null_last_ckpt = 0
 
-        # keys that will never be seen again, safe to delete from the state on the other side
+        # for inner joins, a side whose other side is done never needs to be indexed again
+        self.finished = set()
+
+        # the streams whose sources should drop rows that fail our runtime_filter. only the left rows of inner and semi joins can go.
+        self.runtime_filter_streams = [0] if how in {"inner", "semi"} else []
+        self.build_done = False
+        self.filter_published = False
+
+        self.spill_bytes = spill_bytes
+        self.spill_partitions = spill_partitions
+        self.data_dir = "/data/"
+        self.file_prefix = file_prefix
+        self.spill_token = None
+        self.spill_runs = 0
+        self.executor_id = None
+        self.spilled = set()
+        # partition -> stream -> files, and the rows waiting to be written
+        self.spill_files = {partition: {0: [], 1: []} for partition in range(spill_partitions)}
+        self.spill_buffers = {partition: {0: [], 1: []} for partition in range(spill_partitions)}
+        self.spill_buffer_rows = 100000
 
         self.state0_last_ckpt = 0
         self.state1_last_ckpt = 0
@@ -303,15 +582,15 @@ class JoinExecutor(Executor):
         if self.s3fs is None:
             self.s3fs = S3FileSystem()
 
-        if self.state0 is not None:
-            state0_to_ckpt = self.state0[self.state0_last_ckpt : ]
+        if self.index0.table is not None:
+            state0_to_ckpt = self.index0.table[self.state0_last_ckpt : ]
             self.state0_last_ckpt += len(state0_to_ckpt)
-            pq.write_table(self.state0.to_arrow(), bucket + "/" + str(actor_id) + "-" + str(channel_id) + "-" + str(seq) + "-0.parquet", filesystem=self.s3fs)
+            pq.write_table(self.index0.table.to_arrow(), bucket + "/" + str(actor_id) + "-" + str(channel_id) + "-" + str(seq) + "-0.parquet", filesystem=self.s3fs)
 
-        if self.state1 is not None:
-            state1_to_ckpt = self.state1[self.state1_last_ckpt : ]
+        if self.index1.table is not None:
+            state1_to_ckpt = self.index1.table[self.state1_last_ckpt : ]
             self.state1_last_ckpt += len(state1_to_ckpt)
-            pq.write_table(self.state1.to_arrow(), bucket + "/" + str(actor_id) + "-" + str(channel_id) + "-" + str(seq) + "-1.parquet", filesystem=self.s3fs)
+            pq.write_table(self.index1.table.to_arrow(), bucket + "/" + str(actor_id) + "-" + str(channel_id) + "-" + str(seq) + "-1.parquet", filesystem=self.s3fs)
         
     
     def restore(self, bucket, actor_id, channel_id, seq):
@@ -319,18 +598,105 @@ class JoinExecutor(Executor):
         
         if self.s3fs is None:
             self.s3fs = S3FileSystem()
+        self.index0 = HashIndex(self.left_keys)
+        self.index1 = HashIndex(self.right_keys)
         try:
             print(bucket + "/" + str(actor_id) + "-" + str(channel_id) + "-" + str(seq) + "-0.parquet")
-            self.state0 = polars.from_arrow(pq.read_table(bucket + "/" + str(actor_id) + "-" + str(channel_id) + "-" + str(seq) + "-0.parquet", filesystem=self.s3fs))
-            print(self.state0)
+            self.index0.insert(polars.from_arrow(pq.read_table(bucket + "/" + str(actor_id) + "-" + str(channel_id) + "-" + str(seq) + "-0.parquet", filesystem=self.s3fs)))
         except:
-            self.state0 = None
+            pass
         try:
             print(bucket + "/" + str(actor_id) + "-" + str(channel_id) + "-" + str(seq) + "-1.parquet")
-            self.state1 = polars.from_arrow(pq.read_table(bucket + "/" + str(actor_id) + "-" + str(channel_id) + "-" + str(seq) + "-1.parquet", filesystem=self.s3fs))
-            print(self.state1)
+            self.index1.insert(polars.from_arrow(pq.read_table(bucket + "/" + str(actor_id) + "-" + str(channel_id) + "-" + str(seq) + "-1.parquet", filesystem=self.s3fs)))
         except:
-            self.state1 = None
+            pass
+
+        if self.how == "left" or self.how == "semi":
+            self.matched0 = np.zeros(len(self.index0), dtype = bool)
+            if len(self.index0) > 0:
+                self.matched0[self.index1.probe(self.index0.table, self.left_keys)[0]] = True
+            if self.how == "left" and len(self.index1) > 0:
+                self.first_row_right = self.index1.table[0]
+
+    def join_rows(self, left, left_rows, right, right_rows):
+        # same columns as polars' join: all of the left, then the right without its keys, suffixed if the name is taken
+        left = left[left_rows]
+        right = right[right_rows].drop(self.right_keys)
+        right.columns = [col + self.suffix if col in left.columns else col for col in right.columns]
+        return left.hstack(right)
+
+    def spill_partition_ids(self, frame, keys):
+        # seeded differently from the partitioner that sent us the rows, else they would all land in the same partitions
+        return hash_keys(frame, keys, 7, 11, 13, 17) % self.spill_partitions
+
+    def memory_bytes(self):
+        return self.index0.nbytes() + self.index1.nbytes()
+
+    def write_spill(self, stream_id, partition, frame, flush = False):
+        buffer = self.spill_buffers[partition][stream_id]
+        if frame is not None and len(frame) > 0:
+            buffer.append(frame)
+        if len(buffer) == 0 or (not flush and sum(len(i) for i in buffer) < self.spill_buffer_rows):
+            return
+        filename = self.data_dir + self.file_prefix + "-" + self.spill_token + "-" + str(self.executor_id) + "-" + str(partition) + "-" + \
+            str(stream_id) + "-" + str(self.spill_runs) + ".arrow"
+        self.spill_runs += 1
+        polars.concat(buffer).write_ipc(filename)
+        self.spill_files[partition][stream_id].append(filename)
+        self.spill_buffers[partition][stream_id] = []
+
+    def spill_rows(self, stream_id, frame, partitions, old, matched = None):
+        # __old__ rows were in memory together with the other side's old rows, so they have been joined with each other already
+        frame = frame.with_column(polars.lit(old).alias("__old__"))
+        if stream_id == 0 and self.how == "left":
+            frame = frame.with_column(polars.Series("__matched__", matched if matched is not None else np.zeros(len(frame), dtype = bool)))
+        for partition in np.unique(partitions):
+            self.write_spill(stream_id, partition, take_rows(frame, np.flatnonzero(partitions == partition)))
+
+    def spill(self):
+
+        if self.spill_token is None:
+            self.spill_token = uuid.uuid4().hex[:8]
+
+        parts0 = self.spill_partition_ids(self.index0.table, self.left_keys) if len(self.index0) > 0 else np.empty(0, dtype = np.uint64)
+        parts1 = self.spill_partition_ids(self.index1.table, self.right_keys) if len(self.index1) > 0 else np.empty(0, dtype = np.uint64)
+        row_bytes0 = self.index0.nbytes() / len(self.index0) if len(self.index0) > 0 else 0
+        row_bytes1 = self.index1.nbytes() / len(self.index1) if len(self.index1) > 0 else 0
+        sizes = np.bincount(parts0.astype(np.int64), minlength = self.spill_partitions) * row_bytes0 + \
+            np.bincount(parts1.astype(np.int64), minlength = self.spill_partitions) * row_bytes1
+
+        # spill the biggest partitions until we are down to half the budget, so the next spill isn't right away.
+        # every partition can go, then nothing is joined in memory anymore and memory stays at the spill buffers, so we never come back here for nothing.
+        remaining = sizes.sum()
+        for partition in np.argsort(-sizes):
+            if remaining <= self.spill_bytes / 2:
+                break
+            if partition not in self.spilled and sizes[partition] > 0:
+                self.spilled.add(partition)
+                remaining -= sizes[partition]
+
+        spilled = np.array(sorted(self.spilled), dtype = np.uint64)
+        for stream_id, index, parts in [(0, self.index0, parts0), (1, self.index1, parts1)]:
+            if len(index) == 0:
+                continue
+            spill_mask = np.isin(parts, spilled)
+            keep = np.flatnonzero(~spill_mask)
+            out = np.flatnonzero(spill_mask)
+            if stream_id == 0 and self.how == "semi":
+                # rows already emitted are done with
+                out = out[~self.matched0[out]]
+            if len(out) > 0:
+                self.spill_rows(stream_id, index.table[out], parts[out], True, self.matched0[out] if stream_id == 0 and self.how == "left" else None)
+
+            new_index = HashIndex(index.keys)
+            if len(keep) > 0:
+                new_index.insert(index.table[keep])
+            if stream_id == 0:
+                self.index0 = new_index
+                if self.how == "left" or self.how == "semi":
+                    self.matched0 = self.matched0[keep]
+            else:
+                self.index1 = new_index
 
     # the execute function signature does not change. stream_id will be a [0 - (length of InputStreams list - 1)] integer
     def execute(self,batches, stream_id, executor_id):
@@ -339,9 +705,21 @@ class JoinExecutor(Executor):
         if len(batches) == 0:
             return
         batch = polars.concat(batches)
+        self.executor_id = executor_id
 
         result = None
-        new_left_null = None
+
+        if len(self.spilled) > 0:
+            # rows of spilled partitions join at the end
+            parts = self.spill_partition_ids(batch, self.left_keys if stream_id == 0 else self.right_keys)
+            spill_mask = np.isin(parts, np.array(sorted(self.spilled), dtype = np.uint64))
+            if spill_mask.any():
+                if stream_id == 1 and self.how == "left" and self.first_row_right is None:
+                    self.first_row_right = batch[0]
+                self.spill_rows(stream_id, batch[np.flatnonzero(spill_mask)], parts[spill_mask], False)
+                if spill_mask.all():
+                    return
+                batch = batch[np.flatnonzero(~spill_mask)]
 
         # if random.random() > 0.9 and redis.Redis('172.31.54.141',port=6800).get("input_already_failed") is None:
         #     redis.Redis('172.31.54.141',port=6800).set("input_already_failed", 1)
@@ -350,75 +728,155 @@ class JoinExecutor(Executor):
         #     redis.Redis('localhost',port=6800).set("input_already_failed", 1)
         #     ray.actor.exit_actor()
 
-        if stream_id == 0:
-            if self.state1 is not None:
-                result = batch.join(self.state1,left_on = self.left_on, right_on = self.right_on ,how=self.batch_how, suffix=self.suffix)
-                if self.how == "left" or self.how == "semi":
-                    new_left_null = batch.join(self.state1, left_on = self.left_on, right_on= self.right_on, how = "anti", suffix = self.suffix)
+        if stream_id == 0 and self.build_first:
+            # the right side is complete, so every row gets its final answer now
+            batch_rows, rows1 = self.index1.probe(batch, self.left_keys)
+            if self.how == "semi":
+                result = take_rows(batch, np.unique(batch_rows))
             else:
-                if self.how == "left" or self.how == "semi":
-                    new_left_null = batch
-
-            if self.how != "semi":
-                if self.state0 is None:
-                    self.state0 = batch
-                else:
-                    self.state0.vstack(batch, in_place = True)
-
-            if (self.how == "left" or self.how == "semi") and new_left_null is not None and len(new_left_null) > 0:
-                if self.left_null is None:
-                    self.left_null = new_left_null
-                else:
-                    self.left_null.vstack(new_left_null, in_place= True)
+                result = self.join_rows(batch, batch_rows, self.index1.table, rows1) if len(batch_rows) > 0 else None
+                if self.how == "left":
+                    unmatched = np.ones(len(batch), dtype = bool)
+                    unmatched[batch_rows] = False
+                    if unmatched.any():
+                        assert self.first_row_right is not None, "empty RHS"
+                        left_null = batch[np.flatnonzero(unmatched)].join(self.first_row_right, left_on= self.left_on, right_on= self.right_on, how = "left", suffix = self.suffix)
+                        result = left_null if result is None else polars.concat([result, left_null])
+
+        elif stream_id == 0:
+            batch_rows, rows1 = self.index1.probe(batch, self.left_keys)
+            if self.how == "semi":
+                matched = np.unique(batch_rows)
+                result = take_rows(batch, matched)
+                unmatched = np.ones(len(batch), dtype = bool)
+                unmatched[matched] = False
+                self.index0.insert(take_rows(batch, np.flatnonzero(unmatched)))
+                self.matched0 = np.concatenate([self.matched0, np.zeros(len(batch) - len(matched), dtype = bool)])
+            else:
+                result = self.join_rows(batch, batch_rows, self.index1.table, rows1) if len(batch_rows) > 0 else None
+                if self.how == "left":
+                    matched = np.zeros(len(batch), dtype = bool)
+                    matched[batch_rows] = True
+                    self.matched0 = np.concatenate([self.matched0, matched])
+                if self.how != "inner" or 1 not in self.finished:
+                    self.index0.insert(batch)
              
         elif stream_id == 1:
 
-            if self.state0 is not None and self.how != "semi":
-                result = self.state0.join(batch,left_on = self.left_on, right_on = self.right_on ,how=self.batch_how, suffix=self.suffix)
-            
-            if self.how == "semi" and self.left_null is not None:
-                result = self.left_null.join(batch, left_on = self.left_on, right_on = self.right_on, how = "semi", suffix = self.suffix)
-            
-            if (self.how == "left" or self.how == "semi") and self.left_null is not None:
-                self.left_null = self.left_null.join(batch, left_on = self.left_on, right_on = self.right_on, how = "anti", suffix = self.suffix)
-
-            if self.state1 is None:
-                if self.how == "left":
-                    self.first_row_right = batch[0]
-                self.state1 = batch
+            batch_rows, rows0 = self.index0.probe(batch, self.right_keys)
+            if self.how == "semi":
+                new = np.unique(rows0[~self.matched0[rows0]])
+                if len(new) > 0:
+                    result = self.index0.table[new]
+                    self.matched0[new] = True
             else:
-                self.state1.vstack(batch, in_place = True)
+                result = self.join_rows(self.index0.table, rows0, batch, batch_rows) if len(rows0) > 0 else None
+                if self.how == "left":
+                    self.matched0[rows0] = True
+
+            if self.how == "left" and self.first_row_right is None:
+                self.first_row_right = batch[0]
+            if self.how != "inner" or 0 not in self.finished:
+                self.index1.insert(batch)
+
+        if self.spill_bytes is not None and self.memory_bytes() > self.spill_bytes:
+            self.spill()
 
         if result is not None and len(result) > 0:
             return result
     
+    def runtime_filter(self):
+        # once the right side is complete, the runtime can hand this to the left side's sources, once.
+        # a spilled right side isn't all in index1, so then it's a filter that passes everything, or the sources would wait for one forever.
+        if len(self.runtime_filter_streams) == 0 or not self.build_done or self.filter_published:
+            return None
+        self.filter_published = True
+        runtime_filter = RuntimeFilter(self.left_keys)
+        if len(self.spilled) > 0:
+            return runtime_filter.pass_all()
+        if len(self.index1) > 0:
+            runtime_filter.add(self.index1.table, self.right_keys)
+        return runtime_filter
+
     def update_sources(self, remaining_sources):
         #print(remaining_sources)
+        if 1 not in remaining_sources:
+            self.build_done = True
         if self.how == "inner":
             if 0 not in remaining_sources:
                 #print("DROPPING STATE!")
-                self.state1 = None
+                self.finished.add(0)
+                self.index1 = HashIndex(self.right_keys)
             if 1 not in remaining_sources:
                 #print("DROPPING STATE!")
-                self.state0 = None
+                self.finished.add(1)
+                self.index0 = HashIndex(self.left_keys)
+    
+    def join_spilled(self, partition):
+
+        frames = {}
+        for stream_id in [0, 1]:
+            self.write_spill(stream_id, partition, None, flush = True)
+            files = self.spill_files[partition][stream_id]
+            frames[stream_id] = polars.concat([polars.read_ipc(filename) for filename in files]) if len(files) > 0 else None
+            for filename in files:
+                os.remove(filename)
+        left, right = frames[0], frames[1]
+        
+        if self.how == "semi":
+            if left is not None and right is not None:
+                # old rows of the left that are still here never matched an old row of the right
+                yield left.join(right.drop("__old__"), left_on = self.left_on, right_on = self.right_on, how = "semi").drop("__old__")
+            return
+
+        if left is None or (right is None and self.how == "inner"):
+            return
+
+        matched_rows = polars.Series("__row__", [], dtype = polars.UInt32)
+        left = left.with_row_count("__row__")
+        if right is not None:
+            pairs = left.join(right.rename({"__old__": "__old_right__"}), left_on = self.left_on, right_on = self.right_on, how = "inner", suffix = self.suffix)
+            pairs = pairs.filter(~(polars.col("__old__") & polars.col("__old_right__")))
+            matched_rows = pairs["__row__"]
+            yield pairs.drop([col for col in ["__row__", "__old__", "__old_right__", "__matched__"] if col in pairs.columns])
+        
+        if self.how == "left":
+            left_null = left.filter(~polars.col("__matched__") & ~polars.col("__row__").is_in(matched_rows)).drop(["__row__", "__old__", "__matched__"])
+            if len(left_null) > 0:
+                assert self.first_row_right is not None, "empty RHS"
+                yield left_null.join(self.first_row_right, left_on= self.left_on, right_on= self.right_on, how = "left", suffix = self.suffix)
+
+    def done_spilled(self, in_memory):
+        if in_memory is not None:
+            yield in_memory
+        for partition in sorted(self.spilled):
+            for result in self.join_spilled(partition):
+                if len(result) > 0:
+                    yield result
     
     def done(self,executor_id):
         #print(len(self.state0),len(self.state1))
         #print("done join ", executor_id)
-        if self.how == "left" and self.left_null is not None and len(self.left_null) > 0:
+        result = None
+        if self.how == "left" and len(self.index0) > 0 and not self.matched0.all():
             assert self.first_row_right is not None, "empty RHS"
-            return self.left_null.join(self.first_row_right, left_on= self.left_on, right_on= self.right_on, how = "left", suffix = self.suffix)
+            left_null = self.index0.table[np.flatnonzero(~self.matched0)]
+            result = left_null.join(self.first_row_right, left_on= self.left_on, right_on= self.right_on, how = "left", suffix = self.suffix)
 
-        # print("DONE", executor_id)
+        if len(self.spilled) > 0:
+            return self.done_spilled(result)
+        return result
 
 
 class AntiJoinExecutor(Executor):
     # batch func here expects a list of dfs. This is a quark of the fact that join results could be a list of dfs.
     # batch func must return a list of dfs too
-    def __init__(self, on = None, left_on = None, right_on = None, suffix="_right"):
+    def __init__(self, on = None, left_on = None, right_on = None, suffix="_right", build_first = False):
 
         self.left_null = None
         self.state1 = None
+        # if the runtime drains stream 1 first, left rows can be answered right away
+        self.build_first = build_first
         self.ckpt_start0 = 0
         self.ckpt_start1 = 0
         self.suffix = suffix
@@ -446,7 +904,12 @@ class AntiJoinExecutor(Executor):
 
         new_left_null = None
 
-        if stream_id == 0:
+        if stream_id == 0 and self.build_first:
+            result = batch.join(self.state1, left_on = self.left_on, right_on= self.right_on, how = "anti", suffix = self.suffix) if self.state1 is not None else batch
+            if len(result) > 0:
+                return result
+
+        elif stream_id == 0:
             if self.state1 is not None:
                 new_left_null = batch.join(self.state1, left_on = self.left_on, right_on= self.right_on, how = "anti", suffix = self.suffix)
             else:
@@ -474,11 +937,160 @@ class AntiJoinExecutor(Executor):
             for i in range(0, len(self.left_null), self.batch_size):
                 yield self.left_null[i: i + self.batch_size]
 
-class DistinctExecutor(Executor):
-    def __init__(self, keys) -> None:
+class SortMergeJoinExecutor(Executor):
+    # both streams come sorted on their join key: every batch of a stream has keys no smaller than the batches before it.
+    # a key below the latest key of every stream that isn't done can't come again, so the rows with such keys are joined and dropped right away.
+    # only the rows at or past that key are kept, which is about a batch per stream unless one stream gets far ahead of the other.
+    # batches don't have to be sorted inside, only against each other, which is what a sorted Parquet reader gives.
+    def __init__(self, on = None, left_on = None, right_on = None, suffix="_right", how = "inner", right_schema = None):
 
-        self.keys = keys
-        self.state = None
+        self.suffix = suffix
+        # the right columns of a left join, in case the right stream never sends a row. An empty batch of it once it sent anything.
+        self.right_schema = right_schema
+        self.right_template = None
+
+        if on is not None:
+            assert left_on is None and right_on is None
+            self.left_on = on
+            self.right_on = on
+        else:
+            assert left_on is not None and right_on is not None
+            self.left_on = left_on
+            self.right_on = right_on
+        self.keys = {0: self.left_on, 1: self.right_on}
+
+        assert how in {"inner", "left", "semi", "anti"}
+        self.how = how
+
+        # rows of each stream with keys at or past the watermark, sorted
+        self.state = {0: None, 1: None}
+        # the largest key seen on each stream
+        self.high = {0: None, 1: None}
+        self.watermark = None
+        self.finished = set()
+        # left rows with null keys never match anything
+        self.left_null = None
+
+    def checkpoint(self, conn, actor_id, channel_id, seq):
+        pass
+    
+    def restore(self, conn, actor_id, channel_id, seq):
+        pass
+
+    def join(self, left, right):
+        if left is None or len(left) == 0:
+            return None
+        if right is None:
+            # nothing at all came from the right
+            if self.how == "inner" or self.how == "semi":
+                return None
+            if self.how == "anti":
+                return left
+            return self.null_right(left)
+        result = left.join(right, left_on = self.left_on, right_on = self.right_on, how = self.how, suffix = self.suffix)
+        if len(result) > 0:
+            return result
+
+    def null_right(self, left):
+        # what a left join with nothing on the right gives: the right columns, except the key, all null
+        if self.right_template is not None:
+            columns = [(col, self.right_template[col].dtype) for col in self.right_template.columns]
+        else:
+            assert self.right_schema is not None, "don't know the right columns of the left join"
+            columns = [(col, None) for col in self.right_schema]
+        nulls = []
+        for col, dtype in columns:
+            if col == self.right_on:
+                continue
+            name = col + self.suffix if col in left.columns else col
+            nulls.append((polars.lit(None) if dtype is None else polars.lit(None).cast(dtype)).alias(name))
+        return left.with_columns(nulls)
+
+    def advance(self):
+        highs = [self.high[i] for i in (0, 1) if i not in self.finished]
+        # a stream that hasn't sent anything yet could still send any key
+        if len(highs) == 0 or any(high is None for high in highs):
+            return None
+        watermark = min(highs)
+        if self.watermark is not None and watermark <= self.watermark:
+            return None
+        self.watermark = watermark
+
+        below = {}
+        for i in (0, 1):
+            if self.state[i] is None:
+                below[i] = None
+                continue
+            # the number of keys below the watermark. search_sorted can land anywhere in a run of keys equal to it
+            split = int((self.state[i][self.keys[i]] < watermark).to_numpy().sum())
+            below[i] = self.state[i][:split]
+            self.state[i] = self.state[i][split:]
+        return self.join(below[0], below[1])
+
+    # the execute function signature does not change. stream_id will be a [0 - (length of InputStreams list - 1)] integer
+    def execute(self,batches, stream_id, executor_id):
+        batches = [i for i in batches if i is not None and len(i) > 0]
+        if len(batches) == 0:
+            return
+        key = self.keys[stream_id]
+        batch = polars.concat(batches)
+        if stream_id == 1 and self.right_template is None:
+            self.right_template = batch[:0]
+
+        nulls = batch.filter(polars.col(key).is_null())
+        if stream_id == 0 and (self.how == "left" or self.how == "anti") and len(nulls) > 0:
+            self.left_null = nulls if self.left_null is None else self.left_null.vstack(nulls)
+        batch = batch.filter(polars.col(key).is_not_null()).sort(key)
+        if len(batch) == 0:
+            return
+
+        if self.high[stream_id] is not None and batch[key][0] < self.high[stream_id]:
+            raise Exception("SortMergeJoinExecutor got stream " + str(stream_id) + " out of order on " + str(key))
+        self.high[stream_id] = batch[key][-1]
+        if self.state[stream_id] is None:
+            self.state[stream_id] = batch
+        else:
+            self.state[stream_id] = self.state[stream_id].vstack(batch)
+        
+        return self.advance()
+
+    def update_sources(self, remaining_sources):
+        for i in (0, 1):
+            if i not in remaining_sources:
+                self.finished.add(i)
+
+    def done(self,executor_id):
+        result = self.join(self.state[0], self.state[1])
+        if self.left_null is not None:
+            # the right side's columns, all null
+            right = self.state[1][:0] if self.state[1] is not None else None
+            left_null = self.join(self.left_null, right)
+            result = left_null if result is None else polars.concat([result, left_null])
+        return result
+
+class DistinctExecutor(Executor):
+    # the distinct keys seen so far are a KeySet, so a batch costs O(batch log n) no matter how many keys came before.
+    # past spill_bytes the biggest of spill_partitions hash partitions of the set go to /data/, and rows of those partitions that come later
+    # go straight to disk too. done() then goes through the spilled partitions one at a time, so those rows come out at the end.
+    # a spilled partition is done by a DistinctExecutor of the next level, which partitions differently, so it spills again if it has to.
+    def __init__(self, keys, spill_bytes = 4 * 1024 ** 3, spill_partitions = 16, file_prefix = "distinct", exact = False, level = 0) -> None:
+
+        self.keys = [keys] if type(keys) == str else keys
+        self.exact = exact
+        self.level = level
+        self.state = KeySet(self.keys, exact)
+
+        self.spill_bytes = spill_bytes
+        self.spill_partitions = spill_partitions
+        self.data_dir = "/data/"
+        self.file_prefix = file_prefix
+        self.spill_token = None
+        self.spill_runs = 0
+        self.spilled = set()
+        # partition -> the files of the spilled set and of the rows that came after, and the rows waiting to be written
+        self.spill_files = {partition: {"seen": [], "rows": []} for partition in range(spill_partitions)}
+        self.spill_buffers = {partition: [] for partition in range(spill_partitions)}
+        self.spill_buffer_rows = 100000
     
     def checkpoint(self, conn, actor_id, channel_id, seq):
         pass
@@ -486,60 +1098,183 @@ class DistinctExecutor(Executor):
     def restore(self, conn, actor_id, channel_id, seq):
         pass
 
+    def write_spill(self, executor_id, partition, table, frame, flush = False):
+        if table == "rows":
+            if frame is not None and len(frame) > 0:
+                self.spill_buffers[partition].append(frame)
+            buffer = self.spill_buffers[partition]
+            if len(buffer) == 0 or (not flush and sum(len(i) for i in buffer) < self.spill_buffer_rows):
+                return
+            frame = polars.concat(buffer)
+            self.spill_buffers[partition] = []
+        filename = self.data_dir + self.file_prefix + "-" + self.spill_token + "-" + str(executor_id) + "-" + str(partition) + "-" + \
+            table + "-" + str(self.spill_runs) + ".arrow"
+        self.spill_runs += 1
+        frame.write_ipc(filename)
+        self.spill_files[partition][table].append(filename)
+
+    def spill(self, executor_id):
+
+        if self.spill_token is None:
+            self.spill_token = uuid.uuid4().hex[:8]
+
+        high, low, rows = self.state.entries()
+        parts = KeySet.partitions(high, self.spill_partitions, self.level)
+        sizes = np.bincount(parts, minlength = self.spill_partitions) * (self.state.nbytes() / max(len(self.state), 1))
+
+        # spill the biggest partitions until we are down to half the budget, so the next spill isn't right away.
+        # every partition can go, then the set is empty and stays that way, so we never come back here for nothing.
+        remaining = sizes.sum()
+        new_spilled = []
+        for partition in np.argsort(-sizes):
+            if remaining <= self.spill_bytes / 2:
+                break
+            if partition not in self.spilled and sizes[partition] > 0:
+                self.spilled.add(partition)
+                new_spilled.append(partition)
+                remaining -= sizes[partition]
+        if len(new_spilled) == 0:
+            return
+        
+        removed = self.state.remove_partitions(new_spilled, self.spill_partitions, self.level)
+        removed_parts = KeySet.partitions(removed["__high__"].to_numpy(), self.spill_partitions, self.level)
+        for partition in new_spilled:
+            self.write_spill(executor_id, partition, "seen", take_rows(removed, np.flatnonzero(removed_parts == partition)))
+
     def execute(self, batches, stream_id, executor_id):
         
         batches = [i for i in batches if i is not None and len(i) > 0]
         if len(batches) == 0:
             return
         batch = polars.concat(batches)
-        batch = batch.unique()
 
-        if self.state is None:
-            self.state = batch
-            return batch
-        else:
-            contribution = batch.join(self.state, on = self.keys, how="anti")
-            self.state.vstack(contribution, in_place = True)
+        if len(self.spilled) > 0:
+            parts = KeySet.partitions(self.state.fingerprints(batch)[0], self.spill_partitions, self.level)
+            spill_mask = np.isin(parts, np.array(sorted(self.spilled), dtype = np.int64))
+            for partition in np.unique(parts[spill_mask]):
+                self.write_spill(executor_id, partition, "rows", batch[np.flatnonzero(parts == partition)])
+            if spill_mask.all():
+                return
+            batch = batch[np.flatnonzero(~spill_mask)]
+
+        contribution = self.state.add(batch)
+
+        if self.spill_bytes is not None and self.state.nbytes() > self.spill_bytes:
+            self.spill(executor_id)
+        
+        if len(contribution) > 0:
             return contribution
     
-    def serialize(self):
-        return {0:self.seen}, "all"
-    
-    def deserialize(self, s):
-        # the default is to get a list of things 
-        assert type(s) == list and len(s) == 1
-        self.seen = s[0][0]
+    def load(self, executor_id, frame):
+        # keys that already came out, from a spilled partition of the level before
+        if len(self.spilled) > 0:
+            parts = KeySet.partitions(frame["__high__"].to_numpy(), self.spill_partitions, self.level)
+            spill_mask = np.isin(parts, np.array(sorted(self.spilled), dtype = np.int64))
+            for partition in np.unique(parts[spill_mask]):
+                self.write_spill(executor_id, partition, "seen", frame[np.flatnonzero(parts == partition)])
+            frame = take_rows(frame, np.flatnonzero(~spill_mask))
+        self.state.load(frame)
+        if self.spill_bytes is not None and self.state.nbytes() > self.spill_bytes:
+            self.spill(executor_id)
+
+    def done_spilled(self, executor_id):
+        for partition in sorted(self.spilled):
+            self.write_spill(executor_id, partition, "rows", None, flush = True)
+            if len(self.spill_files[partition]["rows"]) == 0:
+                # no rows came after the spill, so nothing new can come out of this partition
+                for filename in self.spill_files[partition]["seen"]:
+                    os.remove(filename)
+                self.spill_files[partition] = {"seen": [], "rows": []}
+                continue
+            child = DistinctExecutor(self.keys, self.spill_bytes, self.spill_partitions, self.file_prefix, self.exact, self.level + 1)
+            for filename in self.spill_files[partition]["seen"]:
+                child.load(executor_id, polars.read_ipc(filename))
+                os.remove(filename)
+            for filename in self.spill_files[partition]["rows"]:
+                contribution = child.execute([polars.read_ipc(filename)], 0, executor_id)
+                os.remove(filename)
+                if contribution is not None:
+                    yield contribution
+            self.spill_files[partition] = {"seen": [], "rows": []}
+            remaining = child.done(executor_id)
+            if remaining is not None:
+                yield from remaining
     
     def done(self, executor_id):
+        if len(self.spilled) > 0:
+            return self.done_spilled(executor_id)
         return
 
 class AggExecutor(Executor):
     '''
-    aggregation_dict will define what you are going to do for
+    aggregation_dict will define what you are going to do for each input column. The state is a table with one row per group holding
+    the running accumulator of every column. Merging a batch into it rehashes the whole state, so batches wait in self.pending until
+    there are at least as many pending rows as groups (and at least merge_rows). Then the work per input row stays constant and memory is
+    proportional to the number of groups, not the number of rows seen.
+
+    Three accumulators don't fold into one number per group:
+    - count_distinct columns come in as lists of the distinct values of each group, and are kept as the distinct (keys, value) pairs.
+    - approx_count_distinct columns come in as the HyperLogLog codes of each group (see sketches.py), and are kept as a (keys, register, code)
+      row for every nonzero register, the biggest code seen. Both are buffered and merged like the state.
+    - ("quantile", q) columns come in as KLL sketches, and are kept as one sketch per group, merged as they arrive.
+
+    If the groups don't fit in spill_bytes, the state goes to disk as spill_partitions hash partitions, and done() yields one partition at a time.
     '''
-    def __init__(self, groupby_keys, orderby_keys, aggregation_dict, mean_cols, count):
-
+    def __init__(self, groupby_keys, orderby_keys, aggregation_dict, mean_cols, count, spill_bytes = 4 * 1024 ** 3, spill_partitions = 16, file_prefix = "agg"):
 
         self.state = None
+        self.key_dtypes = None
+        self.pending = []
+        self.pending_rows = 0
+        # bytes of the state and pending together, counted as frames come in and measured again only on what a merge makes
+        self.state_bytes = 0
         self.emit_count = count
         assert type(groupby_keys) == list and len(groupby_keys) > 0
         self.groupby_keys = groupby_keys
         self.aggregation_dict = aggregation_dict
         self.mean_cols = mean_cols
-        self.length_limit = 1000000
+        # small, so with few groups we don't sit on many rows, but big enough that a merge isn't all overhead
+        self.merge_rows = 10000
         # hope and pray there is no column called __&&count__
-        self.pyarrow_agg_list = [("__count_sum", "sum")]
         self.count_col = "__count_sum"
-        self.rename_dict = {"__count_sum_sum": self.count_col}
+        # (column, polars aggregation that merges two partial results of it)
+        self.merge_list = [(self.count_col, "sum")]
+        self.distinct_cols = []
+        self.quantile_cols = {}
+        self.hll_cols = []
         for key in aggregation_dict:
+            if type(aggregation_dict[key]) == tuple:
+                assert aggregation_dict[key][0] == "quantile" and 0 <= aggregation_dict[key][1] <= 1
+                self.quantile_cols[key] = aggregation_dict[key][1]
+                continue
             assert aggregation_dict[key] in {
-                    "max", "min", "mean", "sum"}, "only support max, min, mean and sum for now"
-            if aggregation_dict[key] == "mean":
-                self.pyarrow_agg_list.append((key, "sum"))
-                self.rename_dict[key + "_sum"] = key
+                    "max", "min", "mean", "sum", "count_distinct", "approx_count_distinct"}, "only support max, min, mean, sum, count_distinct, approx_count_distinct and quantile for now"
+            if aggregation_dict[key] == "approx_count_distinct":
+                self.hll_cols.append(key)
+            elif aggregation_dict[key] == "count_distinct":
+                self.distinct_cols.append(key)
+            elif aggregation_dict[key] == "mean":
+                self.merge_list.append((key, "sum"))
             else:
-                self.pyarrow_agg_list.append((key, aggregation_dict[key]))
-                self.rename_dict[key + "_" + aggregation_dict[key]] = key
+                self.merge_list.append((key, aggregation_dict[key]))
+
+        # the distinct pairs of count_distinct columns and the register codes of approx_count_distinct columns
+        self.distinct_state = {key: None for key in self.distinct_cols + self.hll_cols}
+        self.distinct_pending = {key: [] for key in self.distinct_cols + self.hll_cols}
+        self.distinct_pending_rows = {key: 0 for key in self.distinct_cols + self.hll_cols}
+        self.distinct_bytes = {key: 0 for key in self.distinct_cols + self.hll_cols}
+        self.sketch_cols = list(self.quantile_cols.keys())
+        self.sketches = {key: {} for key in self.sketch_cols}
+
+        # past spill_bytes of state, it's hash partitioned into runs on disk. done merges them one partition at a time.
+        self.spill_bytes = spill_bytes
+        self.spill_partitions = spill_partitions
+        self.data_dir = "/data/"
+        self.file_prefix = file_prefix
+        # set at the first spill, so two aggregations on the same machine don't write the same files
+        self.spill_token = None
+        self.spill_runs = 0
+        self.spill_files = {partition: [] for partition in range(spill_partitions)}
         
         self.order_list = []
         self.reverse_list = []
@@ -555,53 +1290,226 @@ class AggExecutor(Executor):
         pass
 
     def serialize(self):
-        return {0:self.state}, "all"
+        # the state, then the distinct_state of every distinct_cols and hll_cols column, then the sketches of every sketch_cols column
+        self.merge()
+        result = {0:self.state}
+        distinct_cols = self.distinct_cols + self.hll_cols
+        for i, key in enumerate(distinct_cols):
+            result[1 + i] = self.distinct_state[key]
+        for i, key in enumerate(self.sketch_cols):
+            result[1 + len(distinct_cols) + i] = self.sketch_table(key) if self.key_dtypes is not None else None
+        return result, "all"
     
     def deserialize(self, s):
         # the default is to get a list of dictionaries.
         assert type(s) == list and len(s) == 1
         self.state = s[0][0]
+        if self.state is not None:
+            self.key_dtypes = {col: self.state[col].dtype for col in self.groupby_keys}
+            self.state_bytes = self.state.estimated_size()
+        distinct_cols = self.distinct_cols + self.hll_cols
+        for i, key in enumerate(distinct_cols):
+            self.distinct_state[key] = s[0][1 + i]
+            self.distinct_bytes[key] = 0 if self.distinct_state[key] is None else self.distinct_state[key].estimated_size()
+        for i, key in enumerate(self.sketch_cols):
+            self.sketches[key] = {}
+            frame = s[0][1 + len(distinct_cols) + i]
+            if frame is not None:
+                self.merge_sketches(self.sketches[key], key, frame)
+
+    def sketch_table(self, key):
+        # the sketches of a column as a frame like the ones they come in, one row per group
+        return self.sketch_frame(key, self.sketches[key], KLLSketch.to_list, polars.List(polars.Float64))
+
+    def merge_sketches(self, sketches, key, batch):
+        groups = zip(*[batch[col].to_list() for col in self.groupby_keys])
+        for group, values in zip(groups, batch[key].to_list()):
+            if values is None:
+                continue
+            sketch = KLLSketch.from_list(values)
+            if group in sketches:
+                sketches[group].merge(sketch)
+            else:
+                sketches[group] = sketch
+
+    def sketch_frame(self, key, sketches, values, dtype):
+        groups = list(sketches.keys())
+        return polars.DataFrame([polars.Series(col, [group[i] for group in groups], dtype = self.key_dtypes[col]) for i, col in enumerate(self.groupby_keys)] + 
+            [polars.Series(key, [values(sketch) for sketch in sketches.values()], dtype = dtype)])
+
+    def merge(self, force = True):
+        
+        if len(self.pending) > 0 and (force or self.pending_rows >= max(self.merge_rows, 0 if self.state is None else len(self.state))):
+            frames = self.pending if self.state is None else [self.state] + self.pending
+            self.state = polars.concat(frames).groupby(self.groupby_keys).agg(
+                [getattr(polars.col(col), agg)().alias(col) for col, agg in self.merge_list])
+            self.pending = []
+            self.pending_rows = 0
+            self.state_bytes = self.state.estimated_size()
+
+        for key in self.distinct_cols + self.hll_cols:
+            state = self.distinct_state[key]
+            if len(self.distinct_pending[key]) > 0 and (force or self.distinct_pending_rows[key] >= max(self.merge_rows, 0 if state is None else len(state))):
+                frames = self.distinct_pending[key] if state is None else [state] + self.distinct_pending[key]
+                self.distinct_state[key] = self.merge_distinct(key, frames)
+                self.distinct_pending[key] = []
+                self.distinct_pending_rows[key] = 0
+                self.distinct_bytes[key] = self.distinct_state[key].estimated_size()
+
+    def merge_distinct(self, key, frames):
+        if len(frames) == 0:
+            return None
+        if key in self.hll_cols:
+            # a code is register << 6 | rank, so the biggest code of a register has the biggest rank
+            return polars.concat(frames).groupby(self.groupby_keys + ["__register__"]).agg(polars.col(key).max())
+        return polars.concat(frames).unique()
+
+    def memory_bytes(self):
+        # a KLL sketch with k = 200 holds about 3k float64
+        return self.state_bytes + sum(self.distinct_bytes.values()) + sum(len(self.sketches[key]) * 4800 for key in self.quantile_cols)
+
+    def spill(self, executor_id):
+
+        # hash partition everything we have into one new run per partition, with a different hash from the partitioner that sent us the rows
+        self.merge()
+        if self.spill_token is None:
+            self.spill_token = uuid.uuid4().hex[:8]
+
+        tables = [("state", None, self.state)] + [("distinct", key, self.distinct_state[key]) for key in self.distinct_cols] + \
+            [("hll", key, self.distinct_state[key]) for key in self.hll_cols] + [("quantile", key, self.sketch_table(key)) for key in self.quantile_cols]
+        for table, key, frame in tables:
+            if frame is None or len(frame) == 0:
+                continue
+            table_name = table if key is None else table + str(list(self.aggregation_dict.keys()).index(key))
+            frame = frame.with_column(polars.Series(name = "__partition__", values = frame.select(self.groupby_keys).hash_rows(7, 11, 13, 17) % self.spill_partitions))
+            for part in frame.partition_by("__partition__"):
+                partition = part["__partition__"][0]
+                filename = self.data_dir + self.file_prefix + "-" + self.spill_token + "-" + str(executor_id) + "-" + str(partition) + "-" + \
+                    table_name + "-" + str(self.spill_runs) + ".arrow"
+                part.drop("__partition__").write_ipc(filename)
+                self.spill_files[partition].append((table, key, filename))
+        
+        self.spill_runs += 1
+        self.state = None
+        self.state_bytes = 0
+        self.distinct_state = {key: None for key in self.distinct_cols + self.hll_cols}
+        self.distinct_bytes = {key: 0 for key in self.distinct_cols + self.hll_cols}
+        self.sketches = {key: {} for key in self.sketch_cols}
     
     # the execute function signature does not change. stream_id will be a [0 - (length of InputStreams list - 1)] integer
     def execute(self,batches, stream_id, executor_id):
 
-        batches = [i for i in batches if i is not None]
+        batches = [i for i in batches if i is not None and len(i) > 0]
+        if len(batches) == 0:
+            return
         batch = polars.concat(batches)
         assert type(batch) == polars.internals.DataFrame, batch # polars add has no index, will have wierd behavior
-        if self.state is None:
-            self.state = batch
-        else:
-            self.state = self.state.vstack(batch)
-        if len(self.state) > self.length_limit:
-            arrow_state = self.state.to_arrow()
-            arrow_state = arrow_state.group_by(self.groupby_keys).aggregate(self.pyarrow_agg_list)
-            self.state = polars.from_arrow(arrow_state).rename(self.rename_dict)
-            self.state = self.state.select(sorted(self.state.columns))
-
-
-    def done(self,executor_id):
-
-        # print("done", time.time())
-
-        if self.state is None:
-            return None
+        if self.key_dtypes is None:
+            self.key_dtypes = {col: batch[col].dtype for col in self.groupby_keys}
+
+        for key in self.distinct_cols:
+            pairs = batch.select(self.groupby_keys + [key]).explode(key)
+            self.distinct_pending[key].append(pairs)
+            self.distinct_pending_rows[key] += len(pairs)
+            self.distinct_bytes[key] += pairs.estimated_size()
+        for key in self.hll_cols:
+            codes = batch.select(self.groupby_keys + [key]).explode(key).filter(polars.col(key).is_not_null())
+            codes = codes.with_column((polars.col(key) // 64).cast(polars.UInt32).alias("__register__")).select(self.groupby_keys + ["__register__", key])
+            self.distinct_pending[key].append(codes)
+            self.distinct_pending_rows[key] += len(codes)
+            self.distinct_bytes[key] += codes.estimated_size()
+        for key in self.sketch_cols:
+            self.merge_sketches(self.sketches[key], key, batch)
+
+        self.pending.append(batch.select(self.groupby_keys + [col for col, agg in self.merge_list]))
+        self.pending_rows += len(batch)
+        self.state_bytes += self.pending[-1].estimated_size()
+        self.merge(force = False)
+
+        if self.spill_bytes is not None and self.memory_bytes() > self.spill_bytes:
+            self.spill(executor_id)
+
+    def finalize(self, state, distinct_state, sketches):
         
-        arrow_state = self.state.to_arrow()
-        arrow_state = arrow_state.group_by(self.groupby_keys).aggregate(self.pyarrow_agg_list)
-        self.state = polars.from_arrow(arrow_state).rename(self.rename_dict)
+        for key in self.distinct_cols:
+            counts = distinct_state[key].groupby(self.groupby_keys).agg(polars.col(key).is_not_null().sum().alias(key))
+            state = state.join(counts, on = self.groupby_keys, how = "left")
+
+        for key in self.quantile_cols:
+            q = self.quantile_cols[key]
+            quantiles = self.sketch_frame(key, sketches[key], lambda sketch: sketch.quantile(q), polars.Float64)
+            state = state.join(quantiles, on = self.groupby_keys, how = "left")
+
+        for key in self.hll_cols:
+            # groups without a single non-null value have no registers
+            if distinct_state[key] is None:
+                state = state.with_column(polars.lit(0).cast(polars.Int64).alias(key))
+                continue
+            counts = HyperLogLog.counts(distinct_state[key], self.groupby_keys, key)
+            state = state.join(counts, on = self.groupby_keys, how = "left").with_column(polars.col(key).fill_null(0))
 
         for key in self.aggregation_dict:
             if self.aggregation_dict[key] == "mean":
-                self.state = self.state.with_column(polars.Series(key, self.state[key]/ self.state[self.count_col]))
+                state = state.with_column(polars.Series(key, state[key]/ state[self.count_col]))
         
         for key in self.mean_cols:
             keep_sum = self.mean_cols[key]
-            self.state = self.state.with_column(polars.Series(key + "_mean", self.state[key + "_sum"]/ self.state[self.count_col]))
+            state = state.with_column(polars.Series(key + "_mean", state[key + "_sum"]/ state[self.count_col]))
             if not keep_sum:
-                self.state = self.state.drop(key + "_sum")
+                state = state.drop(key + "_sum")
         
         if not self.emit_count:
-            self.state = self.state.drop(self.count_col)
+            state = state.drop(self.count_col)
+        
+        return state
+
+    def merge_spilled(self, executor_id):
+
+        # what's still in memory becomes the last run, then each partition is small enough to be merged on its own.
+        # with an ordering, the partitions go through an external sort instead of all being kept until the end
+        self.spill(executor_id)
+        sorter = SuperFastSortExecutor(self.order_list, file_prefix = self.file_prefix + "-sort", reverse = self.reverse_list) if len(self.order_list) > 0 else None
+        for partition in range(self.spill_partitions):
+            state = []
+            distinct_state = {key: [] for key in self.distinct_cols + self.hll_cols}
+            sketches = {key: {} for key in self.sketch_cols}
+            for table, key, filename in self.spill_files[partition]:
+                frame = polars.read_ipc(filename)
+                os.remove(filename)
+                if table == "state":
+                    state.append(frame)
+                elif table == "distinct" or table == "hll":
+                    distinct_state[key].append(frame)
+                else:
+                    self.merge_sketches(sketches[key], key, frame)
+            self.spill_files[partition] = []
+            if len(state) == 0:
+                continue
+
+            state = polars.concat(state).groupby(self.groupby_keys).agg(
+                [getattr(polars.col(col), agg)().alias(col) for col, agg in self.merge_list])
+            distinct_state = {key: self.merge_distinct(key, distinct_state[key]) for key in self.distinct_cols + self.hll_cols}
+            result = self.finalize(state, distinct_state, sketches)
+            if sorter is not None:
+                sorter.execute([result], 0, executor_id)
+            else:
+                yield result
+        
+        if sorter is not None:
+            yield from sorter.done(executor_id)
+
+    def done(self,executor_id):
+
+        # print("done", time.time())
+
+        if self.spill_runs > 0:
+            return self.merge_spilled(executor_id)
+
+        self.merge()
+        if self.state is None:
+            return None
+        
+        self.state = self.finalize(self.state, self.distinct_state, self.sketches)
         
         if len(self.order_list) > 0:
             return self.state.sort(self.order_list, self.reverse_list)
@@ -609,21 +1517,142 @@ class AggExecutor(Executor):
             return self.state
 
 
+# gathers everything on one channel and emits it sorted when done, for the final ordering of a parallel aggregation.
+class SortedGatherExecutor(Executor):
+    def __init__(self, orderby_keys) -> None:
+        self.state = []
+        self.order_list = [key for key, dir in orderby_keys]
+        self.reverse_list = [dir == "desc" for key, dir in orderby_keys]
+
+    def checkpoint(self, conn, actor_id, channel_id, seq):
+        pass
+    
+    def restore(self, conn, actor_id, channel_id, seq):
+        pass
+
+    def execute(self, batches, stream_id, executor_id):
+        self.state.extend([i for i in batches if i is not None and len(i) > 0])
+    
+    def done(self, executor_id):
+        if len(self.state) == 0:
+            return None
+        return polars.concat(self.state).sort(self.order_list, self.reverse_list)
+
+class TopKExecutor(Executor):
+    # keeps the first k rows in the order of orderby_keys. batches are buffered until there are k more rows, then the buffer and the current
+    # top k are sorted together and cut to k, so memory stays O(k + batch) and each row is sorted about once.
+    def __init__(self, orderby_keys, k) -> None:
+        assert k > 0
+        self.k = k
+        self.order_list = [key for key, dir in orderby_keys]
+        self.reverse_list = [dir == "desc" for key, dir in orderby_keys]
+        self.state = None
+        self.pending = []
+        self.pending_rows = 0
+
+    def checkpoint(self, conn, actor_id, channel_id, seq):
+        pass
+    
+    def restore(self, conn, actor_id, channel_id, seq):
+        pass
+
+    def compact(self):
+        if len(self.pending) == 0:
+            return
+        frames = self.pending if self.state is None else [self.state] + self.pending
+        self.state = polars.concat(frames).sort(self.order_list, self.reverse_list)[:self.k]
+        self.pending = []
+        self.pending_rows = 0
+
+    def execute(self, batches, stream_id, executor_id):
+        batches = [i for i in batches if i is not None and len(i) > 0]
+        if len(batches) == 0:
+            return
+        self.pending.extend(batches)
+        self.pending_rows += sum(len(batch) for batch in batches)
+        if self.pending_rows >= self.k:
+            self.compact()
+    
+    def done(self, executor_id):
+        self.compact()
+        return self.state
+
 class LimitExecutor(Executor):
+    # passes on the first limit rows it gets and drops the rest. Once it has them it sets done_early, which tells the runtime
+    # that nothing upstream of it is needed anymore.
     def __init__(self, limit) -> None:
+        assert limit > 0
         self.limit = limit
-        self.state = []
+        self.count = 0
+        self.done_early = False
+
+    def checkpoint(self, conn, actor_id, channel_id, seq):
+        pass
+    
+    def restore(self, conn, actor_id, channel_id, seq):
+        pass
 
     def execute(self, batches, stream_id, executor_id):
 
-        batch = pd.concat(batches)
-        self.state.append(batch)
-        length = sum([len(i) for i in self.state])
-        if length > self.limit:
-            self.set_early_termination()
+        batches = [i for i in batches if i is not None and len(i) > 0]
+        if len(batches) == 0 or self.count >= self.limit:
+            return
+        batch = polars.concat(batches)[:self.limit - self.count]
+        self.count += len(batch)
+        if self.count >= self.limit:
+            self.done_early = True
+        return batch
     
-    def done(self):
-        return pd.concat(self.state)[:self.limit]
+    def done(self, executor_id):
+        return
+
+class SampleExecutor(Executor):
+    # a uniform sample of at most rows of the rows it gets. Every row gets a random number and the rows with the smallest ones are kept,
+    # buffered like TopKExecutor. If read_rows is set, it sets done_early after that many rows, so only that much input is read.
+    def __init__(self, rows, read_rows = None) -> None:
+        assert rows > 0
+        self.rows = rows
+        self.read_rows = read_rows
+        self.count = 0
+        self.done_early = False
+        self.state = None
+        self.pending = []
+        self.pending_rows = 0
+
+    def checkpoint(self, conn, actor_id, channel_id, seq):
+        pass
+    
+    def restore(self, conn, actor_id, channel_id, seq):
+        pass
+
+    def compact(self):
+        if len(self.pending) == 0:
+            return
+        frames = self.pending if self.state is None else [self.state] + self.pending
+        self.state = polars.concat(frames).sort("__sample__")[:self.rows]
+        self.pending = []
+        self.pending_rows = 0
+
+    def execute(self, batches, stream_id, executor_id):
+        batches = [i for i in batches if i is not None and len(i) > 0]
+        if len(batches) == 0 or self.done_early:
+            return
+        if self.read_rows is not None:
+            batches = [polars.concat(batches)[:self.read_rows - self.count]]
+        for batch in batches:
+            self.pending.append(batch.with_column(polars.Series("__sample__", np.random.random(len(batch)))))
+            self.pending_rows += len(batch)
+            self.count += len(batch)
+        if self.pending_rows >= self.rows:
+            self.compact()
+        if self.read_rows is not None and self.count >= self.read_rows:
+            self.done_early = True
+    
+    def done(self, executor_id):
+        self.compact()
+        if self.state is None:
+            return
+        return self.state.drop("__sample__")
 
 class CountExecutor(Executor):
     def __init__(self) -> None:
@@ -654,94 +1683,97 @@ class CountExecutor(Executor):
 
 
 class SuperFastSortExecutor(Executor):
-    def __init__(self, key, record_batch_rows = 100000, output_batch_rows = 1000000, file_prefix = "mergesort") -> None:
-        self.key = key
+    # external sort. incoming batches are buffered up to run_rows, sorted and written to /data/ as a run. only the sort keys of every row and the
+    # run it's in are kept in memory. done() sorts those, and each output batch of output_batch_rows takes from every run as many rows as it has
+    # in that slice of the sorted keys, which is always a prefix of what's left of the run. reverse is like polars' sort, per key or for all of them.
+    def __init__(self, key, record_batch_rows = 100000, output_batch_rows = 1000000, file_prefix = "mergesort", run_rows = 1000000, reverse = False) -> None:
+        self.keys = [key] if type(key) == str else key
+        self.reverse = reverse
         self.record_batch_rows = record_batch_rows
         self.output_batch_rows = output_batch_rows
+        self.run_rows = run_rows
         self.fileno = 0
-        self.prefix = file_prefix # make sure this is different for different executors
+        self.prefix = file_prefix
+        # so two sorts in the same query don't write the same files
+        self.token = None
         self.data_dir = "/data/"
         self.in_mem_state = None
-        self.executor = None
-
-    def write_out_df_to_disk(self, target_filepath, input_mem_table):
-        # arrow_table = input_mem_table.to_arrow()
-        # batches = arrow_table.to_batches(1000000)
-        # writer =  pa.ipc.new_file(pa.OSFile(target_filepath, 'wb'), arrow_table.schema)
-        # for batch in batches:
-        #     writer.write(batch)
-        # writer.close()
-        input_mem_table.write_parquet(target_filepath, row_group_size = self.record_batch_rows, use_pyarrow =True)
+        self.pending = []
+        self.pending_rows = 0
 
-        return True
+    def checkpoint(self, conn, actor_id, channel_id, seq):
+        pass
+    
+    def restore(self, conn, actor_id, channel_id, seq):
+        pass
 
-    def execute(self, batches, stream_id, executor_id):
+    def run_file(self, executor_id, run):
+        return self.data_dir + self.prefix + "-" + self.token + "-" + str(executor_id) + "-" + str(run) + ".arrow"
 
-        # if self.executor is None:
-        #     self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    def write_out_df_to_disk(self, target_filepath, input_mem_table):
+        arrow_table = input_mem_table.to_arrow()
+        writer =  pa.ipc.new_file(pa.OSFile(target_filepath, 'wb'), arrow_table.schema)
+        for batch in arrow_table.to_batches(self.record_batch_rows):
+            writer.write(batch)
+        writer.close()
+        return True
 
-        # we are going to update the in memory index and flush out the sorted stuff
-        
-        flush_file_name = self.data_dir + self.prefix + "-" + str(executor_id) + "-" + str(self.fileno) + ".arrow"
-        batches = [i for i in batches if i is not None and len(i) > 0]
-        if len(batches) == 0:
-            return None
-        
-        start = time.time()
-        batch = polars.concat(batches)
-        print("concat execute used", time.time() - start)
+    def flush(self, executor_id):
+        if self.pending_rows == 0:
+            return
+        if self.token is None:
+            self.token = uuid.uuid4().hex[:8]
 
-        start = time.time()
-        sorted_batch = batch.sort(self.key)
-        print("sort execute used", time.time() - start)
-        
-        start = time.time()
-        self.write_out_df_to_disk(flush_file_name, sorted_batch)
-        # future = self.executor.submit(self.write_out_df_to_disk, flush_file_name, sorted_batch)
-        print("flush execute used", time.time() - start)
+        sorted_batch = polars.concat(self.pending).sort(self.keys, self.reverse)
+        self.pending = []
+        self.pending_rows = 0
+        self.write_out_df_to_disk(self.run_file(executor_id, self.fileno), sorted_batch)
 
-        start = time.time()
-        new_in_mem_state = polars.from_dict({ "values": sorted_batch[self.key], "file_no": np.ones(len(batch), dtype=np.int32) * self.fileno})
+        new_in_mem_state = sorted_batch.select(self.keys).with_column(polars.lit(self.fileno).cast(polars.Int32).alias("__file_no__"))
         if self.in_mem_state is None:
             self.in_mem_state = new_in_mem_state
         else:
             self.in_mem_state.vstack(new_in_mem_state, in_place=True)
-        
-        print("update execute state used", time.time() - start)
-        
-        # assert future.result()
         self.fileno += 1
+
+    def execute(self, batches, stream_id, executor_id):
+
+        batches = [i for i in batches if i is not None and len(i) > 0]
+        if len(batches) == 0:
+            return None
         
+        self.pending.extend(batches)
+        self.pending_rows += sum(len(batch) for batch in batches)
+        if self.pending_rows >= self.run_rows:
+            self.flush(executor_id)
     
     def done(self, executor_id):
 
-        # first sort the in memory state
-        print("STARTING DONE", time.time())
-        self.in_mem_state = self.in_mem_state.sort("values")
+        self.flush(executor_id)
+        if self.in_mem_state is None:
+            return
+
+        self.in_mem_state = self.in_mem_state.sort(self.keys, self.reverse)
         
         # load the cache
         num_sources = self.fileno 
-        sources =  {i : pa.ipc.open_file(pa.memory_map( self.data_dir + self.prefix + "-" + str(executor_id) + "-" + str(i) + ".arrow"  , 'rb')) for i in range(num_sources)}
+        sources =  {i : pa.ipc.open_file(pa.memory_map(self.run_file(executor_id, i), 'rb')) for i in range(num_sources)}
         number_of_batches_in_source = { source: sources[source].num_record_batches for source in sources}
         cached_batches = {i : polars.from_arrow( pa.Table.from_batches([sources[i].get_batch(0)]) ) for i in sources}
         current_number_for_source = {i: 1 for i in sources}
 
-        print("END DONE SETUP", time.time())
-
         # now start assembling batches of the output
         for k in range(0, len(self.in_mem_state), self.output_batch_rows):
 
-            start = time.time()
-
             things_to_get = self.in_mem_state[k : k + self.output_batch_rows]
-            file_requirements = things_to_get.groupby("file_no").count()
+            file_requirements = things_to_get.groupby("__file_no__").count()
             desired_batches = []
             for i in range(len(file_requirements)):
                 desired_length = file_requirements["count"][i]
-                source = file_requirements["file_no"][i]
+                source = file_requirements["__file_no__"][i]
                 while desired_length > len(cached_batches[source]):
                     if current_number_for_source[source] == number_of_batches_in_source[source]:
-                        raise Exception
+                        raise Exception("sort run " + str(source) + " is shorter than its keys say")
                     else:
                         cached_batches[source].vstack(polars.from_arrow( pa.Table.from_batches( [sources[source].get_batch(current_number_for_source[source])])), in_place=True)
                         current_number_for_source[source] += 1
@@ -749,11 +1781,124 @@ class SuperFastSortExecutor(Executor):
                     desired_batches.append(cached_batches[source][:desired_length])
                     cached_batches[source] = cached_batches[source][desired_length:]
             
-            result = polars.concat(desired_batches).sort(self.key)
-            print("yield one took", time.time() - start)
-            yield result
+            yield polars.concat(desired_batches).sort(self.keys, self.reverse)
+
+        del sources
+        for i in range(num_sources):
+            os.remove(self.run_file(executor_id, i))
+        self.in_mem_state = None
             
 
+class WindowExecutor(Executor):
+    # window functions over the partitions of keys, in the order of orderby. The channel's rows are external sorted on orderby by a SuperFastSortExecutor,
+    # and done() goes through them a sorted batch at a time. Every batch is computed with over() on the keys, plus what was carried over for each key
+    # from the batches before it, joined on the keys: its row count, last order value and rank, running sums and last rows for lag. The last rows of a key
+    # are held back until its next rows, or the end, say what they lead to.
+    # this is blocking: any row still to come could sort first, so nothing comes out before done(). The rows themselves wait on disk, but the sort
+    # keeps the orderby value and run number of every row in memory, so memory is O(rows) in that column, plus the carried state, O(keys).
+    # windows is a list of (name, function, column, n), function is one of row_number, rank, lag, lead and cumsum.
+    def __init__(self, keys, orderby, windows) -> None:
+        self.keys = keys
+        self.orderby = orderby
+        self.windows = windows
+        self.sorter = SuperFastSortExecutor(orderby, file_prefix = "window")
+        self.ranked = any(function == "rank" for name, function, column, n in windows)
+        self.lags = [(name, column, n) for name, function, column, n in windows if function == "lag"]
+        self.leads = [(name, column, n) for name, function, column, n in windows if function == "lead"]
+        self.sums = [(name, column) for name, function, column, n in windows if function == "cumsum"]
+        self.max_lag = max([n for name, column, n in self.lags], default = 0)
+        self.max_lead = max([n for name, column, n in self.leads], default = 0)
+        self.columns = None
+        # key fingerprint -> __count__, __order__, __rank__ and __sum_<name> of the rows so far
+        self.state = None
+        # the last max_lag rows of every key, only the columns lag needs
+        self.context = None
+        # rows waiting for the rows they lead to
+        self.held = None
+
+    def checkpoint(self, conn, actor_id, channel_id, seq):
+        pass
+    
+    def restore(self, conn, actor_id, channel_id, seq):
+        pass
+
+    def execute(self, batches, stream_id, executor_id):
+        self.sorter.execute(batches, stream_id, executor_id)
+
+    def window(self, batch):
+
+        keys = self.keys
+        if self.columns is None:
+            self.columns = batch.columns
+
+        carried = ["__count__", "__order__"] + (["__rank__"] if self.ranked else []) + ["__sum_" + name for name, column in self.sums]
+        if self.state is None:
+            batch = batch.with_columns([polars.lit(0).alias(col) for col in carried if col != "__order__"] + 
+                [polars.lit(None).cast(batch[self.orderby].dtype).alias("__order__")])
+        else:
+            batch = batch.join(self.state, on = keys, how = "left").with_columns([polars.col(col).fill_null(0) for col in carried if col != "__order__"])
+
+        columns = [(polars.col("__count__") + polars.col(self.orderby).cumcount().over(keys) + 1).cast(polars.Int64).alias("__row_number__")]
+        if self.ranked:
+            # a tie with the last row of the batches before gets its rank, everything after is ranked among this batch
+            columns.append(polars.when(polars.col(self.orderby) == polars.col("__order__")).then(polars.col("__rank__"))
+                .otherwise(polars.col("__count__") + polars.col(self.orderby).rank("min").over(keys)).cast(polars.Int64).alias("__rank_value__"))
+        for name, column in self.sums:
+            columns.append((polars.col("__sum_" + name) + polars.col(column).fill_null(0).cumsum().over(keys)).alias(name))
+        batch = batch.with_columns(columns)
+
+        new_state = batch.groupby(keys).agg([polars.col("__row_number__").last().alias("__count__"), polars.col(self.orderby).last().alias("__order__")] + 
+            ([polars.col("__rank_value__").last().alias("__rank__")] if self.ranked else []) + 
+            [polars.col(name).last().alias("__sum_" + name) for name, column in self.sums])
+        self.state = new_state if self.state is None else polars.concat([self.state.join(new_state, on = keys, how = "anti"), new_state])
+
+        batch = batch.drop(carried).with_columns([polars.col("__row_number__" if function == "row_number" else "__rank_value__").alias(name) 
+            for name, function, column, n in self.windows if function == "row_number" or function == "rank"])
+
+        if self.max_lag > 0:
+            lag_columns = keys + [column for column in set(column for name, column, n in self.lags) if column not in keys]
+            frame = batch.select(lag_columns).with_column(polars.lit(False).alias("__context__"))
+            if self.context is not None:
+                frame = polars.concat([self.context, frame])
+            lagged = frame.with_columns([polars.col(column).shift(n).over(keys).alias(name) for name, column, n in self.lags])
+            batch = batch.hstack(lagged.filter(~polars.col("__context__")).select([name for name, column, n in self.lags]).get_columns())
+            self.context = frame.with_column(polars.lit(True).alias("__context__")).groupby(keys).tail(self.max_lag)
+
+        return self.lead(batch, False)
+
+    def lead(self, frame, final):
+
+        # leads for the rows held back before and frame. Unless this is the end, the last max_lead rows of every key are held back again.
+        keys = self.keys
+        if self.held is not None:
+            frame = self.held if frame is None else polars.concat([self.held, frame])
+            self.held = None
+        if frame is None:
+            return None
+
+        if self.max_lead > 0:
+            frame = frame.with_columns([polars.col(column).shift(-n).over(keys).alias(name) for name, column, n in self.leads])
+            if not final:
+                frame = frame.with_column(polars.col(self.orderby).cumcount(reverse = True).over(keys).alias("__from_end__"))
+                self.held = frame.filter(polars.col("__from_end__") < self.max_lead).drop(["__from_end__"] + [name for name, column, n in self.leads])
+                frame = frame.filter(polars.col("__from_end__") >= self.max_lead)
+
+        return frame.select(self.columns + [name for name, function, column, n in self.windows])
+    
+    def done(self, executor_id):
+
+        for batch in self.sorter.done(executor_id):
+            result = self.window(batch)
+            if result is not None and len(result) > 0:
+                yield result
+        
+        result = self.lead(None, True)
+        if result is not None and len(result) > 0:
+            yield result
+        self.state = None
+        self.context = None
+
+
 #table = polars.read_parquet("/home/ziheng/tpc-h/lineitem.parquet")
 #exe = SuperFastSortExecutor("l_partkey", record_batch_rows = 10000, output_batch_rows = 1000000, file_prefix = "mergesort")
 #for i in range(0, len(table), 1000000):
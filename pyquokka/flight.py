@@ -2,11 +2,14 @@ import threading
 import time
 import pyarrow
 import pyarrow.flight
+import pyarrow.ipc
 from multiprocessing import Lock
 import os, psutil
 import pickle
 
 from collections import deque
+from bisect import bisect_left, insort
+import heapq
 import pyarrow.parquet as pq
 import os
 import polars
@@ -20,9 +23,121 @@ def print_if_debug(*x):
 class DiskFile:
     def __init__(self,filename) -> None:
         self.filename = filename
+    def read(self):
+        # memory map the Arrow IPC file, the batches will point into the mapping so no copies are made
+        reader = pyarrow.ipc.open_file(pyarrow.memory_map(self.filename, 'r'))
+        return [reader.get_batch(i) for i in range(reader.num_record_batches)]
     def delete(self):
         os.remove(self.filename)
 
+class ShmFile(DiskFile):
+    # an Arrow IPC file that a TaskManager on this machine wrote to shared memory (/dev/shm) and handed to us by name.
+    # it's already in RAM so it's never spilled, and do_get hands the consumer the file name instead of the batches.
+    def handle(self, my_format):
+        schema = pyarrow.ipc.open_file(pyarrow.memory_map(self.filename, 'r')).schema
+        empty = pyarrow.record_batch([pyarrow.array([], type = field.type) for field in schema], schema = schema)
+        return [empty], ("shm", self.filename, my_format)
+
+
+'''
+The cache index keeps track of the names of the objects in the cache, organized the way do_get wants to look them up:
+(target_actor_id, target_channel_id) -> source_actor_id -> source_channel_id -> sorted list of seqs.
+The partition_fn part of the name is always 0 for now so it's not part of the index.
+This replaces a Polars table of keys that had to be vstacked on every put and filtered/joined on every get.
+Note this file gets copied to the workers and run standalone, so it can't import from pyquokka.
+'''
+
+class FlightKeyIndex:
+    def __init__(self) -> None:
+        self.index = {}
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.index = {}
+        self.count = 0
+
+    def add(self, name):
+        source_actor_id, source_channel_id, seq, target_actor_id, partition_fn, target_channel_id = name
+        sources = self.index.setdefault((target_actor_id, target_channel_id), {})
+        seqs = sources.setdefault(source_actor_id, {}).setdefault(source_channel_id, [])
+        # seqs almost always arrive in order, so this is usually an append
+        if len(seqs) == 0 or seqs[-1] < seq:
+            seqs.append(seq)
+        else:
+            insort(seqs, seq)
+        self.count += 1
+
+    def remove(self, name):
+        source_actor_id, source_channel_id, seq, target_actor_id, partition_fn, target_channel_id = name
+        sources = self.index[target_actor_id, target_channel_id]
+        channels = sources[source_actor_id]
+        seqs = channels[source_channel_id]
+        pos = bisect_left(seqs, seq)
+        assert pos < len(seqs) and seqs[pos] == seq, "name not in cache index"
+        del seqs[pos]
+        self.count -= 1
+
+        # clean up empty levels so lookups for finished channels stay cheap
+        if len(seqs) == 0:
+            del channels[source_channel_id]
+            if len(channels) == 0:
+                del sources[source_actor_id]
+                if len(sources) == 0:
+                    del self.index[target_actor_id, target_channel_id]
+
+    def contiguous_run(self, target_actor_id, target_channel_id, source_actor_id, source_channel_id, min_seq, limit):
+        # returns the seqs min_seq, min_seq + 1, ... that are present, stopping at the first gap or after limit seqs.
+        try:
+            seqs = self.index[target_actor_id, target_channel_id][source_actor_id][source_channel_id]
+        except KeyError:
+            return []
+        pos = bisect_left(seqs, min_seq)
+        run = []
+        while pos < len(seqs) and len(run) < limit and seqs[pos] == min_seq + len(run):
+            run.append(seqs[pos])
+            pos += 1
+        return run
+
+    def plan(self, target_actor_id, target_channel_id, input_requirements, limit):
+
+        # input_requirements is a list of (source_actor_id, source_channel_id, min_seq)
+        # pick the source actor with the most batches ready to give, and return {source_channel_id: [seqs]} for it.
+        # the seqs for each source channel are guaranteed to be contiguous, starting from min_seq
+
+        sources = self.index.get((target_actor_id, target_channel_id))
+        if sources is None:
+            return None, {}
+
+        candidates = {}
+        for source_actor_id, source_channel_id, min_seq in input_requirements:
+            if source_actor_id not in sources or source_channel_id not in sources[source_actor_id]:
+                continue
+            plan, total = candidates.get(source_actor_id, ({}, 0))
+            if total >= limit:
+                continue
+            run = self.contiguous_run(target_actor_id, target_channel_id, source_actor_id, source_channel_id, min_seq, limit - total)
+            if len(run) > 0:
+                plan[source_channel_id] = run
+                candidates[source_actor_id] = (plan, total + len(run))
+
+        if len(candidates) == 0:
+            return None, {}
+
+        source_actor_id = max(candidates, key = lambda k: candidates[k][1])
+        return source_actor_id, candidates[source_actor_id][0]
+
+    def to_list(self):
+        # flattened list of names, mostly useful for debugging.
+        result = []
+        for (target_actor_id, target_channel_id), sources in self.index.items():
+            for source_actor_id, channels in sources.items():
+                for source_channel_id, seqs in channels.items():
+                    result.extend([(source_actor_id, source_channel_id, seq, target_actor_id, 0, target_channel_id) for seq in seqs])
+        return result
+
 
 class FlightServer(pyarrow.flight.FlightServerBase):
     def __init__(self, host="localhost", location=None):
@@ -35,8 +150,7 @@ class FlightServer(pyarrow.flight.FlightServerBase):
 
         # flights will be a dictionary for now name->(object, format). This should be called cache.
         self.flights = {}
-        # self.flight_keys = polars.DataFrame(columns = ["source_actor_id", "source_channel_id", "seq", "target_actor_id", "partition_fn", "target_channel_id"])
-        self.flight_keys = None
+        self.flight_keys = FlightKeyIndex()
         self.flights_lock = Lock()
 
         # hbq will be a dictionary for now name->(object, format). This should be called push storage.
@@ -45,8 +159,32 @@ class FlightServer(pyarrow.flight.FlightServerBase):
         self.hbq_keys = None
         self.hbq_lock = Lock()
 
+        # the cache has two tiers. Objects in memory are lists of RecordBatches, objects spilled to disk are DiskFiles.
+        # cache_mem_bytes is the budget for the memory tier, None means never spill.
+        # objects pushed from this machine through shared memory are ShmFiles, they are counted separately and not spilled.
+        self.flight_bytes = {}
+        self.mem_bytes = 0
+        self.disk_bytes = 0
+        self.shm_bytes = 0
+        # exact bytes held (both tiers) for each consumer (target_actor_id, target_channel_id) and each producer (source_actor_id, source_channel_id)
+        self.consumer_bytes = {}
+        self.source_bytes = {}
+        # when each object for a consumer arrived, in arrival order. consumer -> {name: time}
+        self.consumer_arrivals = {}
+        # how far along each consumer is for each of its inputs, as told by do_get. (target_actor_id, target_channel_id, source_actor_id, source_channel_id) -> min_seq
+        self.consumer_progress = {}
+        # the in-memory objects as (-distance, name), see _spill. Entries of objects that were dropped or spilled since are skipped when they come up.
+        self.eviction_heap = []
+        # consumers whose input isn't needed anymore because something downstream finished early, see the cancel action.
+        # target actors that are cancelled altogether, and single (target_actor_id, target_channel_id) that finished early.
+        self.cancelled_actors = set()
+        self.cancelled_channels = set()
+
         self.host = host
-        self.config_dict = {"mem_limit" : 0.25, "max_batches": 10}
+        # consumer_quota_bytes and global_quota_bytes bound the bytes held for one consumer and for everyone. 
+        # if global_quota_bytes is None we fall back to keeping mem_limit fraction of system memory free.
+        self.config_dict = {"mem_limit" : 0.25, "max_batches": 10, "cache_mem_bytes": None, "spill_dir": "/data/flight/",
+            "consumer_quota_bytes": None, "global_quota_bytes": None}
         self.process = psutil.Process(os.getpid())
         #self.log_file = open("/home/ubuntu/flight-log","w")
 
@@ -96,39 +234,54 @@ class FlightServer(pyarrow.flight.FlightServerBase):
         
         if is_push:
 
-            source_actor_id, source_channel_id, seq, target_actor_id, partition_fn, target_channel_id = name
-            new_row = polars.from_dict({"source_actor_id": [source_actor_id], "source_channel_id":[source_channel_id], "seq":[seq], "target_actor_id":[target_actor_id],
-                "partition_fn":[partition_fn], "target_channel_id":[target_channel_id]})
-
-            batches = []
+            # a push either carries one object, or if name is None, many objects for this server multiplexed on one stream.
+            # in the latter case every chunk carries the name of the object it belongs to as app_metadata.
+            objects = {}
             while True:
                 try:
-                    batches.append(reader.read_chunk().data)
+                    chunk = reader.read_chunk()
                 except StopIteration:
                     break
+                chunk_name = name if name is not None else pickle.loads(chunk.app_metadata.to_pybytes())
+                if chunk_name in objects:
+                    objects[chunk_name].append(chunk.data)
+                else:
+                    objects[chunk_name] = [chunk.data]
             
-            assert len(batches) > 0
-            data = batches
+            assert len(objects) > 0
 
             print_if_debug('acquiring flight lock')
             self.flights_lock.acquire()
-            if name in self.flights:
-                # print("duplicate data detected")
-                # assert data  == self.flights[name][0], "duplicate data not the same"
-                # important bug fix: the same name could be pushed again with different data.
-                # in case of failure upstream after push and before commit, the object with that name will be reconstructed with different inputs.
-                # we want to accept the most up to date version!
-                self.flights[name] = (data, my_format)
-            
-            else:
-                self.flights[name] = (data, my_format)
+            for name, data in objects.items():
+                if self._cancelled(name):
+                    # the pusher didn't know yet, nobody is going to ask for this
+                    continue
+                if name in self.flights:
+                    # print("duplicate data detected")
+                    # assert data  == self.flights[name][0], "duplicate data not the same"
+                    # important bug fix: the same name could be pushed again with different data.
+                    # in case of failure upstream after push and before commit, the object with that name will be reconstructed with different inputs.
+                    # we want to accept the most up to date version!
+                    self._drop(name)
+                    self._store(name, data, my_format)
                 
-                # very important this happens after update self.flights, due to locking strategy in do_get.
-                if self.flight_keys is None:
-                    self.flight_keys = new_row
                 else:
-                    self.flight_keys.vstack(new_row,in_place=True)
+                    self._store(name, data, my_format)
+                    
+                    # very important this happens after update self.flights, due to locking strategy in do_get.
+                    self.flight_keys.add(name)
+
+            if self.config_dict["cache_mem_bytes"] is not None and self.mem_bytes > self.config_dict["cache_mem_bytes"]:
+                self._spill(self.mem_bytes - self.config_dict["cache_mem_bytes"])
+
+            credits = {}
+            for name in objects:
+                source_actor_id, source_channel_id, seq, target_actor_id, partition_fn, target_channel_id = name
+                credits[target_actor_id, target_channel_id] = self.bytes_free(target_actor_id, target_channel_id)
             self.flights_lock.release()
+
+            # refill the pusher's credits for these consumers, so it doesn't have to ask with check_puttable before the next put
+            writer.write(pyarrow.py_buffer(pickle.dumps(credits)))
             print_if_debug('flight lock released')
 
         else:
@@ -161,6 +314,134 @@ class FlightServer(pyarrow.flight.FlightServerBase):
             self.hbq_lock.release()
         
 
+    def _account(self, name, nbytes):
+        source_actor_id, source_channel_id, seq, target_actor_id, partition_fn, target_channel_id = name
+        consumer = (target_actor_id, target_channel_id)
+        source = (source_actor_id, source_channel_id)
+        self.consumer_bytes[consumer] = self.consumer_bytes.get(consumer, 0) + nbytes
+        self.source_bytes[source] = self.source_bytes.get(source, 0) + nbytes
+        if self.consumer_bytes[consumer] == 0:
+            del self.consumer_bytes[consumer]
+        if self.source_bytes[source] == 0:
+            del self.source_bytes[source]
+
+    def _store(self, name, data, my_format, nbytes = None):
+        # data is a list of batches, or a ShmFile of nbytes
+        if type(data) == ShmFile:
+            self.shm_bytes += nbytes
+        else:
+            nbytes = sum(batch.nbytes for batch in data)
+            self.mem_bytes += nbytes
+        self.flights[name] = (data, my_format)
+        self.flight_bytes[name] = nbytes
+        self._account(name, nbytes)
+        consumer = (name[3], name[5])
+        if consumer not in self.consumer_arrivals:
+            self.consumer_arrivals[consumer] = {}
+        self.consumer_arrivals[consumer][name] = time.time()
+        if type(data) != ShmFile:
+            heapq.heappush(self.eviction_heap, (-self._distance(name), name))
+            if len(self.eviction_heap) > 2 * len(self.flights) + 1024:
+                # mostly stale entries, start over from what's in memory
+                self.eviction_heap = [(-self._distance(name), name) for name in self.flights if not isinstance(self.flights[name][0], DiskFile)]
+                heapq.heapify(self.eviction_heap)
+
+    def _distance(self, name):
+        # how far the consumer is from needing this object: its seq above the consumer's min_seq for that source channel.
+        # the consumer's min_seq is what it last asked for in do_get, or 0 if it never asked.
+        source_actor_id, source_channel_id, seq, target_actor_id, partition_fn, target_channel_id = name
+        return seq - self.consumer_progress.get((target_actor_id, target_channel_id, source_actor_id, source_channel_id), 0)
+
+    def _drop(self, name):
+        # remove the object from whatever tier it's in and do the accounting. Caller must hold flights_lock.
+        data, my_format = self.flights.pop(name)
+        nbytes = self.flight_bytes.pop(name)
+        self._account(name, -nbytes)
+        consumer = (name[3], name[5])
+        del self.consumer_arrivals[consumer][name]
+        if len(self.consumer_arrivals[consumer]) == 0:
+            del self.consumer_arrivals[consumer]
+        if type(data) == DiskFile:
+            data.delete()
+            self.disk_bytes -= nbytes
+        elif type(data) == ShmFile:
+            data.delete()
+            self.shm_bytes -= nbytes
+        else:
+            self.mem_bytes -= nbytes
+
+    def _cancelled(self, name):
+        return name[3] in self.cancelled_actors or (name[3], name[5]) in self.cancelled_channels
+
+    def _lookup(self, name):
+        # return the (list of batches, format) for a name, mapping it back from disk if it was spilled.
+        data, my_format = self.flights[name]
+        if type(data) == DiskFile:
+            return data.read(), my_format
+        elif type(data) == ShmFile:
+            # the consumer is on this machine too, let it map the file itself instead of streaming it over
+            return data.handle(my_format)
+        return data, my_format
+
+    def _spill(self, nbytes):
+
+        # write in-memory objects out as Arrow IPC files until we freed up nbytes. Caller must hold flights_lock.
+        # we evict the objects whose consumers are furthest from needing them, see _distance, off the eviction heap.
+        # a distance only ever goes down as consumers move along, so the one on the heap is an upper bound. If it's stale
+        # the entry goes back with the right distance, and an entry that is still right is really the furthest.
+
+        os.makedirs(self.config_dict["spill_dir"], exist_ok = True)
+
+        freed = 0
+        while freed < nbytes and len(self.eviction_heap) > 0:
+            priority, name = heapq.heappop(self.eviction_heap)
+            if name not in self.flights or isinstance(self.flights[name][0], DiskFile):
+                continue
+            distance = self._distance(name)
+            if distance < -priority:
+                heapq.heappush(self.eviction_heap, (-distance, name))
+                continue
+            data, my_format = self.flights[name]
+            filename = self.config_dict["spill_dir"] + "flight-" + "-".join(str(i) for i in name) + ".arrow"
+            writer = pyarrow.ipc.new_file(filename, data[0].schema)
+            for batch in data:
+                writer.write_batch(batch)
+            writer.close()
+
+            self.flights[name] = (DiskFile(filename), my_format)
+            self.mem_bytes -= self.flight_bytes[name]
+            self.disk_bytes += self.flight_bytes[name]
+            freed += self.flight_bytes[name]
+            print_if_debug("spilled", name)
+
+    def bytes_free(self, target_actor_id, target_channel_id):
+
+        # how many more bytes we are willing to take for this consumer. 
+        # a consumer is only held back by its own backlog, unless the server as a whole is full. In that case consumers
+        # whose backlog is below the average (their fair share) can still keep going, so a slow consumer doesn't stall the fast ones.
+
+        held = self.mem_bytes + self.disk_bytes + self.shm_bytes
+        consumer_held = self.consumer_bytes.get((target_actor_id, target_channel_id), 0)
+
+        if self.config_dict["global_quota_bytes"] is not None:
+            global_free = self.config_dict["global_quota_bytes"] - held
+            capacity = self.config_dict["global_quota_bytes"]
+        else:
+            memory = psutil.virtual_memory()
+            global_free = int(memory.available - memory.total * self.config_dict["mem_limit"])
+            capacity = held
+
+        if self.config_dict["consumer_quota_bytes"] is not None:
+            consumer_free = self.config_dict["consumer_quota_bytes"] - consumer_held
+        else:
+            consumer_free = global_free
+
+        if global_free > 0:
+            return min(consumer_free, global_free)
+        
+        fair_share = capacity // max(len(self.consumer_bytes), 1)
+        return min(consumer_free, fair_share - consumer_held)
+
     @staticmethod
     def number_batches(batches):
         for name, batch in batches:
@@ -192,59 +473,23 @@ class FlightServer(pyarrow.flight.FlightServerBase):
             if not exact:
                 # you might want to make sure that you don't return things out of order here or have gaps in the things you do return
 
-                if self.flight_keys is None or len(self.flight_keys) == 0:
+                if len(self.flight_keys) == 0:
                     print_if_debug("flights empty!")
                     self.flights_lock.release()
                     return pyarrow.flight.GeneratorStream(pyarrow.schema([]), self.number_batches(batches))
 
+                requirements = list(zip(input_requirements["source_actor_id"].to_list(), input_requirements["source_channel_id"].to_list(), input_requirements["min_seq"].to_list()))
+                for source_actor_id, source_channel_id, min_seq in requirements:
+                    self.consumer_progress[actor_id, channel_id, source_actor_id, source_channel_id] = min_seq
+                source_actor_id, exec_plan = self.flight_keys.plan(actor_id, channel_id, requirements, self.config_dict["max_batches"])
 
-                exec_plan = self.flight_keys.lazy().filter((polars.col("target_actor_id") == actor_id) & (polars.col("target_channel_id") == channel_id))\
-                                                .join(input_requirements.lazy(), left_on= ["source_actor_id", "source_channel_id"], right_on=["source_actor_id", "source_channel_id"])\
-                                                .filter(polars.col("seq") >= polars.col("min_seq")).limit(self.config_dict["max_batches"])\
-                                                .select(["source_actor_id", "source_channel_id", "seq", "partition_fn", "min_seq"])\
-                                                .collect()
-                
-                print_if_debug(self.flight_keys, input_requirements, exec_plan)
-
-                if len(exec_plan) == 0:
-                    self.flights_lock.release()
-                    return pyarrow.flight.GeneratorStream(pyarrow.schema([]), self.number_batches(batches))
+                print_if_debug(input_requirements, exec_plan)
 
-                # pick the source with the most batches to give.
-                source_actor_id = exec_plan.lazy().groupby("source_actor_id").agg(polars.count()).sort("count",reverse=True).limit(1).collect().to_dicts()[0]["source_actor_id"]
-                
-                # we need to sort the exec plan!
-                # exec_plan = exec_plan.filter(polars.col("source_actor_id") == source_actor_id).sort(["source_channel_id","seq"])
-
-                exec_plan_candidate = exec_plan.filter(polars.col("source_actor_id") == source_actor_id)
-
-                for df in exec_plan_candidate.groupby("source_channel_id"):
-                    source_channel_id = df["source_channel_id"][0]
-                    seqs = sorted(df["seq"].to_list())
-                    min_seq = df["min_seq"][0]
-                    last_seq = min_seq
-                    for seq in seqs:
-                        if seq == last_seq:
-                            name = (source_actor_id, source_channel_id, seq, actor_id, 0, channel_id)
-                            assert name in self.flights
-                            batches.append((name, self.flights[name]))
-                            last_seq += 1
-                        else:
-                            break
-
-                # print_if_debug("exec plan", exec_plan)
-                # print_if_debug("current flights", self.flight_keys)
-
-                # # do a check here that the returned input batches are contiguous. there could be failure cases but this check should handle most of it.
-                # z = exec_plan.groupby("source_channel_id").agg([polars.max("seq"), polars.count(), polars.max("min_seq")])
-                # print_if_debug(z)
-                # assert (z["seq"] == z["min_seq"] + z["count"] - 1).all(), "Failed check, returned sequence numbers likely not contiguous"
-                                                
-                # for name_dict in exec_plan.to_dicts():
-                #     name = (name_dict["source_actor_id"], name_dict["source_channel_id"], name_dict["seq"], actor_id, name_dict["partition_fn"], channel_id)
-                #     print_if_debug(self.flights)
-                #     assert name in self.flights , "exec plan name not in flights"
-                #     batches.append((name, self.flights[name]))
+                for source_channel_id in exec_plan:
+                    for seq in exec_plan[source_channel_id]:
+                        name = (source_actor_id, source_channel_id, seq, actor_id, 0, channel_id)
+                        assert name in self.flights
+                        batches.append((name, self._lookup(name)))
                 
                 if len(batches) == 0:
                     self.flights_lock.release()
@@ -252,7 +497,7 @@ class FlightServer(pyarrow.flight.FlightServerBase):
 
             else:
 
-                if self.flight_keys is None or len(self.flight_keys) == 0:
+                if len(self.flight_keys) == 0:
                     print_if_debug("flights empty!")
                     self.flights_lock.release()
                     return pyarrow.flight.GeneratorStream(pyarrow.schema([]), self.number_batches([]))
@@ -266,9 +511,8 @@ class FlightServer(pyarrow.flight.FlightServerBase):
                         if name not in self.flights:
                             self.flights_lock.release()
                             return pyarrow.flight.GeneratorStream(pyarrow.schema([]), self.number_batches([]))
-                        batches.append((name, self.flights[name]))
+                        batches.append((name, self._lookup(name)))
  
-                print_if_debug("current flights", self.flight_keys)
                 if len(batches) == 0:
                     self.flights_lock.release()
                     return pyarrow.flight.GeneratorStream(pyarrow.schema([]), self.number_batches(batches))
@@ -285,18 +529,29 @@ class FlightServer(pyarrow.flight.FlightServerBase):
     def list_actions(self, context):
         return [
             ("clear", "Clear the stored flights."),
-            ("check_puttable","check if puttable"),
+            ("check_puttable","bytes a consumer can still take"),
+            ("put_shm", "take objects written to shared memory on this machine"),
             ("shutdown", "Shut down this server."),
             ("get_hbq_info", "get information of hbq"),
             ("get_flights_info", "get information of flights"),
+            ("get_cache_stats", "get bytes and object counts per cache tier"),
+            ("get_ready_channels", "get queued bytes and oldest arrival time per consumer"),
             ("cache_garbage_collect", "garbage collect from cache"),
+            ("cancel", "drop the objects for consumers that don't need them anymore"),
             ("garbage_collect", "garbage collect hbq")
         ]
 
     def do_action(self, context, action):
         if action.type == "clear":
-            self.flight_keys = None
-            self.flights.clear()
+            self.flights_lock.acquire()
+            for name in list(self.flights.keys()):
+                self._drop(name)
+            self.flight_keys.clear()
+            self.consumer_progress.clear()
+            self.eviction_heap = []
+            self.cancelled_actors.clear()
+            self.cancelled_channels.clear()
+            self.flights_lock.release()
             # clear out the datasets that you store, not implemented yet.
             cond = True
             yield pyarrow.flight.Result(pyarrow.py_buffer(bytes(str(cond), "utf-8")))
@@ -308,10 +563,33 @@ class FlightServer(pyarrow.flight.FlightServerBase):
             cond = True
             yield pyarrow.flight.Result(pyarrow.py_buffer(bytes(str(cond), "utf-8")))
         elif action.type == "check_puttable":
-            # puts should now be blocking due to the DiskQueue!
-            # cond = True #sum(self.flights[i].nbytes for i in self.flights) < self.mem_limit
-            cond = (psutil.virtual_memory().available / psutil.virtual_memory().total) > self.config_dict["mem_limit"]
-            yield pyarrow.flight.Result(pyarrow.py_buffer(bytes(str(cond), "utf-8")))
+            # the body names the consumer the pusher wants to put to. We reply with the number of bytes it may still put.
+            target_actor_id, target_channel_id = pickle.loads(action.body.to_pybytes())
+            self.flights_lock.acquire()
+            free = self.bytes_free(target_actor_id, target_channel_id)
+            self.flights_lock.release()
+            yield pyarrow.flight.Result(pyarrow.py_buffer(bytes(str(free), "utf-8")))
+        
+        elif action.type == "put_shm":
+            # same as a push through do_put, except the pusher is on this machine and wrote the objects to shared memory.
+            # the body is the format and a list of (name, file name, bytes). We reply with the credits like do_put.
+            my_format, handles = pickle.loads(action.body.to_pybytes())
+            self.flights_lock.acquire()
+            credits = {}
+            for name, filename, nbytes in handles:
+                if self._cancelled(name):
+                    ShmFile(filename).delete()
+                elif name in self.flights:
+                    self._drop(name)
+                    self._store(name, ShmFile(filename), my_format, nbytes)
+                else:
+                    self._store(name, ShmFile(filename), my_format, nbytes)
+                    self.flight_keys.add(name)
+            for name, filename, nbytes in handles:
+                source_actor_id, source_channel_id, seq, target_actor_id, partition_fn, target_channel_id = name
+                credits[target_actor_id, target_channel_id] = self.bytes_free(target_actor_id, target_channel_id)
+            self.flights_lock.release()
+            yield pyarrow.flight.Result(pyarrow.py_buffer(pickle.dumps(credits)))
     
         elif action.type == "get_hbq_info":
 
@@ -319,7 +597,26 @@ class FlightServer(pyarrow.flight.FlightServerBase):
         
         elif action.type == "get_flights_info":
 
-            yield pyarrow.flight.Result(pyarrow.py_buffer(pickle.dumps((self.flight_keys, list(self.flights.keys())))))
+            yield pyarrow.flight.Result(pyarrow.py_buffer(pickle.dumps((self.flight_keys.to_list(), list(self.flights.keys())))))
+
+        elif action.type == "get_cache_stats":
+
+            self.flights_lock.acquire()
+            disk_objects = sum(1 for name in self.flights if type(self.flights[name][0]) == DiskFile)
+            shm_objects = sum(1 for name in self.flights if type(self.flights[name][0]) == ShmFile)
+            stats = {"mem_bytes": self.mem_bytes, "disk_bytes": self.disk_bytes, "shm_bytes": self.shm_bytes,
+                "mem_objects": len(self.flights) - disk_objects - shm_objects, "disk_objects": disk_objects, "shm_objects": shm_objects,
+                "consumer_bytes": dict(self.consumer_bytes), "source_bytes": dict(self.source_bytes)}
+            self.flights_lock.release()
+            yield pyarrow.flight.Result(pyarrow.py_buffer(pickle.dumps(stats)))
+        
+        elif action.type == "get_ready_channels":
+
+            # cheap summary for TaskManagers to decide which channel to run next: (target_actor_id, target_channel_id) -> (queued bytes, arrival time of the oldest object)
+            self.flights_lock.acquire()
+            ready = {consumer: (self.consumer_bytes.get(consumer, 0), next(iter(arrivals.values()))) for consumer, arrivals in self.consumer_arrivals.items()}
+            self.flights_lock.release()
+            yield pyarrow.flight.Result(pyarrow.py_buffer(pickle.dumps(ready)))
         
         elif action.type == "cache_garbage_collect":
 
@@ -327,18 +624,35 @@ class FlightServer(pyarrow.flight.FlightServerBase):
 
             self.flights_lock.acquire()
             for tup in gcable:
-                assert tup in self.flights, "tuple not in flights"
-                del self.flights[tup]
-
-            gcable = polars.DataFrame( gcable, columns= ["source_actor_id", "source_channel_id", "seq", "target_actor_id",\
-                 "partition_fn", "target_channel_id"], orient='row')
-            self.flight_keys = self.flight_keys.join(gcable, on = ["source_actor_id", "source_channel_id", "seq", "target_actor_id",\
-                 "partition_fn", "target_channel_id"], how = "anti")
+                if tup not in self.flights:
+                    # a cancel got to it first
+                    assert self._cancelled(tup), "tuple not in flights"
+                    continue
+                self._drop(tup)
+                self.flight_keys.remove(tup)
             
             self.flights_lock.release()
                 
             yield pyarrow.flight.Result(pyarrow.py_buffer(bytes(str(True), "utf-8")))
 
+        elif action.type == "cancel":
+
+            # the body is (target actor ids, (target_actor_id, target_channel_id) pairs) whose input is not needed anymore.
+            # drop what we hold for them, and anything that gets pushed to them from now on.
+            actors, channels = pickle.loads(action.body.to_pybytes())
+
+            self.flights_lock.acquire()
+            self.cancelled_actors.update(actors)
+            self.cancelled_channels.update(channels)
+            for name in [name for name in self.flights if self._cancelled(name)]:
+                self._drop(name)
+                self.flight_keys.remove(name)
+            for key in [key for key in self.consumer_progress if key[0] in self.cancelled_actors or key[:2] in self.cancelled_channels]:
+                del self.consumer_progress[key]
+            self.flights_lock.release()
+
+            yield pyarrow.flight.Result(pyarrow.py_buffer(bytes(str(True), "utf-8")))
+
         elif action.type == "garbage_collect":
 
             gcable = pickle.loads(action.body.to_pybytes())
@@ -34,7 +34,9 @@ class HBQ:
         try:
             files = glob.glob(self.path + '*')
             for f in files:
-                os.remove(f)
+                # the Flight server keeps its spill directory in here too
+                if os.path.isfile(f):
+                    os.remove(f)
         except:
             pass
 
@@ -83,6 +83,8 @@ class Node:
 
         self.blocking = False
         self.placement_strategy = None
+        # list of stream ids. if set, each input stream is drained before the next one is read
+        self.ordering = None
     
     def lower(self, task_graph):
         raise NotImplementedError
@@ -189,6 +191,39 @@ class InputS3ParquetNode(SourceNode):
             result += "\n\t" + str(target) + " " + str(self.targets[target])
         return result
 
+class InputS3SortedParquetNode(InputS3ParquetNode):
+    '''
+    Parquet files under a S3 prefix that are each sorted on sorted_by and don't overlap on it. Every channel reads a contiguous key range, in order.
+    copartition is the (bucket, prefix, sorted_by) of another such dataset. If it's set, this one is split on the same key ranges as that one,
+    so channel i of both covers the same keys. This is what a sort-merge join needs.
+    '''
+    def __init__(self, bucket, prefix, schema, sorted_by, predicate = None, projection = None) -> None:
+        super().__init__(bucket, prefix, None, schema, predicate, projection)
+        self.sorted_by = sorted_by
+        self.copartition = None
+
+    def lower(self, task_graph):
+
+        # the same number of channels new_input_reader_node will launch
+        channels_per_node = 1 if self.placement_strategy is None else self.placement_strategy.channels_per_node
+        num_channels = task_graph.cluster.num_node * channels_per_node * task_graph.io_per_node
+        if self.copartition is None:
+            parquet_reader = InputSortedEC2ParquetDataset(self.bucket, self.prefix, self.sorted_by, columns = list(self.projection), filters = self.predicate)
+            parquet_reader.get_bounds(num_channels)
+        else:
+            bucket, prefix, sorted_by = self.copartition
+            channel_bounds = InputSortedEC2ParquetDataset(bucket, prefix, sorted_by).get_bounds(num_channels)
+            parquet_reader = InputEC2CoPartitionedSortedParquetDataset(self.bucket, self.prefix, self.sorted_by, columns = list(self.projection), filters = self.predicate)
+            parquet_reader.get_bounds(num_channels, channel_bounds)
+        node = task_graph.new_input_reader_node(parquet_reader, self.placement_strategy)
+        return node
+
+    def __str__(self):
+        result = str(type(self)) + '\nSorted by: ' + str(self.sorted_by) + '\nPredicate: ' + str(self.predicate) + '\nProjection: ' + str(self.projection) + '\nTargets:' 
+        for target in self.targets:
+            result += "\n\t" + str(target) + " " + str(self.targets[target])
+        return result
+
 class InputDiskParquetNode(SourceNode):
     def __init__(self, filepath, schema, predicate = None, projection = None) -> None:
         super().__init__(schema)
@@ -255,9 +290,9 @@ class StatefulNode(TaskNode):
             target_info = self.targets[list(self.targets.keys())[0]]
             transform_func = target_info_to_transform_func(target_info)          
             
-            return task_graph.new_blocking_node(parent_nodes,self.operator, self.placement_strategy, source_target_info=parent_source_info, transform_fn = transform_func)
+            return task_graph.new_blocking_node(parent_nodes,self.operator, self.placement_strategy, source_target_info=parent_source_info, transform_fn = transform_func, ordering = self.ordering)
         else:
-            return task_graph.new_non_blocking_node(parent_nodes,self.operator, self.placement_strategy, source_target_info=parent_source_info)
+            return task_graph.new_non_blocking_node(parent_nodes,self.operator, self.placement_strategy, source_target_info=parent_source_info, ordering = self.ordering)
         
 '''
 We need a separate MapNode from StatefulNode since we can compact UDFs
@@ -15,8 +15,9 @@ from functools import partial
 
 class TaskGraph:
     # this keeps the logical dependency DAG between tasks 
-    def __init__(self, cluster, io_per_node = 2, exec_per_node = 1) -> None:
+    def __init__(self, cluster, io_per_node = 2, exec_per_node = 1, exec_config = {}) -> None:
 
+        self.exec_config = exec_config
         self.io_per_node = io_per_node
         self.exec_per_node = exec_per_node
         self.cluster = cluster
@@ -177,12 +178,21 @@ class TaskGraph:
 
             result = {}
             assert type(data) == polars.internals.DataFrame
-            if "int" in str(data[key].dtype).lower():
-                partitions = data.with_column(polars.Series(name="__partition__", values=(data[key] % num_target_channels))).partition_by("__partition__")
+            if len(data) == 0:
+                # hash_rows panics on an empty frame, and there is nothing to send anyway
+                return result
+            if type(key) == list and len(key) == 1:
+                key = key[0]
+            if type(key) == list:
+                partitions = data.with_column(polars.Series(name="__partition__", values=(data.select(key).hash_rows() % num_target_channels))).partition_by("__partition__")
+            elif "int" in str(data[key].dtype).lower():
+                # the remainder of a negative key is negative
+                partitions = data.with_column(polars.Series(name="__partition__", values=((data[key] % num_target_channels) + num_target_channels) % num_target_channels)).partition_by("__partition__")
             elif data[key].dtype == polars.datatypes.Utf8:
                 partitions = data.with_column(polars.Series(name="__partition__", values=(data[key].hash() % num_target_channels))).partition_by("__partition__")
             else:
-                raise Exception("partition key type not supported")
+                # dates, floats, booleans etc.
+                partitions = data.with_column(polars.Series(name="__partition__", values=(data.select([key]).hash_rows() % num_target_channels))).partition_by("__partition__")
             for partition in partitions:
                 target = partition["__partition__"][0]
                 result[target] = partition.drop("__partition__")   
@@ -200,10 +210,27 @@ class TaskGraph:
                 result[target] = partition.drop("__partition__")   
             return result 
 
+        def partition_key_splitters(keys, splitters, data, source_channel, num_target_channels):
+
+            assert len(splitters) < num_target_channels
+            channel = polars.lit(0)
+            for i in range(len(splitters)):
+                # lexicographic data >= splitter i. null keys sort first, so they stay in channel 0
+                condition = polars.col(keys[-1]) >= splitters[keys[-1]][i]
+                for key in reversed(keys[:-1]):
+                    condition = (polars.col(key) > splitters[key][i]) | ((polars.col(key) == splitters[key][i]) & condition)
+                channel = channel + condition.fill_null(False).cast(polars.Int32)
+            result = {}
+            partitions = data.with_column(channel.cast(polars.Int32).alias("__partition__")).partition_by("__partition__")
+            for partition in partitions:
+                target = partition["__partition__"][0]
+                result[target] = partition.drop("__partition__")   
+            return result
+
         def broadcast(data, source_channel, num_target_channels):
             return {i: data for i in range(num_target_channels)}
         
-        def partition_fn(predicate_fn, partitioner_fn, batch_funcs, projection, num_target_channels, x, source_channel):
+        def partition_fn(predicate_fn, partitioner_fn, batch_funcs, projection, num_target_channels, x, source_channel, runtime_filter = None):
 
             start = time.time()
             if predicate_fn != sqlglot.exp.TRUE:
@@ -231,6 +258,10 @@ class TaskGraph:
                 else:
                     results[channel] = payload
                 # print("selection time", time.time() - start)
+
+                # rows the target can't use, see RuntimeFilter. the channel stays in results even if nothing is left.
+                if runtime_filter is not None:
+                    results[channel] = runtime_filter.filter(results[channel])
             return results
         
         mapping = {}
@@ -251,6 +282,8 @@ class TaskGraph:
                 target_info.partitioner = partial(partition_key_str, target_info.partitioner.key)
             elif type(target_info.partitioner) == RangePartitioner:
                 target_info.partitioner = partial(partition_key_range, target_info.partitioner.key, target_info.partitioner.total_range)
+            elif type(target_info.partitioner) == SplitterPartitioner:
+                target_info.partitioner = partial(partition_key_splitters, target_info.partitioner.keys, target_info.partitioner.splitters)
             elif type(target_info.partitioner) == BroadcastPartitioner:
                 target_info.partitioner = broadcast
             elif type(target_info.partitioner) == PassThroughPartitioner:
@@ -281,7 +314,7 @@ class TaskGraph:
 
         return input_reqs
 
-    def new_non_blocking_node(self, streams, functionObject, placement_strategy = CustomChannelsStrategy(1), source_target_info = {}):
+    def new_non_blocking_node(self, streams, functionObject, placement_strategy = CustomChannelsStrategy(1), source_target_info = {}, ordering = None):
 
         assert len(source_target_info) == len(streams)
         self.actor_types[self.current_actor] = 'exec'
@@ -295,6 +328,16 @@ class TaskGraph:
 
         input_reqs = self.prologue(streams, placement_strategy, source_target_info)
         # print("input_reqs",input_reqs)
+
+        # the sources of these streams drop the rows that fail the runtime filter the operator publishes, see JoinExecutor
+        for key in getattr(functionObject, "runtime_filter_streams", []):
+            registered = ray.get([node.register_runtime_filter.remote(streams[key], self.current_actor) for node in (self.nodes.values())])
+            assert all(registered)
+
+        if ordering is not None:
+            # ordering is a list of stream ids, the task managers want the source actors
+            registered = ray.get([node.register_ordering.remote(self.current_actor, [streams[key] for key in ordering]) for node in (self.nodes.values())])
+            assert all(registered)
         
         channel_locs = {}
         if type(placement_strategy) == SingleChannelStrategy:
@@ -325,12 +368,12 @@ class TaskGraph:
         
         return self.epilogue(placement_strategy)
 
-    def new_blocking_node(self, streams, functionObject, placement_strategy = CustomChannelsStrategy(1), source_target_info = {}, transform_fn = None):
+    def new_blocking_node(self, streams, functionObject, placement_strategy = CustomChannelsStrategy(1), source_target_info = {}, transform_fn = None, ordering = None):
 
         if placement_strategy is None:
             placement_strategy = CustomChannelsStrategy(1)
 
-        current_actor = self.new_non_blocking_node(streams, functionObject, placement_strategy, source_target_info)
+        current_actor = self.new_non_blocking_node(streams, functionObject, placement_strategy, source_target_info, ordering)
         self.actor_types[current_actor] = 'exec'
         total_channels = self.get_total_channels_from_placement_strategy(placement_strategy, 'exec')
 
@@ -345,6 +388,8 @@ class TaskGraph:
 
         initted = ray.get([node.init.remote() for node in list(self.nodes.values())])
         assert all(initted)
+        configured = ray.get([node.set_configs.remote(self.exec_config) for node in list(self.nodes.values())])
+        assert all(configured)
 
         # galaxy brain shit here -- the topological order is implicit given the way the API works. 
         topological_order = list(range(self.current_actor))[::-1]
@@ -387,4 +432,12 @@ class TaskGraph:
             new_thread.start()
         ray.get(self.coordinator.execute.remote())
         if not PROFILE:
-            new_thread.join()
\ No newline at end of file
+            new_thread.join()
+
+    def get_runtime_filter_stats(self):
+        # join actor_id -> rows its runtime filter dropped before the shuffle, over all machines
+        result = {}
+        for stats in ray.get([node.get_runtime_filter_stats.remote() for node in self.nodes.values()]):
+            for (source_actor_id, target_actor_id), pruned in stats.items():
+                result[target_actor_id] = result.get(target_actor_id, 0) + pruned
+        return result
\ No newline at end of file
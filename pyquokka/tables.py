@@ -270,4 +270,26 @@ class InputRequirementsTable(ClientWrapper):
     def to_dict(self, redis_client):
         keys = self.keys(redis_client)
         values = self.mget(redis_client, keys)
-        return {pickle.loads(key): pickle.loads(value) for key, value in zip(keys, values)}
\ No newline at end of file
+        return {pickle.loads(key): pickle.loads(value) for key, value in zip(keys, values)}
+'''
+- Runtime Filter Table (RFT): the runtime filters published by the build sides of joins, see RuntimeFilter in sketches.py
+    key: actor_id, channel_id, value: pickled RuntimeFilter
+'''
+
+class RuntimeFilterTable(ClientWrapper):
+    def __init__(self) -> None:
+        super().__init__("RFT")
+
+'''
+- Early Done Table (EDT): exec channels whose executor said it doesn't need the rest of its input, e.g. a limit that has its rows.
+    key: actor_id, channel_id, value: state_seq it happened at. The upstream actors that only feed such channels are cancelled, see TaskManager.update_cancelled
+'''
+
+class EarlyDoneTable(ClientWrapper):
+    def __init__(self) -> None:
+        super().__init__("EDT")
+    
+    def to_dict(self, redis_client):
+        keys = self.keys(redis_client)
+        values = self.mget(redis_client, keys)
+        return {pickle.loads(key): int(value) for key, value in zip(keys, values)}
@@ -47,11 +47,12 @@ class BroadcastPartitioner(Partitioner):
         return 'broadcast'
 
 class HashPartitioner(Partitioner):
+    # key can be a column name or a list of column names
     def __init__(self, key) -> None:
         super().__init__()
         self.key = key
     def __str__(self):
-        return self.key
+        return str(self.key)
 
 class RangePartitioner(Partitioner):
     # total_range needs to be filled by the cardinality estimator
@@ -64,6 +65,17 @@ class RangePartitioner(Partitioner):
     def __str__(self):
         return "range partitioner on " + str(self.key) + ", range estimate " + str(self.total_range)
 
+class SplitterPartitioner(Partitioner):
+    # splitters is a polars DataFrame of the key columns, sorted, with one row less than the number of target channels.
+    # rows below the first splitter go to channel 0, rows from splitter i - 1 up to splitter i go to channel i.
+    def __init__(self, keys, splitters) -> None:
+        super().__init__()
+        self.keys = keys
+        self.splitters = splitters
+
+    def __str__(self):
+        return "range partitioner on " + str(self.keys) + " with " + str(len(self.splitters)) + " splitters"
+
 class FunctionPartitioner(Partitioner):
     def __init__(self, func) -> None:
         super().__init__()
@@ -0,0 +1,61 @@
+import numpy as np
+import polars
+import pytest
+from pyquokka.executors import DistinctExecutor, KeySet
+
+def run(executor, batches):
+    results = []
+    for batch in batches:
+        result = executor.execute([batch], 0, 0)
+        if result is not None:
+            results.append(result)
+    remaining = executor.done(0)
+    if remaining is not None:
+        results.extend(remaining)
+    return results
+
+def same(results, frame, keys):
+    got = polars.concat(results) if len(results) > 0 else frame[:0]
+    expected = frame.unique(subset = keys)
+    assert len(got) == len(expected)
+    assert got.select(keys).sort(keys).frame_equal(expected.select(keys).sort(keys), null_equal = True)
+
+def keys_frame(rng, rows):
+    return polars.DataFrame({"a": rng.integers(0, 300, rows), "b": rng.choice(["x", "y", "z"], rows)})
+
+@pytest.mark.parametrize("keys", [["a"], ["a", "b"]])
+@pytest.mark.parametrize("exact", [False, True])
+@pytest.mark.parametrize("spill_bytes", [None, 2000])
+def test_distinct_matches_unique(tmp_path, keys, exact, spill_bytes):
+    rng = np.random.default_rng(len(keys) + 2 * exact)
+    frame = keys_frame(rng, 3000)
+    executor = DistinctExecutor(keys, spill_bytes = spill_bytes, spill_partitions = 4, exact = exact)
+    executor.data_dir = str(tmp_path) + "/"
+    # the same keys over and over, so most batches have nothing new
+    batches = [frame[i : i + 250] for i in range(0, len(frame), 250)] + [frame[:250]]
+    same(run(executor, batches), frame, keys)
+
+def test_distinct_batch_without_new_keys():
+    executor = DistinctExecutor(["a", "b"])
+    frame = polars.DataFrame({"a": [1, 2, 2], "b": ["x", "y", "y"]})
+    assert len(executor.execute([frame], 0, 0)) == 2
+    assert executor.execute([frame], 0, 0) is None
+
+def test_distinct_batch_all_in_spilled_partitions(tmp_path):
+    executor = DistinctExecutor(["a"], spill_bytes = 1, spill_partitions = 2)
+    executor.data_dir = str(tmp_path) + "/"
+    frame = polars.DataFrame({"a": np.arange(100)})
+    results = [executor.execute([frame[:50]], 0, 0)]
+    assert len(executor.spilled) == 2
+    assert executor.execute([frame[50:]], 0, 0) is None
+    # the spilled keys that came out already must not come out again
+    assert executor.execute([frame[:50]], 0, 0) is None
+    executor.spill_bytes = None
+    same(results + list(executor.done(0)), frame, ["a"])
+
+def test_keyset_nulls_and_empty():
+    keyset = KeySet(["a"])
+    frame = polars.DataFrame({"a": [None, 1, None]})
+    assert len(keyset.add(frame)) == 2
+    assert len(keyset.add(frame)) == 0
+    assert len(keyset.add(frame[:0])) == 0
@@ -0,0 +1,84 @@
+import numpy as np
+import polars
+import pytest
+from pyquokka.executors import JoinExecutor
+
+def outputs(result):
+    # what execute or done gave back: None, a DataFrame or a generator of them
+    if result is None:
+        return []
+    if isinstance(result, polars.DataFrame):
+        return [result]
+    return [frame for frame in result if frame is not None]
+
+def run(executor, left, right, seed, build_first = False):
+    # feed the batches of both sides in a random interleaving, like the runtime would
+    rng = np.random.default_rng(seed)
+    results = []
+    streams = {0: list(left), 1: list(right)}
+    if build_first:
+        order = [1] * len(right) + [0] * len(left)
+    else:
+        order = [0] * len(left) + [1] * len(right)
+        rng.shuffle(order)
+    for position, stream_id in enumerate(order):
+        results.extend(outputs(executor.execute([streams[stream_id].pop(0)], stream_id, 0)))
+        remaining = set(order[position + 1:])
+        executor.update_sources(remaining)
+    results.extend(outputs(executor.done(0)))
+    return results
+
+def batches(frame, rng):
+    cuts = np.sort(rng.choice(np.arange(1, len(frame)), size = min(4, len(frame) - 1), replace = False))
+    return [frame[a:b] for a, b in zip([0] + list(cuts), list(cuts) + [len(frame)])]
+
+def same(results, expected):
+    columns = expected.columns
+    got = polars.concat([frame.select(columns) for frame in results]) if len(results) > 0 else expected[:0]
+    assert len(got) == len(expected)
+    if len(expected) > 0:
+        assert got.sort(columns).frame_equal(expected.sort(columns), null_equal = True)
+
+@pytest.mark.parametrize("how", ["inner", "left", "semi"])
+@pytest.mark.parametrize("spill", [False, True])
+@pytest.mark.parametrize("seed", range(6))
+def test_join_matches_polars(tmp_path, how, spill, seed):
+    rng = np.random.default_rng(seed)
+    # few distinct keys, so there are plenty of duplicates, and some keys only on one side
+    left = polars.DataFrame({"k": rng.integers(0, 12, 60), "a": np.arange(60)})
+    right = polars.DataFrame({"k": rng.integers(4, 16, 40), "b": np.arange(40) * 10})
+    executor = JoinExecutor(on = "k", how = how, spill_bytes = 500 if spill else None, spill_partitions = 4)
+    executor.data_dir = str(tmp_path) + "/"
+    results = run(executor, batches(left, rng), batches(right, rng), seed)
+    same(results, left.join(right, on = "k", how = how))
+
+@pytest.mark.parametrize("how", ["inner", "left", "semi"])
+def test_join_build_first(how):
+    rng = np.random.default_rng(0)
+    left = polars.DataFrame({"k": rng.integers(0, 12, 60), "a": np.arange(60)})
+    right = polars.DataFrame({"k": rng.integers(4, 16, 40), "b": np.arange(40) * 10})
+    executor = JoinExecutor(on = "k", how = how, build_first = True)
+    same(run(executor, batches(left, rng), batches(right, rng), 0, build_first = True), left.join(right, on = "k", how = how))
+
+def test_semi_join_empty_selections():
+    # a left batch with no match, then one where every row matches
+    executor = JoinExecutor(on = "k", how = "semi")
+    assert executor.execute([polars.DataFrame({"k": [1, 2], "a": [0, 1]})], 0, 0) is None
+    assert len(executor.index0) == 2
+    executor.execute([polars.DataFrame({"k": [5], "b": [0]})], 1, 0)
+    result = executor.execute([polars.DataFrame({"k": [5, 5], "a": [2, 3]})], 0, 0)
+    assert result["a"].to_list() == [2, 3]
+    assert len(executor.index0) == 2
+
+def test_spilled_batch_entirely_in_spilled_partitions(tmp_path):
+    executor = JoinExecutor(on = "k", how = "inner", spill_bytes = 1, spill_partitions = 2)
+    executor.data_dir = str(tmp_path) + "/"
+    left = polars.DataFrame({"k": np.arange(20), "a": np.arange(20)})
+    right = polars.DataFrame({"k": np.arange(20), "b": np.arange(20)})
+    results = outputs(executor.execute([left[:10]], 0, 0))
+    # everything is spilled now, so the next batches go straight to disk
+    assert len(executor.spilled) == 2
+    results += outputs(executor.execute([left[10:]], 0, 0))
+    results += outputs(executor.execute([right], 1, 0))
+    results += outputs(executor.done(0))
+    same(results, left.join(right, on = "k"))
@@ -0,0 +1,41 @@
+import numpy as np
+import polars
+from pyquokka.sketches import RuntimeFilter, hash_keys, take_rows
+
+def test_hash_keys_empty():
+    frame = polars.DataFrame({"a": [1, 2], "b": ["x", "y"]})[:0]
+    assert len(hash_keys(frame, ["a", "b"])) == 0
+    assert len(hash_keys(frame, ["a"], 7, 11, 13, 17)) == 0
+
+def test_take_rows_empty():
+    frame = polars.DataFrame({"a": [1, 2, 3]})
+    assert take_rows(frame, np.empty(0, dtype = np.int64)).shape == (0, 1)
+    assert take_rows(frame, np.array([0, 2]))["a"].to_list() == [1, 3]
+
+def test_runtime_filter_prunes_everything():
+    build = polars.DataFrame({"k": [1, 2, 3]})
+    runtime_filter = RuntimeFilter(["key"])
+    runtime_filter.add(build, ["k"])
+    runtime_filter.finalize()
+    probe = polars.DataFrame({"key": [10, 11, 12], "v": ["a", "b", "c"]})
+    result = runtime_filter.filter(probe)
+    assert result.shape == (0, 2) and result.columns == ["key", "v"]
+    assert runtime_filter.pruned == 3
+    assert runtime_filter.filter(probe[:0]).shape == (0, 2)
+
+def test_runtime_filter_keeps_matches():
+    build = polars.DataFrame({"k": np.arange(0, 1000, 3)})
+    runtime_filter = RuntimeFilter(["key"])
+    runtime_filter.add(build, ["k"])
+    runtime_filter.finalize()
+    probe = polars.DataFrame({"key": np.arange(1000)})
+    result = runtime_filter.filter(probe)["key"].to_numpy()
+    # a bloom filter never drops a match
+    assert set(np.arange(0, 1000, 3)).issubset(set(result))
+
+def test_runtime_filter_pass_all_merge():
+    runtime_filter = RuntimeFilter(["key"])
+    runtime_filter.add(polars.DataFrame({"k": [1]}), ["k"])
+    runtime_filter.merge(RuntimeFilter(["key"]).pass_all()).finalize()
+    probe = polars.DataFrame({"key": [1, 5, 9]})
+    assert runtime_filter.filter(probe)["key"].to_list() == [1, 5, 9]
@@ -0,0 +1,64 @@
+import numpy as np
+import polars
+import pytest
+from pyquokka.executors import SortMergeJoinExecutor
+
+def sorted_batches(frame, key, rng):
+    # sorted against each other but not inside, and cut so runs of equal keys cross batch boundaries
+    frame = frame.sort(key)
+    cuts = np.sort(rng.choice(np.arange(1, len(frame)), size = 5, replace = False))
+    return [frame[a:b].sample(frac = 1.0, seed = int(rng.integers(1000))) for a, b in zip([0] + list(cuts), list(cuts) + [len(frame)])]
+
+def run(executor, left, right, rng):
+    results = []
+    streams = {0: list(left), 1: list(right)}
+    order = [0] * len(left) + [1] * len(right)
+    rng.shuffle(order)
+    for position, stream_id in enumerate(order):
+        result = executor.execute([streams[stream_id].pop(0)], stream_id, 0)
+        if result is not None:
+            results.append(result)
+        executor.update_sources(set(order[position + 1:]))
+    result = executor.done(0)
+    if result is not None:
+        results.append(result)
+    return results
+
+def same(results, expected):
+    columns = expected.columns
+    got = polars.concat([frame.select(columns) for frame in results]) if len(results) > 0 else expected[:0]
+    assert len(got) == len(expected)
+    if len(expected) > 0:
+        assert got.sort(columns).frame_equal(expected.sort(columns), null_equal = True)
+
+@pytest.mark.parametrize("how", ["inner", "left", "semi", "anti"])
+@pytest.mark.parametrize("seed", range(10))
+def test_sort_merge_join_matches_polars(how, seed):
+    rng = np.random.default_rng(seed)
+    # few distinct keys, so long runs of equal keys span batches on both sides
+    left = polars.DataFrame({"k": rng.integers(0, 8, 60), "a": np.arange(60)})
+    right = polars.DataFrame({"k": rng.integers(2, 10, 50), "b": np.arange(50) * 10})
+    executor = SortMergeJoinExecutor(on = "k", how = how)
+    results = run(executor, sorted_batches(left, "k", rng), sorted_batches(right, "k", rng), rng)
+    same(results, left.join(right, on = "k", how = how))
+
+def test_sort_merge_join_tie_across_batches():
+    # the run of 2s crosses a batch boundary on both sides, and the watermark lands on it
+    executor = SortMergeJoinExecutor(on = "k", how = "inner")
+    results = []
+    for stream_id, batch in [(0, {"k": [1, 2, 2], "a": [0, 1, 2]}), (1, {"k": [2, 2], "b": [0, 1]}), 
+            (0, {"k": [2, 3], "a": [3, 4]}), (1, {"k": [2, 3], "b": [2, 3]})]:
+        result = executor.execute([polars.DataFrame(batch)], stream_id, 0)
+        if result is not None:
+            results.append(result)
+    executor.update_sources(set())
+    results.append(executor.done(0))
+    same(results, polars.DataFrame({"k": [1, 2, 2, 2, 3], "a": [0, 1, 2, 3, 4]}).join(
+        polars.DataFrame({"k": [2, 2, 2, 3], "b": [0, 1, 2, 3]}), on = "k"))
+
+def test_sort_merge_left_join_empty_right():
+    executor = SortMergeJoinExecutor(on = "k", how = "left", right_schema = ["k", "b"])
+    executor.execute([polars.DataFrame({"k": [1, None], "a": [0, 1]})], 0, 0)
+    executor.update_sources(set())
+    result = executor.done(0)
+    assert len(result) == 2 and result["b"].null_count() == 2
@@ -0,0 +1,38 @@
+import numpy as np
+import polars
+import pytest
+from pyquokka.executors import WindowExecutor
+
+def run(executor, frame, tmp_path):
+    executor.sorter.data_dir = str(tmp_path) + "/"
+    # small runs and output batches, so the windows cross both
+    executor.sorter.run_rows = 37
+    executor.sorter.output_batch_rows = 23
+    for i in range(0, len(frame), 29):
+        executor.execute([frame[i : i + 29]], 0, 0)
+    return polars.concat(list(executor.done(0)))
+
+@pytest.mark.parametrize("seed", range(5))
+def test_window_matches_polars(tmp_path, seed):
+    rng = np.random.default_rng(seed)
+    rows = 300
+    # orderby is unique, so the order inside every group is well defined
+    frame = polars.DataFrame({"g": rng.integers(0, 7, rows), "h": rng.choice(["x", "y"], rows), "t": rng.permutation(rows), "v": rng.integers(0, 100, rows)})
+    windows = [("rn", "row_number", None, 0), ("rk", "rank", None, 0), ("lag2", "lag", "v", 2), ("lead1", "lead", "v", 1), ("cs", "cumsum", "v", 0)]
+    result = run(WindowExecutor(["g", "h"], "t", windows), frame, tmp_path)
+
+    expected = frame.sort("t").with_columns([
+        polars.col("t").cumcount().over(["g", "h"]).cast(polars.Int64).alias("rn") + 1,
+        polars.col("t").rank("min").over(["g", "h"]).cast(polars.Int64).alias("rk"),
+        polars.col("v").shift(2).over(["g", "h"]).alias("lag2"),
+        polars.col("v").shift(-1).over(["g", "h"]).alias("lead1"),
+        polars.col("v").cumsum().over(["g", "h"]).alias("cs")])
+    assert len(result) == rows
+    columns = expected.columns
+    assert result.select(columns).sort("t").frame_equal(expected.select(columns).sort("t"), null_equal = True)
+
+def test_window_rank_ties(tmp_path):
+    # ties of the order column across batches and runs get the same rank
+    frame = polars.DataFrame({"g": [1] * 100, "t": [i // 10 for i in range(100)]})
+    result = run(WindowExecutor(["g"], "t", [("rk", "rank", None, 0)]), frame, tmp_path)
+    assert (result["rk"].to_numpy() == result["t"].to_numpy() * 10 + 1).all()